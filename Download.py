@@ -8,8 +8,9 @@ For Example, you could shut down a stalled download stream without affecting
 the current Python VM"""
 
 import time
-from threading import Thread, Lock
+from threading import Thread, Lock, Condition, current_thread
 from Queue import PriorityQueue
+import heapq
 import sys, os, errno, re, subprocess
 import utils, protocol_handler, shutil
 import logging
@@ -40,6 +41,7 @@ class DownloadThread(Thread):
         self.name = name
         self.running = True
         self.active_file = None
+        self.active_url = None
         self.downloaded = None
         self.benchmarks = None
 
@@ -164,6 +166,7 @@ class DownloadThread(Thread):
         log.debug("Downloading %s [%s-%s] (%s)",full_path, start, end, protocol)
         #start download
         self.active_file = full_path
+        self.active_url = url
         self.benchmarks = utils.Struct(time=time.time(), bytes=start, avg= 0)
         self.start_byte = start
         
@@ -181,6 +184,7 @@ class DownloadThread(Thread):
         #download done!
         self._handler = None
         self.active_file = None
+        self.active_url = None
 
         if ret == 0:
             return (self.__class__.EXIT_DONE, {'file':full_path, 'url':url, 'size':end-start})
@@ -201,6 +205,11 @@ class DownloadThread(Thread):
             except: pass    #The process might have just been ended
 
     def __getTargetFileSize(self):
+        #in-process handlers know better than the file system (files might be preallocated)
+        h = self._handler
+        if h:
+            progress = h.getProgress()
+            if progress is not None: return progress
         file = self.active_file
         if file:
             try:
@@ -241,6 +250,197 @@ class DownloadThread(Thread):
         return avg
 
 
+def getHost(url):
+    """Returns the host part of the url ('localhost' for local files)."""
+    if not url or '://' not in url: return 'localhost'
+    return url.split('/')[2].split(':')[0] or 'localhost'
+
+class HostQueue(object):
+    """Pending downloads from one host together with the number of concurrent downloads
+    we allow for it. The limit is tuned from the throughput achieved and the failures seen."""
+    #seconds to wait before judging a change
+    TUNE_INTERVAL = 30
+    #seconds to wait before trying to add a slot again after it didn't help
+    HOLD_TIME = 300
+
+    def __init__(self, host, limit, max_limit):
+        self.host = host
+        self.limit = limit
+        self.max_limit = max_limit
+        self.pending = []   #heap of (priority, sequence, entry)
+        self.active = 0
+        self.done = self.failed = 0
+        #failures since the last tuning step
+        self.recent_done = self.recent_failed = 0
+        self.speed = 0.0
+        self.last_speed = 0.0
+        self.last_change = time.time()
+        self.hold_until = 0
+        self.probing = False
+
+    def report(self, ok):
+        if ok:
+            self.done += 1
+            self.recent_done += 1
+        else:
+            self.failed += 1
+            self.recent_failed += 1
+
+    def tune(self, speed, now):
+        """Adjust the limit. speed:= current throughput from this host (byte/s).
+        Returns True if the limit changed."""
+        self.speed = speed
+        if now - self.last_change < HostQueue.TUNE_INTERVAL: return False
+        old_limit = self.limit
+
+        if self.recent_failed > 1 and self.recent_failed > self.recent_done:
+            #the host is having trouble (or refusing connections), back off
+            self.limit = max(1, self.limit/2)
+            self.hold_until = now + HostQueue.HOLD_TIME
+            self.probing = False
+            log.debug('%s: %s of %s downloads failed, limit %s -> %s', self.host, self.recent_failed,\
+                      self.recent_failed + self.recent_done, old_limit, self.limit)
+        elif self.probing:
+            #we added a slot last time, let's see if it was worth it
+            self.probing = False
+            if speed < self.last_speed * 1.2:
+                #no (or not enough) improvement, give it back and don't try again for a while
+                self.limit = max(1, self.limit - 1)
+                self.hold_until = now + HostQueue.HOLD_TIME
+                log.debug('%s: %.2f MB/s with %s slots is no improvement, back to %s', self.host,\
+                          speed/1024/1024, old_limit, self.limit)
+        elif now >= self.hold_until and self.limit < self.max_limit and self.pending \
+                and self.active >= self.limit:
+            #all slots are busy and there's more to do, let's see if a new slot helps
+            self.last_speed = speed
+            self.limit += 1
+            self.probing = True
+            log.debug('%s: trying %s slots (%.2f MB/s now)', self.host, self.limit, speed/1024/1024)
+
+        self.recent_done = self.recent_failed = 0
+        self.last_change = now
+        return self.limit != old_limit
+
+class HostScheduler(object):
+    """Queue of downloads grouped per host. It can be used instead of the PriorityQueue by
+    the DownloadThreads (put, get, task_done, qsize and join). get() hands out entries
+    round robin from all hosts which still have a free slot, so a slow or overloaded
+    host doesn't hold the threads which could be downloading from the others."""
+
+    def __init__(self, start_limit=1, max_limit=4):
+        self.start_limit = start_limit
+        self.max_limit = max_limit
+        self.hosts = {}
+        self.order = []     #hosts in round robin order
+        self.next_index = 0
+        self.control = []   #STOP tokens, they go before anything else
+        self.unfinished = 0
+        self.counter = 0
+        #thread -> HostQueue of the entry it's processing
+        self.current = {}
+        self.cond = Condition()
+
+    def put(self, item):
+        priority, entry = item
+        self.cond.acquire()
+        try:
+            if entry == DownloadThread.STOP:
+                self.control.append(item)
+            else:
+                host = getHost(entry[1])
+                hq = self.hosts.get(host)
+                if hq is None:
+                    hq = self.hosts[host] = HostQueue(host, self.start_limit, self.max_limit)
+                    self.order.append(hq)
+                self.counter += 1
+                heapq.heappush(hq.pending, (priority, self.counter, entry))
+            self.unfinished += 1
+            self.cond.notify_all()
+        finally:
+            self.cond.release()
+
+    def _pick(self):
+        """Next host in turn with something pending and a free slot, or None."""
+        count = len(self.order)
+        for i in range(count):
+            hq = self.order[(self.next_index + i) % count]
+            if hq.pending and hq.active < hq.limit:
+                self.next_index = (self.next_index + i + 1) % count
+                return hq
+        return None
+
+    def get(self):
+        """Blocks until there's something this thread may process. Returns (priority, entry)."""
+        self.cond.acquire()
+        try:
+            while True:
+                if self.control:
+                    self.current[current_thread()] = None
+                    return self.control.pop(0)
+                hq = self._pick()
+                if hq:
+                    priority, counter, entry = heapq.heappop(hq.pending)
+                    hq.active += 1
+                    self.current[current_thread()] = hq
+                    return (priority, entry)
+                self.cond.wait()
+        finally:
+            self.cond.release()
+
+    def task_done(self):
+        self.cond.acquire()
+        try:
+            hq = self.current.pop(current_thread(), None)
+            if hq: hq.active -= 1
+            self.unfinished -= 1
+            self.cond.notify_all()
+        finally:
+            self.cond.release()
+
+    def join(self):
+        """Blocks until every entry put was processed."""
+        self.cond.acquire()
+        try:
+            #wait with a timeout so we can still be interrupted
+            while self.unfinished > 0: self.cond.wait(1)
+        finally:
+            self.cond.release()
+
+    def qsize(self):
+        """Number of entries not yet handed out."""
+        return len(self.control) + sum([len(hq.pending) for hq in self.order])
+
+    def report(self, url, ok):
+        """Record the outcome of a download from this url."""
+        self.cond.acquire()
+        try:
+            hq = self.hosts.get(getHost(url))
+            if hq: hq.report(ok)
+        finally:
+            self.cond.release()
+
+    def tune(self, speeds):
+        """Adjust the limit of every host. speeds:= {host: byte/s}"""
+        now = time.time()
+        self.cond.acquire()
+        try:
+            changed = False
+            for hq in self.order:
+                if hq.tune(speeds.get(hq.host, 0.0), now): changed = True
+            if changed: self.cond.notify_all()
+        finally:
+            self.cond.release()
+
+    def wantedThreads(self):
+        """Number of threads that could be busy right now."""
+        return sum([min(hq.limit, hq.active + len(hq.pending)) for hq in self.order])
+
+    def getStatus(self):
+        """Returns [(host, active, limit, pending, done, failed, byte/s)]"""
+        return [(hq.host, hq.active, hq.limit, len(hq.pending), hq.done, hq.failed, hq.speed)\
+                for hq in self.order]
+
+
 class DownloadManager(object):
     """Manages multiple donloadThreads.
 
@@ -249,7 +449,7 @@ class DownloadManager(object):
         what you are doing""" 
 
     def __init__(self):
-        self.priorityQueue = PriorityQueue()
+        self.scheduler = HostScheduler()
         self.threads = []
         self.started = False
         self.lock = Lock()
@@ -261,6 +461,9 @@ class DownloadManager(object):
         #init (this can be configurable)
         self.startThreads = 2
         self.maxThreads = 4
+        #concurrent downloads per host, at start and at most
+        self.startPerHost = 1
+        self.maxPerHost = 4
         
     def _callback(self, status, **data):
         """This MUST be multithread secured"""
@@ -271,16 +474,18 @@ class DownloadManager(object):
         elif status == DownloadThread.EXIT_DONE: 
             log.debug('%s done.', data['file'])
             self.results.done += 1
+            if not data.get('already_there'): self.scheduler.report(data['url'], True)
             if data['url'].find('file://')!=0 and 'size' in data.keys():
                 self.results.doneB += (data['size'])
                 self.results.doneDL += 1  # doneDL only counts files downloaded over the Internet,
                 # unlike done which counts all files including local copies
         elif status == DownloadThread.EXIT_DOWNLOAD_ERR:
             log.warn('The download from %s failed.', data['url'])
+            self.scheduler.report(data['url'], False)
             if self.retry:
                 #reschedule this download
                 log.warn('Error downloading %s, retrying..', data['url'])
-                self.download(data['file'], data['url'])
+                self.download(data['url'], data['file'], size=data.get('end'))
             else:
                 self.results.failed += 1
                 self.results.failed_data.append(data)
@@ -293,7 +498,7 @@ class DownloadManager(object):
         if self.currentThreads >= self.maxThreads: return
 
         self.currentThreads += 1
-        t = DownloadThread('DownloadThread-{0}'.format(len(self.threads)), self.priorityQueue, callback=self._callback)
+        t = DownloadThread('DownloadThread-{0}'.format(len(self.threads)), self.scheduler, callback=self._callback)
         t.start()
 
         self.threads.append(t)
@@ -308,7 +513,7 @@ class DownloadManager(object):
         self.currentThreads -= 1
 
         #next token will cause a thread to be killed
-        self.priorityQueue.put((DownloadThread.PRIO_HIGH, DownloadThread.STOP))
+        self.scheduler.put((DownloadThread.PRIO_HIGH, DownloadThread.STOP))
         
     def _cleanList(self):
         """Remove al dead threads. Return number of removed threads."""
@@ -322,6 +527,8 @@ class DownloadManager(object):
     def start(self):
         if self.started: return
 
+        self.scheduler.start_limit = self.startPerHost
+        self.scheduler.max_limit = self.maxPerHost
         for i in range(self.startThreads):
             self._addThread()
 
@@ -345,9 +552,9 @@ class DownloadManager(object):
         #log.debug('Adding %s..%s(%s)',url[:30], url[-30:], size)
         
         try:
-            self.priorityQueue.put((DownloadThread.PRIO_NORMAL, (file, url, size, flags)))
+            self.scheduler.put((DownloadThread.PRIO_NORMAL, (file, url, size, flags)))
         except:
-            print "jfp exception thrown from priorityQueue.put() for",url
+            print "jfp exception thrown from scheduler.put() for",url
             print sys.exc_info()[:3]
             raise
 
@@ -358,78 +565,33 @@ class DownloadManager(object):
             The current thread will be used for managing which involves, creating Threads and removing them as required.
             bechmark_callback:= call back function(speed=byte/s, files_done=#file_finished, threads=#active_threads)"""
 
-        last_speed = 0.0001
-        old_speeds = []
-        checking = True
-        try_new_thread = True
-        last_time = time.time()
-        improvement_index = 0
-        threshold = 1<<17   #128k
         speeds = self._getSpeeds()
 
-        while self.priorityQueue.qsize() > 0:
+        while self.scheduler.qsize() > 0:
             try:
                 #sleep a little
                 time.sleep(2)
 
+                host_speeds = self._getSpeedsByHost()
                 speeds = self._getSpeeds()
-
-                if not speeds and self.currentThreads: continue #No active threads. Nothing to do.
-                
                 total_speed = sum(speeds)
-                old_speeds.append(total_speed)
+
+                #each host gets its own concurrency limit, tuned from its throughput and failures
+                self.scheduler.tune(host_speeds)
+
+                #and we keep as many threads as the hosts can use
+                wanted = min(self.maxThreads, max(1, self.scheduler.wantedThreads()))
+                while self.currentThreads < wanted: self._addThread()
+                while self.currentThreads > wanted: self._removeThread()
 
                 if verbose: self.showStatus(speeds)
                 
                 #pass benchmarks if a call back was defined
                 if benchmark_callback: benchmark_callback(speed=total_speed, files_done=self.results.done, threads=len(speeds))
-                log.debug("%s Active Threads at %.2f MB/s (%.2f Mbps). files done:%s, failed:%s, still:%s on %s",len(speeds), total_speed/1024/1024, total_speed*8/1000000, self.results.done, self.results.failed, self.priorityQueue.qsize(),time.ctime())
-
-                if total_speed < threshold: continue #Something's wrong here, more threads will not help, that's for sure
-
-                now = time.time()
-                elapsed_time = now - last_time
-                if self.currentThreads < self.maxThreads:
-                    
-                    #in this case we count the average from the first one 
-                    total_speed = sum(old_speeds)/len(old_speeds)
-                    #until we reach the threads limit we'll dynamically add threads 
-
-                    if checking:
-                        improvement_index = total_speed/last_speed
-                        log.debug('index=%.2f, threads=%s', improvement_index, len(speeds))
-                        if improvement_index > 1.2:
-                            #this worked! reset everything 
-                            try_new_thread = True
-                        elif elapsed_time > 30:
-                            #stop checking this is it, don't add any more threads
-                            checking = False
-                            if self.currentThreads > 1 and improvement_index < 0.8: 
-                                #This is worse (definitely not better), so let's take down a thread
-                                log.debug('Performance dropped, removing latest thread...')
-                                self._removeThread()
-                            else:
-                                log.debug('No performance increase. Let\'s leave it here...')
-                
-
-                    if try_new_thread or elapsed_time > 300:
-                        #reset time and start checking again
-                        log.debug("Let's see if a new thread helps...")
-                        last_speed = total_speed
-                        self._addThread()
-                        #start procedure
-                        old_speeds = []
-                        last_time = now
-                        checking = True
-                        try_new_thread = False
-                elif elapsed_time > 600 and self.currentThreads > 1:
-                    #all threads are created, let's end one and see what happens...
-                    log.debug('Everythings fine... we need some chaos, let\'s drop a thread...')
-                    last_time = now
-                    self._removeThread()
-                    checking = True
-                    
-
+                log.debug("%s Active Threads at %.2f MB/s (%.2f Mbps). files done:%s, failed:%s, still:%s on %s",len(speeds), total_speed/1024/1024, total_speed*8/1000000, self.results.done, self.results.failed, self.scheduler.qsize(),time.ctime())
+                for host, active, limit, pending, done, failed, speed in self.scheduler.getStatus():
+                    log.debug("  %s: %s/%s active at %.2f MB/s, pending:%s, done:%s, failed:%s", host,\
+                              active, limit, speed/1024/1024, pending, done, failed)
     
             except (KeyboardInterrupt, SystemExit):
                 #let us end the program if desired!
@@ -457,7 +619,7 @@ class DownloadManager(object):
                 
         log.debug('The queue is empty, waiting for last threads to finish')
         #The queue is empty, now we only have to wait for the threads to finish
-        self.priorityQueue.join()
+        self.scheduler.join()
         #We should check again that the queue is empty, in case the last threads connection broke....
         if verbose:  # added by jfp
             self.showStatus(speeds) #jfp
@@ -474,6 +636,14 @@ class DownloadManager(object):
     def _getSpeeds(self):
         """Returns an array of the mean speeds (byte/s) of all active threads, no particular order though"""
         return [ t.getThroughput() for t in filter(lambda t: t.isActive(), self.threads)]
+
+    def _getSpeedsByHost(self):
+        """Returns a dictionary {host: mean speed (byte/s)} summing all active threads per host"""
+        speeds = {}
+        for t in filter(lambda t: t.isActive(), self.threads):
+            host = getHost(t.active_url)
+            speeds[host] = speeds.get(host, 0.0) + t.getThroughput()
+        return speeds
             
         
     def showStatus(self, *speed ):
@@ -488,8 +658,8 @@ class DownloadManager(object):
         print ("{0} Active Threads at {1:.2f} MB/s ({2:.2f} Mbps)."+\
                " files done:{3}, failed:{4}, still:{5} on {6}").\
               format(len(speed), total/1024/1024, total*8/1000000,\
-                     self.results.done, self.results.failed, self.priorityQueue.qsize(),time.ctime())
-        #jfp was print "{0} Active Threads at {1:.2f} MB/s ({2:.2f} Mbps). files done:{3}, still:{4}".format(len(speed), total/1024/1024, total*8/1000000, self.results.done, self.priorityQueue.qsize())
+                     self.results.done, self.results.failed, self.scheduler.qsize(),time.ctime())
+        #jfp was print "{0} Active Threads at {1:.2f} MB/s ({2:.2f} Mbps). files done:{3}, still:{4}".format(len(speed), total/1024/1024, total*8/1000000, self.results.done, self.scheduler.qsize())
 
 
 
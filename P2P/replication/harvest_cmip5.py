@@ -106,39 +106,49 @@ class Dataset(Base, DAO):
                 filecount=p2p_result['number_of_files'], creationtime=p2p_result['timestamp'])
 
     @staticmethod
-    def insert(p2p_results):
-        """Insert all results from the path p2p_result (or list) into the current session 
+    def insert(p2p_results, session=None):
+        """Insert all results from the path p2p_result (or list) into the given (or current) session 
 (Does not commit them!)"""
+        if session is None: session = getSession()
         if isinstance(p2p_results, dict): p2p_results = [p2p_results]
         for dataset in p2p_results:
             try:
                 ds = Dataset.instance(dataset)
                 if ds:
-                    getSession().add(ds)
+                    session.add(ds)
             except:
                 log.error('Skipping dataset: ' + ('id' in dataset and dataset['id'] or 'dataset'))
 
     @staticmethod
-    def update(p2p_results):
-        """Updates (all inserts) all results from the path p2p_result (or list) into the current session
-(Does not commit them!)"""
+    def update(p2p_results, session=None):
+        """Updates (all inserts) all results from the path p2p_result (or list) into the given
+(or current) session (Does not commit them!)"""
+        if session is None: session = getSession()
         if isinstance(p2p_results, dict): p2p_results = [p2p_results]
         for dataset in p2p_results:
             try:
                 ds = Dataset.instance(dataset)
                 if ds:
-                    _ = getSession().merge(ds)
+                    _ = session.merge(ds)
             except:
                 log.error('Skipping dataset: ' + ('id' in dataset and dataset['id'] or 'dataset'))
 
 
 _db = None
+_Session = None
+def newSession():
+    """Returns a new session. Sessions can't be shared among threads, each one needs its own."""
+    global _Session
+    if not _Session:
+        e = sqlalchemy.create_engine(_dburl )
+        Base.metadata.create_all(e)
+        _Session = orm.sessionmaker(bind=e, autoflush=False, autocommit=False,expire_on_commit=False)
+    return _Session()
+
 def getSession():
     global _db
     if not _db:
-        e = sqlalchemy.create_engine(_dburl )
-        Base.metadata.create_all(e)
-        _db = orm.sessionmaker(bind=e, autoflush=False, autocommit=False,expire_on_commit=False)()
+        _db = newSession()
     return _db
 
 def Q():
@@ -152,12 +162,145 @@ def __trim_dict(dict, *key_list):
         if key in dict: 
             del dict[key]
 
+def _chunks(items, size):
+    items = list(items)
+    for i in range(0, len(items), size):
+        yield items[i:i+size]
+
+def _upsert(session, p2p_results, data_node):
+    """Inserts or updates the given datasets. A (master_id, version) already stored under another
+catalog replaces the old row. Returns the number of (master_id, version) which weren't stored."""
+    new = 0
+    for batch in _chunks(p2p_results, 500):
+        datasets = []
+        for dataset in batch:
+            try:
+                ds = Dataset.instance(dataset)
+                if ds: datasets.append(ds)
+            except:
+                log.error('Skipping dataset: ' + ('id' in dataset and dataset['id'] or 'dataset'))
+        if not datasets: continue
+
+        stored = {}
+        for row in session.query(Dataset.catalog, Dataset.id, Dataset.version)\
+                .filter(Dataset.data_node==data_node)\
+                .filter(Dataset.id.in_(set([ds.id for ds in datasets]))):
+            stored[(row.id, row.version)] = row.catalog
+        for ds in datasets:
+            catalog = stored.get((ds.id, ds.version))
+            if catalog is None:
+                new += 1
+            elif catalog != ds.catalog:
+                session.query(Dataset).filter_by(catalog=catalog).delete(synchronize_session=False)
+            session.merge(ds)
+        session.flush()
+    return new
+
+def _harvestDelta(p, session, data_node, count, total, last_entry, batch_size, constraints):
+    """Harvest only what changed in the given data node since last_entry. Returns the number of
+upserted datasets."""
+    #the index returns all records modified since the given time stamp (inclusive)
+    since = dict(constraints)
+    since['from'] = last_entry.strftime('%Y-%m-%dT%H:%M:%SZ')
+    changed = [d for d in p.datasets(batch_size=batch_size, fields=Dataset.FIELDS_STR,
+                                     data_node=data_node, distrib=False, **since)]
+    new = _upsert(session, changed, data_node)
+    log.debug("%s: %s records since %s, %s new", data_node, len(changed), since['from'], new)
+
+    if total + new != count:
+        #something was removed (or there's something older we don't have). Compare only the
+        #ids, which is much cheaper than retrieving all records.
+        remote = p.get_datasets_names(batch_size=batch_size, data_node=data_node, distrib=False,
+                                      **constraints)
+        local = {}
+        for row in session.query(Dataset.catalog, Dataset.id, Dataset.version).filter_by(data_node=data_node):
+            local[(row.id, row.version)] = row.catalog
+
+        removed = [local[key] for key in set(local) - remote]
+        for catalogs in _chunks(removed, 500):
+            session.query(Dataset).filter(Dataset.catalog.in_(catalogs)).delete(synchronize_session=False)
+
+        missing = remote - set(local)
+        for keys in _chunks(missing, 100):
+            keys = set(keys)
+            docs = p.get_datasets(fields=Dataset.FIELDS_STR, data_node=data_node, distrib=False,
+                                  master_id=list(set([id for id, _ in keys])), **constraints)
+            docs = [d for d in docs if (d['master_id'], int(d['version'])) in keys]
+            _upsert(session, docs, data_node)
+            changed.extend(docs)
+        log.debug("%s: %s removed, %s older records missing", data_node, len(removed), len(missing))
+    return len(changed)
+
+def _harvestDataNode(p, node, data_node, count, db_row, batch_size, incremental, constraints):
+    """Brings the given data node up to date. Runs in its own thread, so it uses its own
+session and P2P connection. Returns True if successful."""
+    index_node = None
+    log.info("Checking %s", data_node)
+    if db_row:
+        #check if it has been changed
+        _ , index_node, total, last_entry = db_row
+        if incremental and last_entry:
+            #even with the same count some might have changed, so always ask for the delta
+            log.debug("Harvesting changes since %s", last_entry)
+        elif count != total:
+            log.info("Different number of datasets detected. Remote: %s, local: %s", count, total)
+            if total > count:
+                log.debug("We have more. Some dataset where removed")
+        else:
+            log.debug("No changes detected.")
+            return True
+    else:
+        #this is a new data_node we didn't know about (we need to find the index_node!
+        log.info("Unknown data node.")
+        
+        result = p.get_datasets(fields='index_node', data_node=data_node, limit=1, **constraints)
+        if result:
+            index_node = result[0]['index_node']
+        else:
+            log.error("Skipping. Cannot find the index node holding %s data.", data_node)
+            return False
+    
+    #if here, then we need to process data from this node.
+    session = newSession()
+    try:
+        #let's try first the index holding the data and then a distributed search...
+        #index node might be behind a firewall
+        for index in [index_node, node]:
+            if not index: continue
+            p.node = index
+            try:
+                if db_row and incremental and db_row[3]:
+                    log.debug("Ingesting changes")
+                    changes = _harvestDelta(p, session, data_node, count, total, last_entry,
+                                            batch_size, constraints)
+                    log.debug("%s changes", changes)
+                else:
+                    log.debug("Ingesting new data")
+                    if db_row:
+                        session.query(Dataset).filter_by(data_node=data_node).delete()
+                    Dataset.insert(p.datasets(batch_size=batch_size, fields=Dataset.FIELDS_STR, data_node=data_node, distrib=False, **constraints), session=session)
+                    log.debug("%s changes, %s new entries", len(session.dirty), len(session.new))
+                session.commit()
+                log.info("All datasets from %s are up to date", data_node)
+                return True
+            except:
+                session.rollback()
+                log.warn("Can't access index %s", p.node, exc_info=True)
+        return False
+    finally:
+        session.close()
+
 #jfp was node='esgf-data.dkrz.de'
-def processP2P(node='pcmdi9.llnl.gov', batch_size=3000, **constraints):
-    """Harvest the new P2P nodes"""
+def processP2P(node='pcmdi9.llnl.gov', batch_size=3000, incremental=True, threads=4, page_threads=None,
+               **constraints):
+    """Harvest the new P2P nodes
+incremental := harvest only what changed since the last harvest instead of re-ingesting
+               every data node that changed.
+threads := number of data nodes harvested concurrently
+page_threads := number of threads retrieving the batches of each listing (default: P2P's)"""
     
     print "jfp in processP2P, node=",node
-    p = p2p.P2P(node=node, defaults={'distrib':True, 'project':'CMIP5'})
+    p = p2p.P2P(node=node, defaults={'distrib':True, 'project':'CMIP5'}, threads=page_threads)
     nodes = p.get_facets('data_node', **constraints)['data_node']
     #we don't need a data_node constraint anymore as we keep on working from these results
     #also trim other constraints that we use and make no sense here (limit makes little sence since
@@ -170,57 +313,29 @@ def processP2P(node='pcmdi9.llnl.gov', batch_size=3000, **constraints):
     db_info = {}
     #for data_node, index_node, total, last_entry in getSession().connection().execute(sql_str):
     for row in getSession().connection().execute(sql_str):
-        db_info[row['data_node']] = row
+        db_info[row['data_node']] = tuple(row)
+    getSession().commit()
     
-    #now check the remote info and see what needs/can be updated
-    for data_node, count in nodes.items():
-        index_node = None
-        log.info("Checking %s", data_node)
-        if data_node in db_info:
-            #check if it has been changed
-            _ , index_node, total, last_entry = db_info[data_node]
-            if count != total:
-                log.info("Different number of datasets detected. Remote: %s, local: %s", count, total)
-                if total > count:
-                    log.debug("We have more. Some dataset where removed")
-            else:
-                log.debug("No changes detected.")
-                continue
-        else:
-            #this is a new data_node we didn't know about (we need to find the index_node!
-            log.info("Unknown data node.")
-            
-            result = p.get_datasets(fields='index_node', data_node=data_node, limit=1, **constraints)
-            if result:
-                index_node = result[0]['index_node']
-            else:
-                log.error("Skipping. Cannot find the index node holding %s data.", data_node)
-                continue
-        
-        #if here, then we need to process data from this node.
-        log.debug("Ingesting new data")
-        p.node = index_node
-        try:
-            if data_node in db_info:
-                getSession().query(Dataset).filter_by(data_node=data_node).delete()
-            Dataset.insert(p.datasets(batch_size=batch_size, fields=Dataset.FIELDS_STR, data_node=data_node, distrib=False, **constraints))
-            log.debug("%s changes, %s new entries", len(getSession().dirty), len(getSession().new))
-            getSession().commit()
-            getSession().expunge_all()  #we don't ned them anymore
-            log.info("All datasets from %s are up to date", data_node)
-        except:
+    #now check the remote info and see what needs/can be updated. Each data node is handled
+    #independently, so we do it concurrently.
+    from multiprocessing.pool import ThreadPool
+    pool = ThreadPool(max(1, threads))
+    try:
+        jobs = [(data_node, pool.apply_async(_harvestDataNode, (p.duplicate(), node, data_node, count,
+                    db_info.get(data_node), batch_size, incremental, constraints)))
+                for data_node, count in nodes.items()]
+        failed = []
+        for data_node, job in jobs:
             try:
-                #let's try at least a distributed search... index node might be behind a firewall
-                p.node = node
-                Dataset.insert(p.datasets(batch_size=batch_size, fields=Dataset.FIELDS_STR, data_node=data_node, distrib=False, **constraints))
-                log.debug("%s changes, %s new entries", len(getSession().dirty), len(getSession().new))
-                getSession().commit()
-                getSession().expunge_all()  #we don't ned them anymore
-                log.info("All datasets from %s are up to date", data_node)
+                if not job.get(): failed.append(data_node)
             except:
-                pass
-            getSession().rollback()
-            log.warn("Can't access index %s", index_node,exc_info=True)
+                log.error("Error while harvesting %s", data_node, exc_info=True)
+                failed.append(data_node)
+    finally:
+        pool.close()
+        pool.join()
+    if failed:
+        log.warn("Could not harvest (%s): %s", len(failed), ', '.join(failed))
     
     #report data nodes we knew about but are not there anymore.
     missing = set(db_info) - set(nodes)
@@ -534,18 +649,25 @@ def main(argv=None):
 
     if argv is None: argv = sys.argv[1:]
     try:
-        args, lastargs = getopt.getopt(argv, "ndh", ['help','debug','dry-run','harvest','update-wiki'])
+        args, lastargs = getopt.getopt(argv, "ndh", ['help','debug','dry-run','harvest','update-wiki',
+                                                        'full','threads=','page-threads='])
     except getopt.error:
         print sys.exc_info()[:3]
         return 1
 
     debug = dry_run =  False
+    incremental = True
+    threads = 4
+    page_threads = None
     harvest = wiki = False
 
     #parse arguments *!!!*
     for flag, arg in args:
         if flag=='--harvest': harvest = True    #updates the DB backend
         elif flag=='--update-wiki': wiki = True   #updates the setup wiki page
+        elif flag=='--full': incremental = False    #re-ingest changed data nodes completely instead of harvesting changes
+        elif flag=='--threads': threads = int(arg)  #number of data nodes harvested concurrently (default 4)
+        elif flag=='--page-threads': page_threads = int(arg)  #threads retrieving batches of each listing (default 4)
         elif flag=='-n' or flag=='--dry-run': dry_run = True  #Don't update the wiki, just show the wiki text
         elif flag=='-d' or flag=='--debug': debug = True  #extra debug output (breaks on any exception)
         elif flag=='-h' or flag=='--help':        #This help
@@ -565,7 +687,7 @@ def main(argv=None):
         # nodes = ['esgf-data.dkrz.de','pcmdi9.llnl.gov','esgf.nccs.nasa.gov']
         nodes = ['pcmdi9.llnl.gov']
         for node in nodes:
-            processP2P(node=node)
+            processP2P(node=node, incremental=incremental, threads=threads, page_threads=page_threads)
     if wiki: 
         if dry_run: updateWiki(verbose=True, dry_run=True)
         else:       updateWiki()
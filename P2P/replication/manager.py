@@ -549,7 +549,7 @@ We expect the dataset to be the latest version (i.e., latest=True)"""
                 # better url...
                 if abs_path==None or len(abs_path)<1:
                     continue
-                apexp = replica_db.ReplicaFile.abs_path.like( abs_path )
+                apexp = replica_db.ReplicaFile.abs_path==abs_path
                 fq = self.replicas.query(replica_db.ReplicaFile).filter( apexp )
                 oldfiles = fq.all()
                 if len(oldfiles)>0:
@@ -1,7 +1,11 @@
 #!/usr/local/cdat/bin/python
-import urllib2
+import urllib2, httplib
 import xml.dom.minidom
 import re
+import logging
+from lxml import etree
+
+log = logging.getLogger(__name__)
 
 dataset_pat = re.compile('^(.*)\.v([0-9]*)$')
 def parseNode(node, services=[]):
@@ -76,41 +80,97 @@ def findRootCatalog(catalog):
         return '/'.join(parts[:5] + ["catalog.xml"])
     raise Exception("Can't infer root catalog. Unknown format.")
 
-def getDatasetMetadata(catalog_url):    
-    """Harvest a main catalog and returs a dictionary with information about the datasets catalogs
-        returns:= dictionary[drs id string][version number] = absolute url"""
-    try:
-        xml_str = urllib2.urlopen(catalog_url).read()
-    except:
-        # TODO: use exception, write log
-        #print 'error', catalog_url
-        return None
-    dom = xml.dom.minidom.parseString(xml_str)
-    catalog = dom.firstChild
+def _localName(elem):
+    """Tag name without namespace"""
+    return elem.tag.rsplit('}', 1)[-1]
+
+def iterDatasetMetadata(catalog_url):
+    """Parse a dataset catalog incrementally and yield (kind, dictionary) for each dataset node
+    as soon as it's complete. kind is 'dataset' for the main node, 'file' or 'aggregation'; the
+    dictionaries are the same parseNode() returns (including resolved 'access' urls).
+    Processed elements are dropped, so memory doesn't grow with the size of the catalog.
+    catalog_url might also be a file object, in which case urls are resolved against nothing."""
+    if isinstance(catalog_url, basestring):
+        server_root = catalog_url[:catalog_url.index('/',10)]
+        source = urllib2.urlopen(catalog_url)
+    else:
+        server_root = ''
+        source = catalog_url
 
-    #parse services and resolve to absolute url
-    server_root = catalog_url[:catalog_url.index('/',10)]
     services = {}
-    for service in catalog.getElementsByTagName('service'):
-        type = service.getAttribute('serviceType')
+    depth = 0
+    stack = []  #[depth, properties, urlPath, default service name, access list] per open dataset
+    for event, elem in etree.iterparse(source, events=('start', 'end')):
+        if not isinstance(elem.tag, basestring): continue  #comments, etc
+        name = _localName(elem)
+        if event == 'start':
+            depth += 1
+            if name == 'dataset': stack.append([depth, {}, elem.get('urlPath'), None, []])
+            elif name == 'service':
+                #parse services and resolve to absolute url
+                type = elem.get('serviceType', '')
 
-        #don't consider compound services
-        if type.lower() == 'compound': continue
+                #don't consider compound services
+                if type.lower() != 'compound':
+                    url_base = elem.get('base', '')
+                    if url_base[:1] == '/': url_base = server_root + url_base
+                    services[elem.get('name', '')] = {'type': type, 'url_base': url_base}
+            continue
 
-        url_base = service.getAttribute('base')
-        if url_base[0] == '/': url_base = server_root + url_base  
-        services[service.getAttribute('name')] = {'type': type, 'url_base': url_base}
+        if name == 'property' and stack and stack[-1][0] == depth - 1:
+            stack[-1][1][elem.get('name', '')] = elem.get('value', '')
+        elif name == 'access' and stack and stack[-1][0] == depth - 1:
+            service_name = elem.get('serviceName', '')
+            if service_name in services:
+                #resolve properly
+                service = services[service_name]
+            else:
+                #if we can't resolve then do the best we can... (I don't think this is a valid TDS)
+                service = {'url_base' : '', 'type': service_name}
+            stack[-1][4].append({'url': service['url_base'] + elem.get('urlPath', ''),
+                                 'type': service['type'],
+                                 'format': elem.get('dataFormat', '')})
+        elif name == 'serviceName':
+            #the first one found within a dataset defines its default access
+            for entry in stack:
+                if entry[3] is None: entry[3] = (elem.text or '').strip()
+        elif name == 'dataset':
+            ds_depth, ds, url_path, service_name, access = stack.pop()
+            if url_path is not None:
+                #there's a default access... who designed this schema?!...
+                if service_name in services: service = services[service_name]
+                else: service = {'url_base' : '', 'type': service_name}
+                access.insert(0, {'url': service['url_base'] + url_path,
+                                  'type': service['type'],
+                                  'format': ''}) #<-- Unknown for default service (?!!)
+            if access: ds['access'] = access
+
+            if ds_depth == 2:
+                #this is the main node
+                yield ('dataset', ds)
+            elif 'file_id' in ds: yield ('file', ds)
+            elif 'aggregation_id' in ds: yield ('aggregation', ds)
+            #we are done with it and everything before it
+            elem.clear()
+            while elem.getprevious() is not None: del elem.getparent()[0]
+        depth -= 1
+
+def getDatasetMetadata(catalog_url):    
+    """Harvest a main catalog and returs a dictionary with information about the datasets catalogs
+        returns:= dictionary[drs id string][version number] = absolute url"""
     dataset = None
     
     files = []
     aggregations = []
-    for node in catalog.getElementsByTagName('dataset'):
-        ds = parseNode(node, services)
-        if node.parentNode == catalog:
-            #this is the main node
-            dataset = ds
-        elif 'file_id' in ds: files.append(ds)
-        elif 'aggregation_id' in ds: aggregations.append(ds)
+    try:
+        for kind, ds in iterDatasetMetadata(catalog_url):
+            if kind == 'dataset': dataset = ds
+            elif kind == 'file': files.append(ds)
+            elif kind == 'aggregation': aggregations.append(ds)
+    except (IOError, httplib.HTTPException, ValueError, etree.XMLSyntaxError) as e:
+        #a flaky data node or a bad catalog shouldn't stop the caller, it just skips this one
+        log.error('Could not read catalog %s: %s', catalog_url, e)
+        return None
         
     return {'dataset' : dataset, 'files' : files, 'aggregations' : aggregations}
 
@@ -68,15 +68,20 @@ class P2P(object):
     _time_out = 120
     """Specifies the time out (seconds) when trying to reach an index node"""
 
+    _threads = 4
+    """Default number of threads retrieving the batches of a search concurrently (see datasets)"""
+
 
     #jfp was node='esgf-data.dkrz.de'
-    def __init__(self, node='pcmdi9.llnl.gov', api='esg-search/search', defaults=None):
+    def __init__(self, node='pcmdi9.llnl.gov', api='esg-search/search', defaults=None, threads=None):
         """Generates a p2p connection.
 node := the p2p search node to connect to.
 api := the url path of the service
-defaults := start the connection with the given defaults"""
+defaults := start the connection with the given defaults
+threads := number of threads retrieving batches of results (default: P2P._threads)"""
         self.node = node
         self.api = api
+        self.threads = threads or self._threads
 
         self.defaults = (defaults or {})
         
@@ -112,7 +117,7 @@ E.g. del_defaults('institute','model')"""
 
     def duplicate(self):
         """Create a duplicate of this p2p connection."""
-        return P2P(node=self.node, api=self.api, defaults=self.get_defaults())
+        return P2P(node=self.node, api=self.api, defaults=self.get_defaults(), threads=self.threads)
 
 
     def __get_url(self):
@@ -166,13 +171,13 @@ E.g. del_defaults('institute','model')"""
         query = self.__constraints_to_str(constraints, type=type) 
         return self.raw_search(query)['response']
 
-    def get_datasets_names(self, batch_size=__MAX_RESULTS, **constraints):
+    def get_datasets_names(self, batch_size=__MAX_RESULTS, threads=None, **constraints):
         """returns a list of (datasets, version) tuppels. You can't define "fields"
 while calling this method"""
         if 'fields' in constraints: 
             del constraints['fields']
         datasets = set([(d['master_id'], int(d['version'])) for d in self.datasets(
-                        fields='master_id,version',batch_size=batch_size,**constraints)])
+                        fields='master_id,version',batch_size=batch_size,threads=threads,**constraints)])
 # ...normal jfp testing...
 #        datasets = set([(d['instance_id'], int(d['version'])) for d in self.datasets(
 #                        fields='instance_id,version',batch_size=batch_size,**constraints)])
@@ -186,12 +191,16 @@ just the first "N" records."""
         dsets = [d for d in self.datasets(**constraints)]
         return dsets
 
-    def datasets(self, batch_size=__MAX_RESULTS, **constraints):
+    def datasets(self, batch_size=__MAX_RESULTS, threads=None, **constraints):
         """returns a generator iterating thorugh the complete resulting docs.
            batch_size := defines the size of the retrieved batch
            limit := limits the total number of returned docs
+           threads := if > 1, after the first batch (which tells us how many docs there are)
+                      the remaining batches are retrieved concurrently by this many threads.
+                      Docs are still returned in the same order. Default: the connection's.
 
            all other solar constraints apply"""
+        if threads is None: threads = self.threads
         #if we have a limit use it also here.
         max_items = sys.maxint
         if 'limit' in constraints:
@@ -220,6 +229,12 @@ just the first "N" records."""
         datasets = {}
         for d in result['docs']:
             yield d
+
+        if threads > 1 and retrieved > 0:
+            for docs in self.__fetch_batches(range(sofar+retrieved, total, retrieved), threads, constraints):
+                for d in docs:
+                    yield d
+            return
         
         while sofar + retrieved < total:
             result = self.search(offset=sofar+retrieved,**constraints)
@@ -229,6 +244,24 @@ just the first "N" records."""
             sofar += retrieved
             retrieved = len(result['docs'])
 
+    def __fetch_batches(self, offsets, threads, constraints):
+        """Retrieve the batches starting at the given offsets with a pool of threads and return
+        their docs in order. At most 2*threads batches are requested ahead of the consumer, so
+        memory stays bounded however big the result is."""
+        from multiprocessing.pool import ThreadPool
+        from collections import deque
+        pool = ThreadPool(threads)
+        pending = deque()
+        try:
+            for offset in offsets:
+                pending.append(pool.apply_async(self.search, (), dict(constraints, offset=offset)))
+                if len(pending) >= 2*threads:
+                    yield pending.popleft().get(self._time_out*2)['docs']
+            while pending:
+                yield pending.popleft().get(self._time_out*2)['docs']
+        finally:
+            pool.terminate()
+
     def files(self, type=TYPE.FILE, **constraints):
         """the same as datasets, but sets the type to 'File'. It's just a commodity function to
 improve readability"""
@@ -311,7 +344,8 @@ def main(argv=None):
 
     if argv is None: argv = sys.argv[1:]
     try:
-        args, lastargs = getopt.getopt(argv, "f:h", ['help','facet=','query=', 'list-datasets'])
+        args, lastargs = getopt.getopt(argv, "f:h", ['help','facet=','query=', 'list-datasets', 'node=',
+                                                    'threads='])
     except getopt.error:
         print sys.exc_info()[:3]
         return 1
@@ -319,6 +353,8 @@ def main(argv=None):
     datasets = False
     facets = {}
     query=None
+    node = None
+    threads = None
 
     #parse arguments *!!!*
     for flag, arg in args:
@@ -334,6 +370,10 @@ def main(argv=None):
             datasets = True
         elif flag=='--query':               #<list> :Display results from <list> queried fields
             query=arg
+        elif flag=='--node':                #<host[:port]> :Index node to search (default pcmdi9.llnl.gov)
+            node=arg
+        elif flag=='--threads':             #<nr> :Threads retrieving batches of results (default 4)
+            threads=int(arg)
         elif flag=='-h' or flag=='--help':        #This help
             usage('Interact with p2p index nodes via the search API\n')
             return 0
@@ -342,7 +382,8 @@ def main(argv=None):
     #if empty leave it alone    
 #    if not facets: facets = None
 
-    p2p = P2P()
+    if node: p2p = P2P(node=node, threads=threads)
+    else: p2p = P2P(threads=threads)
 
     if datasets: print '\n'.join(['%s#%s' % d for d in sorted(p2p.get_datasets_names(**facets))])
     if query: 
@@ -116,10 +116,20 @@ class ReplicaAccess(Base, DAO):
     abs_path = Column(String, ForeignKey('replica.files.abs_path'))
     type = Column(String, nullable=False)
 
+def strip_version(abs_path):
+    """Returns abs_path without its version directory (the 10th DRS component), so all versions
+    of a file map to the same value. Paths too short to hold a version are returned unchanged."""
+    parts = abs_path.split('/')
+    if len(parts) <= 9: return abs_path
+    return '/'.join(parts[:9] + parts[10:])
+
 class ReplicaFile(Base, DAO):
     __tablename__ = 'files'
     __table_args__ = {'schema':'replica'}
     abs_path = Column(String, primary_key=True)
+    #derived from abs_path for indexed lookups (rows predating them: replica_manager.py --index-files)
+    basename = Column(String, index=True)
+    nv_path = Column(String, index=True)    #abs_path without version (see strip_version)
     dataset_name = Column(String,  ForeignKey('replica.datasets.name'))
     checksum = Column(String, nullable=False)       #nullable:=avoid replicating things we can't be sure of
     checksum_type =  Column(String, default='md5')
@@ -127,6 +137,14 @@ class ReplicaFile(Base, DAO):
     mtime = Column(Float)
     status = Column(Integer, default=STATUS.UNINIT)
     access = orm.relation(ReplicaAccess, backref=orm.backref('file'), order_by = ReplicaAccess.url, cascade='all, delete')
+
+    @orm.validates('abs_path')
+    def _set_derived_paths(self, key, abs_path):
+        if abs_path:
+            self.basename = os.path.basename(abs_path)
+            self.nv_path = strip_version(abs_path)
+        return abs_path
+
     def getFinalLocations(self):
         return [ os.path.join(archive_root0, self.abs_path),
                  os.path.join(archive_root1, self.abs_path),
@@ -304,6 +322,25 @@ Ex: cmip5.output1.BCC.bcc-csm1-1.1pctCO2.day.atmos.day.r1i1p1.v20110101"""
         #if not is larger (meaning lower priority)
         return 999
 
+def add_file_path_columns(engine):
+    """Adds the columns basename and nv_path of replica.files, and their indices, if the table
+    predates them (as replica_manager.add_file_path_columns does).  Their values for existing
+    rows come from replica_manager.py --index-files."""
+    files = ReplicaFile.__table__
+    try:
+        engine.execute(sql.select([files.c.basename, files.c.nv_path]).limit(1))
+        return
+    except sqlalchemy.exc.DBAPIError:
+        pass
+    log.info("adding columns basename, nv_path to %s", files.fullname)
+    for column in ('basename', 'nv_path'):
+        engine.execute("ALTER TABLE %s ADD COLUMN %s VARCHAR"%(files.fullname, column))
+    for index in files.indexes:
+        try:
+            index.create(engine)
+        except sqlalchemy.exc.DBAPIError:
+            pass    # it's already there
+
 __rep_s=None
 def getSession(shared=True):
     """Get a shared/new session"""
@@ -318,6 +355,7 @@ def getSession(shared=True):
         db_string = _database + ':' + ':'.join(tmp[1:])
     e = sqlalchemy.create_engine(db_string)
     Base.metadata.create_all(e)
+    add_file_path_columns(e)
     session = orm.sessionmaker(bind=e, autoflush=False, autocommit=False,expire_on_commit=False)()
 
     #if here, set the local session if it is shared
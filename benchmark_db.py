@@ -5,7 +5,7 @@ from datetime import datetime
 from sqlalchemy.ext.declarative import declarative_base
 from sqlalchemy.exc import IntegrityError
 from sqlalchemy.sql import func
-from sqlalchemy import Column, Integer, String, create_engine, orm, ForeignKey, DateTime, Numeric
+from sqlalchemy import Column, Integer, String, Float, create_engine, orm, ForeignKey, DateTime, Numeric
 import hashlib
 import utils
 Base =  declarative_base()
@@ -46,6 +46,20 @@ class BenchmarkDAO(Base, DAO):
         self.inbound = bench.inbound
         self.outbound = bench.outbound
 
+class BenchmarkResultDAO(Base, DAO):
+    """Result of one benchmark of the suite (see benchmark_suite.py). Values are throughputs,
+    so higher is better."""
+    __tablename__ = 'benchmark_result'
+    id = Column(Integer, primary_key=True)
+    run = Column(String, nullable=False, index=True)
+    timestamp = Column(DateTime, default=datetime.now)
+    machine = Column(String, default=gethostname())
+    commit = Column(String)
+    name = Column(String, nullable=False)
+    value = Column(Float, nullable=False)
+    unit = Column(String)
+    elapsed = Column(Float)
+
 class BenchmarkDB(object):
 
     def __init__(self, db_url):
@@ -70,9 +84,44 @@ class BenchmarkDB(object):
 
     def get(self, **filter):
         self.open()
-        return self._session.query(ReplicaFileDAO).filter_by(**filter)
-         
+        return self._session.query(BenchmarkDAO).filter_by(**filter)
+
+    def addResult(self, run, name, value, unit=None, elapsed=None, commit=None, machine=None):
+        """Store the result of one benchmark. Not committed."""
+        self.open()
+        entry = BenchmarkResultDAO(run=run, name=name, value=value, unit=unit, elapsed=elapsed,
+                                   commit=commit, machine=machine or gethostname())
+        self._session.add(entry)
+        return entry
+
+    def getResults(self, **filter):
+        self.open()
+        return self._session.query(BenchmarkResultDAO).filter_by(**filter)
+
+    def getRuns(self, machine=None):
+        """Returns [(run, timestamp, machine, commit)] of all runs (on this machine), oldest first."""
+        self.open()
+        query = self._session.query(BenchmarkResultDAO.run, func.min(BenchmarkResultDAO.timestamp),
+                        BenchmarkResultDAO.machine, BenchmarkResultDAO.commit)\
+                .group_by(BenchmarkResultDAO.run, BenchmarkResultDAO.machine, BenchmarkResultDAO.commit)
+        if machine: query = query.filter(BenchmarkResultDAO.machine==machine)
+        return sorted(query.all(), key=lambda r: r[1])
+
+    def compare(self, run, base_run, threshold=0.1):
+        """Compares the results of run against those of base_run.
+        Returns [(name, base value, value, relative change, is regression)] for all benchmarks
+        in run. A regression is a throughput drop bigger than threshold (0.1 = 10%)."""
+        base = dict([(r.name, r.value) for r in self.getResults(run=base_run)])
+        result = []
+        for r in self.getResults(run=run).order_by(BenchmarkResultDAO.name):
+            if r.name in base and base[r.name]:
+                change = (r.value - base[r.name]) / base[r.name]
+                result.append((r.name, base[r.name], r.value, change, change < -threshold))
+            else:
+                result.append((r.name, None, r.value, None, False))
+        return result
         
+
     def commit(self):
         self.open()
         self._session.commit()
@@ -0,0 +1,364 @@
+#!/usr/local/cdat/bin/python
+"""Benchmarks of the hot paths of the replication tools.
+Every benchmark runs on data generated from a fixed seed, so runs are comparable. Results
+(throughputs, higher is better) are stored in the benchmark DB per run, machine and commit,
+and a run can be compared against a previous one to spot regressions."""
+
+import os, sys, time, random, shutil, tempfile, subprocess
+from socket import gethostname
+import logging
+log = logging.getLogger('benchmark')
+
+#name -> (function, unit, description)
+BENCHMARKS = {}
+ORDER = []
+
+def benchmark(name, unit, description=''):
+    """Registers the decorated function as a benchmark. It gets the fixtures (see Fixtures) and
+    returns the amount of work done (in units, e.g. files or bytes). Raise SkipBenchmark (or let
+    an ImportError through) if it can't run here."""
+    def register(function):
+        BENCHMARKS[name] = (function, unit, description)
+        ORDER.append(name)
+        return function
+    return register
+
+class SkipBenchmark(Exception):
+    pass
+
+#### FIXTURES ####
+
+INSTITUTES = [('MPI-M', 'MPI-ESM-LR'), ('MOHC', 'HadGEM2-ES'), ('IPSL', 'IPSL-CM5A-LR'),
+              ('NCAR', 'CCSM4'), ('CNRM-CERFACS', 'CNRM-CM5'), ('MIROC', 'MIROC5')]
+EXPERIMENTS = ['historical', 'rcp45', 'rcp85', 'piControl', 'amip']
+VARIABLES = ['tas', 'pr', 'psl', 'uas', 'vas', 'huss', 'clt', 'rlut']
+
+class Fixtures(object):
+    """Test data shared by all benchmarks, generated in a temporary directory."""
+
+    def __init__(self, workdir, seed=0, files=5000, data_files=32, data_size=4*1024*1024):
+        self.workdir = workdir
+        self.root = os.path.join(workdir, 'data')
+        rand = random.Random(seed)
+
+        #DRS paths (relative) of many files
+        self.paths = []
+        for n in range(files):
+            institute, model = rand.choice(INSTITUTES)
+            experiment = rand.choice(EXPERIMENTS)
+            variable = rand.choice(VARIABLES)
+            ensemble = 'r%si1p1' % rand.randint(1, 5)
+            year = 1850 + 10 * (n % 25)
+            name = '%s_Amon_%s_%s_%s_%s01-%s12.nc' % (variable, model, experiment, ensemble,
+                                                        year, year + 9)
+            self.paths.append('/'.join(['cmip5', 'output1', institute, model, experiment, 'mon',
+                              'atmos', 'Amon', ensemble, 'v20110901', variable, name]))
+        #avoid duplicates but keep the order
+        seen = set()
+        self.paths = [p for p in self.paths if not (p in seen or seen.add(p))]
+        self.checksums = dict([(p, '%032x' % rand.getrandbits(128)) for p in self.paths])
+        self.sizes = dict([(p, rand.randint(1, 1<<31)) for p in self.paths])
+        self.mtimes = dict([(p, 1300000000.0 + rand.randint(0, 1<<24)) for p in self.paths])
+
+        #some real files for checksums and transfers
+        self.data_files = []
+        block = ''.join([chr(rand.randint(0, 255)) for i in range(1024*1024)])
+        for path in self.paths[:data_files]:
+            file = os.path.join(self.root, path)
+            if not os.path.isdir(os.path.dirname(file)): os.makedirs(os.path.dirname(file))
+            fp = open(file, 'wb')
+            for i in range(data_size / len(block)): fp.write(block)
+            fp.close()
+            self.data_files.append(file)
+        self.data_bytes = sum([os.path.getsize(f) for f in self.data_files])
+
+        self.catalog = os.path.join(workdir, 'catalog.xml')
+        self.__writeCatalog(self.catalog)
+
+    def __writeCatalog(self, file):
+        """THREDDS catalog of a dataset holding all files"""
+        id = 'cmip5.output1.MPI-M.MPI-ESM-LR.historical.mon.atmos.Amon.r1i1p1'
+        fp = open(file, 'w')
+        fp.write('<?xml version="1.0" encoding="UTF-8"?>\n'
+            '<catalog xmlns="http://www.unidata.ucar.edu/namespaces/thredds/InvCatalog/v1.0" '
+            'xmlns:xlink="http://www.w3.org/1999/xlink" name="TDS configuration file" version="1.0.1">\n'
+            '  <service name="HTTPServer" serviceType="HTTPServer" base="/thredds/fileServer/" />\n'
+            '  <dataset name="%s.v20110901" ID="%s.v20110901" restrictAccess="esg-user">\n'
+            '    <property name="dataset_id" value="%s" />\n'
+            '    <property name="dataset_version" value="20110901" />\n' % (id, id, id))
+        for path in self.paths:
+            name = os.path.basename(path)
+            fp.write('    <dataset name="%s" ID="%s.v20110901.%s" urlPath="esg_dataroot/%s">\n'
+                     '      <serviceName>HTTPServer</serviceName>\n'
+                     '      <property name="file_id" value="%s.%s" />\n'
+                     '      <property name="size" value="%s" />\n'
+                     '      <property name="checksum" value="%s" />\n'
+                     '      <property name="checksum_type" value="MD5" />\n'
+                     '      <property name="mod_time" value="2011-09-01 12:00:00" />\n'
+                     '    </dataset>\n' % (name, id, name, path, id, name, self.sizes[path],
+                                            self.checksums[path]))
+        fp.write('  </dataset>\n</catalog>\n')
+        fp.close()
+
+def _replicaDatasets(fixtures):
+    """Transient ReplicaDataset objects (grouped by DRS dataset) for all fixture paths.
+    They are created once, so their creation isn't part of what's measured."""
+    if getattr(fixtures, 'replica_datasets', None) is not None: return fixtures.replica_datasets
+    try:
+        import replica_manager
+    except Exception as e:
+        raise SkipBenchmark('replica_manager not available: %s' % e)
+    datasets = {}
+    for path in fixtures.paths:
+        parts = path.split('/')
+        name = '.'.join(parts[:9])
+        if name not in datasets:
+            datasets[name] = replica_manager.ReplicaDataset(name=name, version=20110901,
+                                status=replica_manager.STATUS.INIT, gateway='benchmark',
+                                parent='benchmark', catalog=fixtures.catalog, size=0, filecount=0)
+        f = replica_manager.ReplicaFile(abs_path=path, checksum=fixtures.checksums[path],
+                checksum_type='md5', size=fixtures.sizes[path], mtime=fixtures.mtimes[path],
+                status=replica_manager.STATUS.INIT)
+        f.access = [replica_manager.ReplicaAccess(url='http://example.org/thredds/fileServer/' + path,
+                                                  type='HTTPServer')]
+        datasets[name].files.append(f)
+    fixtures.replica_datasets = datasets.values()
+    return fixtures.replica_datasets
+
+#### BENCHMARKS ####
+
+@benchmark('drs.path', 'paths/s', 'drs.DRS from path and filename, and back to the id')
+def bench_drs(fixtures):
+    import drs
+    for path in fixtures.paths:
+        drs.DRS(path=os.path.dirname(path), filename=os.path.basename(path)).getId()
+    return len(fixtures.paths)
+
+@benchmark('drslib.filename_to_drs', 'files/s', 'drslib translation of file names')
+def bench_drslib(fixtures):
+    try:
+        from drslib import cmip5
+    except ImportError:
+        raise SkipBenchmark('drslib not available')
+    trans = cmip5.make_translator('cmip5')
+    for path in fixtures.paths:
+        trans.filename_to_drs(os.path.basename(path))
+    return len(fixtures.paths)
+
+@benchmark('mapfile.replica_dataset', 'files/s', 'ReplicaDataset.getMapfile')
+def bench_replica_mapfile(fixtures):
+    datasets = _replicaDatasets(fixtures)
+    files = 0
+    for dataset in datasets:
+        dataset.getMapfile(fixtures.root)
+        files += len(dataset.files)
+    return files
+
+@benchmark('mapfile.file_db', 'files/s', 'FileDB.exportCMIP5Mapfile to a single file')
+def bench_filedb_mapfile(fixtures):
+    from file_db import FileDB, FileDAO
+    db_file = os.path.join(fixtures.workdir, 'file_db.sqlite')
+    if os.path.exists(db_file): os.remove(db_file)
+    db = FileDB('sqlite:///' + db_file, fixtures.root)
+    db.addAll([FileDAO(path=os.path.dirname(p), name=os.path.basename(p), size=fixtures.sizes[p],
+                       mtime=fixtures.mtimes[p], checksum_value=fixtures.checksums[p])
+               for p in fixtures.paths])
+    db.exportCMIP5Mapfile(os.path.join(fixtures.workdir, 'file_db.map'))
+    db.close()
+    return len(fixtures.paths)
+
+@benchmark('checksum.serial', 'MB/s', 'md5 of the data files, one after the other')
+def bench_checksum(fixtures):
+    import checksum_pool
+    for file in fixtures.data_files: checksum_pool.checksum(file)
+    return float(fixtures.data_bytes)/1024/1024
+
+@benchmark('checksum.pool', 'MB/s', 'md5 of the data files with ChecksumPool')
+def bench_checksum_pool(fixtures):
+    import checksum_pool
+    pool = checksum_pool.ChecksumPool()
+    try:
+        for file in fixtures.data_files: pool.submit(file)
+        for tag, file, value, error in pool.results():
+            if error: raise Exception(error)
+    finally:
+        pool.close()
+    return float(fixtures.data_bytes)/1024/1024
+
+@benchmark('catalog.parse', 'files/s', 'catalog.getDatasetMetadata of a dataset catalog')
+def bench_catalog(fixtures):
+    import catalog
+    fp = open(fixtures.catalog, 'r')
+    try:
+        return len(catalog.getDatasetMetadata(fp)['files'])
+    finally:
+        fp.close()
+
+@benchmark('create_repo_list', 'files/s', 'replica_manager.create_repo_list download list')
+def bench_repo_list(fixtures):
+    datasets = _replicaDatasets(fixtures)
+    import replica_manager
+    replica_manager.create_repo_list(datasets, output=os.path.join(fixtures.workdir, 'download.list'))
+    return sum([len(d.files) for d in datasets])
+
+@benchmark('transfer.file', 'MB/s', 'file:// protocol handler copies')
+def bench_local_transfer(fixtures):
+    import protocol_handler
+    target_root = os.path.join(fixtures.workdir, 'transfer')
+    if os.path.isdir(target_root): shutil.rmtree(target_root)
+    for file in fixtures.data_files:
+        target = os.path.join(target_root, file[len(fixtures.root)+1:])
+        ret = protocol_handler.getHandler('file://' + file).getFile(target, block_check=False)
+        if ret != 0: raise Exception('transfer of %s failed (%s)' % (file, ret))
+    return float(fixtures.data_bytes)/1024/1024
+
+#### RUNNING ####
+
+def getCommit():
+    """Commit of the code being benchmarked, if it's a git checkout."""
+    try:
+        proc = subprocess.Popen(['git', 'rev-parse', '--short', 'HEAD'], stdout=subprocess.PIPE,
+                                stderr=subprocess.PIPE, cwd=os.path.dirname(os.path.abspath(__file__)))
+        out = proc.communicate()[0].strip()
+        if proc.returncode == 0: return out
+    except OSError:
+        pass
+    return None
+
+def run(names=None, repeat=3, db=None, commit=None, workdir=None):
+    """Runs the given benchmarks (all by default). Each one is repeated and the best time kept.
+    If db (a BenchmarkDB) is given, results are stored there.
+    Returns (run id, [(name, value, unit, best time)])"""
+    if not names: names = ORDER
+    if commit is None: commit = getCommit()
+    run_id = '%s-%s' % (time.strftime('%Y%m%d%H%M%S'), gethostname())
+
+    tmp_dir = None
+    if not workdir: workdir = tmp_dir = tempfile.mkdtemp(prefix='benchmark')
+    try:
+        log.info('Preparing fixtures in %s', workdir)
+        fixtures = Fixtures(workdir)
+
+        results = []
+        for name in names:
+            function, unit, description = BENCHMARKS[name]
+            best = None
+            try:
+                for i in range(repeat):
+                    start = time.time()
+                    amount = function(fixtures)
+                    elapsed = time.time() - start
+                    if best is None or elapsed < best: best = elapsed
+            except (SkipBenchmark, ImportError) as e:
+                log.warn('Skipping %s: %s', name, e)
+                continue
+            value = amount / max(best, 1e-6)
+            log.info('%-25s %12.2f %-8s (%.3fs)', name, value, unit, best)
+            results.append((name, value, unit, best))
+            if db: db.addResult(run_id, name, value, unit=unit, elapsed=best, commit=commit)
+        if db: db.commit()
+    finally:
+        if tmp_dir: shutil.rmtree(tmp_dir, ignore_errors=True)
+
+    return (run_id, results)
+
+def report(db, run=None, base_run=None, threshold=0.1, out=sys.stdout):
+    """Compares run (the latest one) against base_run (the one before it, on the same machine)
+    and prints a report. Returns the number of regressions found."""
+    if not run or not base_run:
+        runs = [r[0] for r in db.getRuns(machine=gethostname())]
+        if run in runs: runs = runs[:runs.index(run)+1]
+        if not run and runs: run = runs[-1]
+        if not base_run and len(runs) > 1: base_run = runs[-2]
+    if not run or not base_run:
+        out.write('Need two runs to compare.\n')
+        return 0
+
+    regressions = 0
+    out.write('%s vs. %s (regression: more than %d%% slower)\n' % (run, base_run, threshold*100))
+    for name, base, value, change, regression in db.compare(run, base_run, threshold):
+        if change is None:
+            out.write('  %-25s %12s -> %12.2f\n' % (name, '-', value))
+            continue
+        flag = ''
+        if regression:
+            regressions += 1
+            flag = ' <<< REGRESSION'
+        out.write('  %-25s %12.2f -> %12.2f %+6.1f%%%s\n' % (name, base, value, change*100, flag))
+    return regressions
+
+def main(argv=None):
+    from benchmark_db import BenchmarkDB
+
+    if argv is None: argv = sys.argv[1:]
+
+    import getopt
+    try:
+        args, lastargs = getopt.getopt(argv, "hD:b:r:l", ['help', 'db-name=', 'benchmarks=', 'repeat=',
+                            'commit=', 'compare', 'threshold=', 'list'])
+    except getopt.error:
+        print sys.exc_info()[:3]
+        return 1
+
+    #init values
+    db_name = 'benchmark.db'
+    names = None
+    repeat = 3
+    commit = None
+    compare = False
+    threshold = 0.1
+
+    #parse arguments
+    for flag, arg in args:
+        if flag=='-h' or flag=='--help': return 1
+        elif flag=='-D' or flag=='--db-name':       db_name = arg
+        elif flag=='-b' or flag=='--benchmarks':    names = arg.split(',')
+        elif flag=='-r' or flag=='--repeat':        repeat = int(arg)
+        elif flag=='--commit':                      commit = arg
+        elif flag=='--compare':                     compare = True
+        elif flag=='--threshold':                   threshold = float(arg)
+        elif flag=='-l' or flag=='--list':
+            for name in ORDER: print '%-25s %-8s %s' % (name, BENCHMARKS[name][1], BENCHMARKS[name][2])
+            return 0
+
+    if names:
+        unknown = [n for n in names if n not in BENCHMARKS]
+        if unknown:
+            log.error('Unknown benchmarks: %s', ', '.join(unknown))
+            return 1
+
+    db = BenchmarkDB('sqlite:///' + db_name)
+    try:
+        if compare:
+            #compare the given runs (or the last two)
+            run_id = len(lastargs) > 0 and lastargs[0] or None
+            base_run = len(lastargs) > 1 and lastargs[1] or None
+        else:
+            run_id, results = run(names, repeat=repeat, db=db, commit=commit)
+            base_run = None
+        if report(db, run_id, base_run, threshold) > 0: return 2
+    finally:
+        db.close()
+    return 0
+
+if __name__=='__main__':
+    #configure logging
+    logging.basicConfig(level=logging.INFO)
+
+    error_code = main()
+    if error_code == 1:
+        print """benchmark_suite.py [opt] [<run> [<base run>]]
+Runs the benchmarks and compares them against the previous run on this machine.
+Exits with 2 if a regression was found.
+Opt:
+    -h, --help              : show this help
+    -D, --db-name <file>    : benchmark DB to use (default: ./benchmark.db)
+    -b, --benchmarks <list> : comma separated benchmarks to run (default: all)
+    -r, --repeat <#>        : repetitions per benchmark, the best one counts (default: 3)
+    -l, --list              : list all benchmarks
+    --commit <id>           : commit to record (default: current git HEAD)
+    --compare               : don't run, just compare <run> against <base run>
+                              (default: the last two runs on this machine)
+    --threshold <x>         : slow down considered a regression (default: 0.1 = 10%)
+"""
+    sys.exit(error_code)
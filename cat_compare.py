@@ -1,7 +1,9 @@
 import catalog,re
 import sys
+from multiprocessing.pool import ThreadPool
 
 tds_fix_re = re.compile('(.*\.nc)_[0-9]*$')
+comp_att = ['size', 'checksum']
 
 def compare_keys(first, second):
     keys_1 = set(first.keys())
@@ -9,106 +11,129 @@ def compare_keys(first, second):
     
     return (keys_1 & keys_2, keys_1 - keys_2, keys_2 - keys_1)
 
+def file_key(file):
+    """The name a file entry is compared by: its file_id, but for the TDS uniqueness suffix."""
+    #workaround for file_id uniquenes...
+    f_id = tds_fix_re.match(file['file_id'])
+    if f_id: return f_id.group(1)
+    return file['file_id']
 
 def compare_files(master_list, replica_list):
-    comp_att = ['size', 'checksum']
+    """Compares file entries by name.  master_list and replica_list may be any iterables: only the
+    compared attributes of the master entries are kept, the replica ones are compared as they come,
+    so the replica side may be streamed straight from its catalog.
+        returns: = (both, m_only, r_only, difference) with the names in both, sorted lists of the
+        names only in master / only in replica, and difference[name][att] = {'master':.., 'replica':..}"""
     m_att = {}
     for m in master_list:
-        #workaround for file_id uniquenes...
-        f_id = tds_fix_re.match(m['file_id'])
-        if f_id: f_id = f_id.group(1)
-        else: f_id = m['file_id']
-        m_att[f_id] = m
+        m_att[file_key(m)] = dict([(att, m[att]) for att in comp_att])
     
-    r_att = {}
-    for r in replica_list:
-        #workaround for file_id uniquenes...
-        f_id = tds_fix_re.match(r['file_id'])
-        if f_id: f_id = f_id.group(1)
-        else: f_id = r['file_id']
-        r_att[f_id] = r
-    
-    both, m_only, r_only = compare_keys(m_att, r_att)
-    if m_only:
-        m_only = list(m_only)
-        m_only.sort()
-    if r_only: 
-        r_only = list(r_only)
-        r_only.sort()
+    both = set()
+    r_only = set()
     difference = {}
-    for key in both:
+    for r in replica_list:
+        key = file_key(r)
+        m = m_att.pop(key, None)
+        if m is None:
+            if key not in both: r_only.add(key)
+            continue
+        both.add(key)
         for att in comp_att:
-            if m_att[key][att] != r_att[key][att]:
-                if att == 'file_id':
-                    #workaround for file_id uniquenes...
-                    tds_fix_re.match(m_att[key][att]).group(0) == tds_fix_re.match(r_att[key][att]).group(0)
-                    
+            if m[att] != r[att]:
                 if key not in difference: difference[key] = {}
-                difference[key][att] = {'master':  m_att[key][att], 'replica': r_att[key][att]}
+                difference[key][att] = {'master':  m[att], 'replica': r[att]}
+    m_only = sorted(m_att.keys())
+    r_only = sorted(r_only)
     return (both, m_only, r_only, difference)
 
-
-def compare_catalogs(master_url, replica_url):
-    master = catalog.getDatasetMetadata(master_url)
-    replica = catalog.getDatasetMetadata(replica_url)
-    
-    both, m_only, r_only, difference = compare_files(master['files'], replica['files'])
+def catalog_files(url, cache=None):
+    """Yields the file entries of the dataset catalog at url as they are parsed, read through cache
+    (a catalog.CatalogCache) if given."""
+    if cache: source = cache.open(url)
+    else: source = url
+    try:
+        for kind, ds in catalog.iterDatasetMetadata(source):
+            if kind == 'file': yield ds
+    finally:
+        if cache: source.close()
+
+def diff_catalogs(master_url, replica_url, cache=None):
+    """Like compare_catalogs, without printing anything."""
+    both, m_only, r_only, difference = compare_files(catalog_files(master_url, cache),
+                                                     catalog_files(replica_url, cache))
     if difference or m_only or r_only:
-        print ">> Difference at: \n%s\n%s" % (master_url, replica_url)
         return both, m_only, r_only, difference
     return False
 
-    
-def compare_root_catalogs(master, replica, data_re):
+def compare_catalogs(master_url, replica_url, cache=None):
+    result = diff_catalogs(master_url, replica_url, cache)
+    if result:
+        print ">> Difference at: \n%s\n%s" % (master_url, replica_url)
+    return result
+
+def _diff_version(task):
+    """Worker of compare_root_catalogs"""
+    dataset, ver, master_url, replica_url, cache = task
+    return dataset, ver, master_url, replica_url, diff_catalogs(master_url, replica_url, cache)
+
+def compare_root_catalogs(master, replica, data_re, workers=8, cache=None):
+    """Compares the dataset catalogs matching data_re in the master and replica root catalogs.
+    Up to workers pairs of catalogs are fetched and compared at once; cache is a
+    catalog.CatalogCache, so that catalogs which didn't change since the last run aren't
+    transferred again."""
     results = {}
-    
-    #get the interesting subset from master catalogs[dataset][version]
-    m_catalogs = catalog.getAllCatalogs(master)
-    for dataset in m_catalogs.keys():
-        if data_re.match(dataset) is None:
-            del m_catalogs[dataset]
-    
-    #get the interesting subset from the replica
-    r_catalogs = catalog.getAllCatalogs(replica)
-    for dataset in r_catalogs.keys():
-        if data_re.match(dataset) is None:
-            del r_catalogs[dataset]
-    
-    both, m_only, r_only = compare_keys(m_catalogs, r_catalogs)
-    if m_only: 
-        print "Not replicated: ", m_only
-        for d in m_only:
-            for v in m_catalogs[d]:
-                results[dataset] = {}
-                results[dataset][v] = (False, True, False, False)
-    if r_only: 
-        print "Not in original: ", r_only
-        for d in r_only:
-            for v in r_catalogs[d]:
-                results[dataset] = {}
-                results[dataset][v] = (False, False, True, False)
-    
-    for dataset in both:
-        print "Checking: ", dataset
-        results[dataset] = {}
+    pool = ThreadPool(workers)
+    try:
+        #get the interesting subsets from master and replica catalogs[dataset][version]
+        m_catalogs, r_catalogs = pool.map(lambda url: catalog.getAllCatalogs(url, cache), [master, replica])
+        for catalogs in m_catalogs, r_catalogs:
+            for dataset in catalogs.keys():
+                if data_re.match(dataset) is None:
+                    del catalogs[dataset]
         
-        m_ver = m_catalogs[dataset]
-        r_ver = r_catalogs[dataset]
-        both_v, m_only_v, r_only_v = compare_keys(m_ver, r_ver)
-            
-        if m_only_v: 
-            print "Version not replicated: %s (%s)" % (dataset, m_only_v)
-            for v in m_only_v:
-                results[dataset][v] = (False, True, False, False)
-        if r_only_v: 
-            print "Version removed: %s (%s)" % (dataset, r_only_v)
-            for v in r_only_v:
-                results[dataset][v] = (False, False, True, False)
+        both, m_only, r_only = compare_keys(m_catalogs, r_catalogs)
+        if m_only: 
+            print "Not replicated: ", m_only
+            for d in m_only:
+                results[d] = {}
+                for v in m_catalogs[d]:
+                    results[d][v] = (False, True, False, False)
+        if r_only: 
+            print "Not in original: ", r_only
+            for d in r_only:
+                results[d] = {}
+                for v in r_catalogs[d]:
+                    results[d][v] = (False, False, True, False)
         
-        for ver in both_v:
-            results[dataset][ver] = compare_catalogs(m_ver[ver], r_ver[ver])
-            if results[dataset][ver]:
-                both, m_only, r_only, differences = results[dataset][ver]
+        tasks = []
+        for dataset in both:
+            print "Checking: ", dataset
+            results[dataset] = {}
+            
+            m_ver = m_catalogs[dataset]
+            r_ver = r_catalogs[dataset]
+            both_v, m_only_v, r_only_v = compare_keys(m_ver, r_ver)
+                
+            if m_only_v: 
+                print "Version not replicated: %s (%s)" % (dataset, m_only_v)
+                for v in m_only_v:
+                    results[dataset][v] = (False, True, False, False)
+            if r_only_v: 
+                print "Version removed: %s (%s)" % (dataset, r_only_v)
+                for v in r_only_v:
+                    results[dataset][v] = (False, False, True, False)
+            
+            for ver in both_v:
+                tasks.append((dataset, ver, m_ver[ver], r_ver[ver], cache))
+
+        #the results come in as the comparisons finish
+        for dataset, ver, master_url, replica_url, result in pool.imap_unordered(_diff_version, tasks):
+            if result:
+                print ">> Difference at: \n%s\n%s" % (master_url, replica_url)
+            results[dataset][ver] = result
+    finally:
+        pool.close()
+        pool.join()
     return results
 
 def print_diff(diffs):
@@ -175,13 +200,16 @@ def rename_files(to_rename):
         fo.close()
 
 
-master='http://norstore-trd-bio1.hpc.ntnu.no/thredds/esgcet/catalog.xml'
-replica='http://bmbf-ipcc-ar5.dkrz.de/thredds/esgcet/catalog.xml'
-datasets='cmip5.output1.NCC.%'
-#datasets='cmip5.output1.NCC.NorESM1-M.rcp26.day.land.day.r1i1p1'
+if __name__ == '__main__':
+    master='http://norstore-trd-bio1.hpc.ntnu.no/thredds/esgcet/catalog.xml'
+    replica='http://bmbf-ipcc-ar5.dkrz.de/thredds/esgcet/catalog.xml'
+    datasets='cmip5.output1.NCC.%'
+    #datasets='cmip5.output1.NCC.NorESM1-M.rcp26.day.land.day.r1i1p1'
 
-data_re = re.compile(datasets.replace('.','\.').replace('%','.*'))
+    data_re = re.compile(datasets.replace('.','\.').replace('%','.*'))
 
-results = compare_root_catalogs(master, replica, data_re)
-print_diff(results)
+    cache = catalog.CatalogCache()
+    results = compare_root_catalogs(master, replica, data_re, cache=cache)
+    print_diff(results)
+    print "catalogs: %d unchanged, %d fetched" % (cache.hits, cache.misses)
 
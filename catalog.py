@@ -1,6 +1,69 @@
 #!/usr/local/cdat/bin/python
-import urllib2
+import urllib2, os, hashlib, json, shutil, tempfile, threading
+from StringIO import StringIO
 import xml.dom.minidom
+from lxml import etree
+
+DEFAULT_CACHE_DIR = os.path.expanduser('~/.esgcet/catalog_cache')
+
+class CatalogCache(object):
+    """On-disk cache of catalogs, revalidated with conditional GETs (ETag/Last-Modified): a catalog
+    which didn't change since it was cached isn't transferred again, the server just answers 304.
+    Each url has its own files (body and headers, named after the url's hash), which are replaced
+    atomically, so the cache may be used from several threads."""
+
+    def __init__(self, cache_dir=DEFAULT_CACHE_DIR, timeout=120):
+        if not os.path.isdir(cache_dir): os.makedirs(cache_dir)
+        self.cache_dir = cache_dir
+        self.timeout = timeout
+        self._lock = threading.Lock()
+        self.hits = self.misses = 0
+
+    def __paths(self, url):
+        name = os.path.join(self.cache_dir, hashlib.sha1(url).hexdigest())
+        return name + '.xml', name + '.json'
+
+    def __write(self, path, source):
+        """Replace path with the contents of the file object source"""
+        fd, tmp = tempfile.mkstemp(dir=self.cache_dir)
+        try:
+            f = os.fdopen(fd, 'wb')
+            try: shutil.copyfileobj(source, f)
+            finally: f.close()
+            os.rename(tmp, path)
+        except:
+            if os.path.exists(tmp): os.remove(tmp)
+            raise
+
+    def fetch(self, url):
+        """Returns the name of a local file with the current contents of url."""
+        body, meta = self.__paths(url)
+        headers = {}
+        if os.path.exists(body) and os.path.exists(meta):
+            try: cached = json.load(open(meta))
+            except ValueError: cached = {}
+            if cached.get('etag'): headers['If-None-Match'] = cached['etag']
+            if cached.get('last_modified'): headers['If-Modified-Since'] = cached['last_modified']
+        try:
+            response = urllib2.urlopen(urllib2.Request(url, headers=headers), timeout=self.timeout)
+        except urllib2.HTTPError, e:
+            if e.code != 304 or not headers: raise
+            #not modified, what we have is still good
+            with self._lock: self.hits += 1
+            return body
+        try:
+            self.__write(body, response)
+            info = response.info()
+            self.__write(meta, StringIO(json.dumps({'url': url, 'etag': info.getheader('ETag'),
+                                                    'last_modified': info.getheader('Last-Modified')})))
+        finally:
+            response.close()
+        with self._lock: self.misses += 1
+        return body
+
+    def open(self, url):
+        """Like urllib2.urlopen(url), but through the cache."""
+        return open(self.fetch(url), 'rb')
 
 def parseNode(node):
     """Extract information from the dataset xml node (not necessary "our" concept of dataset
@@ -22,34 +85,66 @@ def parseCatalogLinknode(node):
     version = int(version)
     return (id, version, node.getAttribute('xlink:href'))
 
+def _localName(elem):
+    """Tag name without namespace"""
+    return elem.tag.rsplit('}', 1)[-1]
+
+def iterDatasetMetadata(catalog):
+    """Parse a dataset catalog (url or file object) incrementally and yield (kind, dictionary) for
+    each dataset node as soon as it's complete. kind is 'dataset' for the main node, 'file' or
+    'aggregation'; the dictionaries are the same parseNode() returns. Processed elements are
+    dropped, so memory doesn't grow with the size of the catalog."""
+    if isinstance(catalog, basestring): catalog = urllib2.urlopen(catalog)
+
+    depth = 0
+    stack = []  #(depth, properties) of the dataset nodes we are in
+    for event, elem in etree.iterparse(catalog, events=('start', 'end')):
+        if not isinstance(elem.tag, basestring): continue  #comments, etc
+        name = _localName(elem)
+        if event == 'start':
+            depth += 1
+            if name == 'dataset': stack.append((depth, {}))
+            continue
+
+        if name == 'property' and stack and stack[-1][0] == depth - 1:
+            stack[-1][1][elem.get('name', '')] = elem.get('value', '')
+        elif name == 'dataset':
+            ds_depth, ds = stack.pop()
+            if ds_depth == 2:
+                #this is the main node
+                yield ('dataset', ds)
+            elif 'file_id' in ds: yield ('file', ds)
+            elif 'aggregation_id' in ds: yield ('aggregation', ds)
+            #we are done with it and everything before it
+            elem.clear()
+            while elem.getprevious() is not None: del elem.getparent()[0]
+        depth -= 1
+
 def getDatasetMetadata(catalog):    
     """Harvest a main catalog and returs a dictionary with information about the datasets catalogs
         returns:= dictionary[drs id string][version number] = absolute url"""
-    xml_str = urllib2.urlopen(catalog).read()
-    dom = xml.dom.minidom.parseString(xml_str)
-    catalog = dom.firstChild
-    #services = catalog.getElementsByTagName('service')
     dataset = None
     
     files = []
     aggregations = []
-    for node in catalog.getElementsByTagName('dataset'):
-        ds = parseNode(node)
-        if node.parentNode == catalog:
-            #this is the main node
-            dataset = ds
-        elif 'file_id' in ds: files.append(ds)
-        elif 'aggregation_id' in ds: aggregations.append(ds)
+    for kind, ds in iterDatasetMetadata(catalog):
+        if kind == 'dataset': dataset = ds
+        elif kind == 'file': files.append(ds)
+        elif kind == 'aggregation': aggregations.append(ds)
         
     return {'dataset' : dataset, 'files' : files, 'aggregations' : aggregations}
 
-def getAllCatalogs(main_catalog_url):
+def getAllCatalogs(main_catalog_url, cache=None):
     """Harvest a main catalog and returs a dictionary with information about the datasets catalogs
-        returns:= dictionary[drs id string][version number] = absolute url"""
+        returns:= dictionary[drs id string][version number] = absolute url
+        The catalog is read through cache (a CatalogCache) if given."""
  
     catalog_base = main_catalog_url[:main_catalog_url.rindex('/')]
     
-    xml_str = urllib2.urlopen(main_catalog_url).read()
+    if cache: source = cache.open(main_catalog_url)
+    else: source = urllib2.urlopen(main_catalog_url)
+    try: xml_str = source.read()
+    finally: source.close()
     dom = xml.dom.minidom.parseString(xml_str)
     catalog = dom.firstChild
     datasets = {}
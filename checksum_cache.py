@@ -0,0 +1,122 @@
+#!/usr/local/cdat/bin/python
+"""Persistent cache of file checksums, shared by everything verifying files.
+A checksum is stored under the device and inode of the file, together with the size and mtime
+(in ns) it had when it was computed; as long as none of these changed, the stored value is
+returned by a stat alone and the file doesn't have to be read again.  Keying by inode rather
+than path means a file which is renamed or moved within a file system (e.g. from scratch to
+the published tree) keeps its entry.
+Usage:
+    cache = checksum_cache.getCache()
+    md5 = cache.checksum('/some/file')
+    ...
+    cache.report(log)"""
+
+import os, sqlite3, threading
+import logging
+log = logging.getLogger('checksum_cache')
+
+DEFAULT_DB_FILE = os.path.expanduser('~/.esgcet/checksum_cache.db')
+
+#how many new entries are kept before committing them
+COMMIT_EVERY = 100
+
+def mtime_ns(st):
+    """mtime of an os.stat result in ns (python 2 os.stat has no st_mtime_ns)"""
+    if hasattr(st, 'st_mtime_ns'): return st.st_mtime_ns
+    return int(round(st.st_mtime * 1e9))
+
+class ChecksumCache(object):
+    """sqlite backed (device, inode, size, mtime_ns) -> checksum cache.  It may be used from
+    several threads."""
+
+    def __init__(self, db_file=DEFAULT_DB_FILE):
+        self.db_file = db_file
+        self._lock = threading.Lock()
+        self._conn = sqlite3.connect(db_file, check_same_thread=False)
+        self._conn.text_factory = str
+        self._conn.execute('CREATE TABLE IF NOT EXISTS file_checksums (dev INTEGER NOT NULL, '
+                           'inode INTEGER NOT NULL, algorithm TEXT NOT NULL, size INTEGER, '
+                           'mtime_ns INTEGER, checksum TEXT, path TEXT, '
+                           'PRIMARY KEY (dev, inode, algorithm))')
+        self._uncommitted = 0
+        self.hits = self.misses = 0
+
+    def get(self, path, algorithm='md5', st=None):
+        """Returns the checksum of path if it's known and the file didn't change since, or None.
+        st is the os.stat of path (if known)."""
+        if st is None:
+            try:
+                st = os.stat(path)
+            except OSError:
+                self.misses += 1
+                return None
+        self._lock.acquire()
+        try:
+            row = self._conn.execute('SELECT size, mtime_ns, checksum FROM file_checksums '
+                                     'WHERE dev=? AND inode=? AND algorithm=?',\
+                                     (st.st_dev, st.st_ino, algorithm.lower())).fetchone()
+            if row and row[0] == st.st_size and row[1] == mtime_ns(st):
+                self.hits += 1
+                return row[2]
+            self.misses += 1
+            return None
+        finally:
+            self._lock.release()
+
+    def put(self, path, checksum, algorithm='md5', st=None):
+        """Remember the checksum of path. st is the os.stat of path when the checksum was computed
+        (if known), a file changing while being read then won't be cached with the new mtime."""
+        if st is None: st = os.stat(path)
+        self._lock.acquire()
+        try:
+            self._conn.execute('INSERT OR REPLACE INTO file_checksums VALUES (?,?,?,?,?,?,?)',\
+                               (st.st_dev, st.st_ino, algorithm.lower(), st.st_size, mtime_ns(st),\
+                                checksum, path))
+            self._uncommitted += 1
+            if self._uncommitted >= COMMIT_EVERY:
+                self._conn.commit()
+                self._uncommitted = 0
+        finally:
+            self._lock.release()
+
+    def checksum(self, path, algorithm='md5'):
+        """Returns the checksum of path, from the cache if possible, else computing (and storing) it."""
+        import checksum_pool
+        st = os.stat(path)
+        value = self.get(path, algorithm, st)
+        if value is None:
+            value = checksum_pool.checksum(path, algorithm)
+            self.put(path, value, algorithm, st)
+        return value
+
+    def getHitRate(self):
+        """Fraction of lookups served from the cache (0 if there were none)."""
+        total = self.hits + self.misses
+        if not total: return 0.0
+        return float(self.hits) / total
+
+    def report(self, logger=log):
+        logger.info('checksum cache: %d hits, %d misses (%.1f%% hit rate)', self.hits, self.misses,\
+                    100 * self.getHitRate())
+
+    def commit(self):
+        self._lock.acquire()
+        try:
+            self._conn.commit()
+            self._uncommitted = 0
+        finally:
+            self._lock.release()
+
+    def close(self):
+        self.commit()
+        self._conn.close()
+        if _caches.get(self.db_file) is self: del _caches[self.db_file]
+
+_caches = {}
+def getCache(db_file=DEFAULT_DB_FILE):
+    """Returns the cache stored in db_file, shared within this process."""
+    if db_file not in _caches:
+        dir = os.path.dirname(db_file)
+        if dir and not os.path.isdir(dir): os.makedirs(dir)
+        _caches[db_file] = ChecksumCache(db_file)
+    return _caches[db_file]
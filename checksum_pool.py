@@ -0,0 +1,135 @@
+#!/usr/local/cdat/bin/python
+"""Compute checksums of many files in a pool of worker processes.
+Files are hashed in-process with hashlib (no fork/exec of an external md5 program per file)
+and results are handed back as soon as each one is ready, so a slow file never blocks
+the ones queued behind it."""
+
+import os, time, hashlib, multiprocessing, Queue
+import logging
+log = logging.getLogger('checksum_pool')
+
+#Read size. Should be a multiple of the file system block size (GPFS uses up to 4MB blocks).
+BLOCK_SIZE = 4*1024*1024
+
+def checksum(filename, algorithm='md5', block_size=BLOCK_SIZE):
+    """Returns the hex digest of the given file. The file is read unbuffered in large blocks
+    into a single reusable buffer."""
+    alg = hashlib.new(algorithm.lower())
+    buf = bytearray(block_size)
+    view = memoryview(buf)
+    f = open(filename, 'rb', 0)
+    try:
+        while True:
+            read = f.readinto(buf)
+            if not read: break
+            alg.update(view[:read])
+    finally:
+        f.close()
+    return alg.hexdigest()
+
+def _work(job):
+    """Runs in the worker process. Exceptions are returned, not raised, so every job reports back."""
+    key, filename, algorithm, block_size = job
+    start = time.time()
+    value = error = None
+    size = 0
+    try:
+        value = checksum(filename, algorithm, block_size)
+        size = os.path.getsize(filename)
+    except Exception as e:
+        error = str(e)
+    return (key, value, error, os.getpid(), size, time.time() - start)
+
+class ChecksumPool(object):
+    """Pool of processes computing file checksums.
+    Usage:
+        pool = ChecksumPool(processes=16)
+        pool.submit('/some/file', tag=whatever)
+        for tag, filename, checksum, error in pool.results(): ...
+        pool.close()"""
+
+    def __init__(self, processes=None, algorithm='md5', block_size=BLOCK_SIZE):
+        """processes := number of workers (default: number of cpus)
+        algorithm := any algorithm known to hashlib
+        block_size := size of each read"""
+        self.algorithm = algorithm
+        self.block_size = block_size
+        self._pool = multiprocessing.Pool(processes)
+        self._done = Queue.Queue()
+        self._pending = {}
+        self._counter = 0
+        #pid -> [files, bytes, seconds]
+        self._stats = {}
+
+    def submit(self, filename, tag=None, algorithm=None):
+        """Schedule the checksum computation of filename. tag is returned untouched with the result."""
+        self._counter += 1
+        self._pending[self._counter] = (tag, filename)
+        self._pool.apply_async(_work, ((self._counter, filename, algorithm or self.algorithm,\
+                                        self.block_size),), callback=self._done.put)
+
+    def pending(self):
+        """Number of submitted checksums whose results weren't collected yet."""
+        return len(self._pending)
+
+    def next(self):
+        """Blocks until any pending checksum is ready and returns (tag, filename, checksum, error).
+        error is None if the checksum could be computed. Returns None if nothing is pending."""
+        if not self._pending: return None
+        key, value, error, pid, size, elapsed = self._done.get()
+        tag, filename = self._pending.pop(key)
+
+        stats = self._stats.setdefault(pid, [0, 0, 0.0])
+        stats[0] += 1
+        stats[1] += size
+        stats[2] += elapsed
+        if error: log.warn('checksum of %s failed: %s', filename, error)
+        return (tag, filename, value, error)
+
+    def results(self):
+        """Generator returning results of all pending checksums in the order they complete."""
+        while self._pending:
+            yield self.next()
+
+    def getThroughput(self):
+        """Returns a dictionary {worker pid: (files, bytes, bytes/s)} for all workers that did something."""
+        result = {}
+        for pid, (files, bytes, secs) in self._stats.items():
+            if secs > 0: result[pid] = (files, bytes, bytes/secs)
+            else: result[pid] = (files, bytes, 0.0)
+        return result
+
+    def report(self, logger=log):
+        """Log the throughput achieved per worker and in total."""
+        total_files = total_bytes = 0
+        total_speed = 0.0
+        for pid, (files, bytes, speed) in sorted(self.getThroughput().items()):
+            logger.info('checksum worker %s: %s files, %.1f MB at %.1f MB/s', pid, files,\
+                        float(bytes)/1024/1024, speed/1024/1024)
+            total_files += files
+            total_bytes += bytes
+            total_speed += speed
+        if total_files:
+            logger.info('checksum pool: %s files, %.1f MB at %.1f MB/s aggregated', total_files,\
+                        float(total_bytes)/1024/1024, total_speed/1024/1024)
+
+    def close(self):
+        """Wait for all workers to finish and release them. Uncollected results are discarded."""
+        self._pool.close()
+        self._pool.join()
+
+    def terminate(self):
+        """Stop all workers right away."""
+        self._pool.terminate()
+        self._pool.join()
+
+if __name__ == '__main__':
+    import sys
+    logging.basicConfig(level=logging.INFO)
+    pool = ChecksumPool()
+    for file in sys.argv[1:]: pool.submit(file)
+    for tag, file, value, error in pool.results():
+        if error: print "ERROR", file, error
+        else: print value, file
+    pool.report()
+    pool.close()
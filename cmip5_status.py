@@ -51,17 +51,9 @@ class Cmip5StatusDB(DB):
         if overwrite: 
             log.debug('merging %s items', len(items))
             return self._merge_all(items)
-            
-
-        results = self._session.query(items[0].__class__).filter(items[0].__class__.dataset_id.in_([ i.dataset_id for i in items])) #\
-#                                                        .filter(items[0].__class__.version.in_([ i.version for i in items])).all()
-
-        new = []
-        existing = []
-
-        in_session = self._add_all(items, db_objects=results, new=new, existing=existing )
 
-        return new + existing
+        #only new ones
+        return self._upsert_all(items, update=False)
 
 def __getTestData():
     return [EntryDAO(DATASET_ID='cmip5.output1.IPSL.IPSL-CM5A-LR.aqua4K.mon.atmos.cfMon.r1i1p1', version=20110429, datanode='cmip2.dkrz.de', gateway='albedo2.dkrz.de')]
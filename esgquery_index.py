@@ -9,6 +9,8 @@ import getopt
 import string
 import re
 import pprint
+import threading
+import Queue
 
 from lxml import etree
 from urllib2 import urlopen, HTTPError
@@ -100,6 +102,13 @@ Options:
        Query the service at URL. If the esgcet publisher package is present, the value of parameter
        'solr_search_service_url' is used, otherwise the default is %s.
 
+    --stream
+       Write the records as they are read, chunk by chunk, rather than after all of them have been read.
+       Memory use then doesn't depend on the number of results, and the next chunk is read from the
+       service while the current one is written. In wide format records are sorted by id only within
+       a chunk, and the fields are those of the first chunk. With --pretty-print, columns are aligned
+       within a chunk.
+
     -t TEXT
     --free-text TEXT
        Free text query.
@@ -295,6 +304,70 @@ def readChunk(service, query):
         sys.exit(1)
     return tree
 
+# Generator yielding the parsed chunk for each query in queries (an iterable of query strings).
+# The chunks are read by a background thread, staying up to ahead chunks ahead of the caller, so
+# the service is queried while the previous chunk is being parsed and written.
+def prefetchChunks(service, queries, ahead=1):
+    chunkq = Queue.Queue(ahead)
+    stop = threading.Event()
+    def reader():
+        try:
+            for query in queries:
+                if stop.isSet(): return
+                chunkq.put((readChunk(service, query), None))
+        except BaseException:
+            # readChunk calls sys.exit on some errors; pass that on to the caller too
+            chunkq.put((None, sys.exc_info()))
+        else:
+            chunkq.put((None, None))
+    thread = threading.Thread(target=reader, name='prefetchChunks')
+    thread.daemon = True
+    thread.start()
+    try:
+        while True:
+            tree, exc = chunkq.get()
+            if exc is not None:
+                raise exc[0], exc[1], exc[2]
+            if tree is None:
+                break
+            yield tree
+    finally:
+        # The caller may stop early; make sure the reader isn't left blocked on a full queue.
+        stop.set()
+        try:
+            while True: chunkq.get_nowait()
+        except Queue.Empty:
+            pass
+
+# Read the records of a (non-facet) query, chunk by chunk.
+# The first chunk is read right away, the following ones through prefetchChunks.
+# Returns (numFound, chunks) where chunks is an iterator over lists [(objid, field, value), ...],
+# one per chunk.  Only the current chunk and the prefetched ones are held in memory.
+def readResults(facets, fields, format, freetext, objtype, service, userLimit, includeId,\
+                verbose=False, chunksize=DEFAULT_CHUNKSIZE, ahead=1):
+    def formulate(offset, limit):
+        query = formulateQuery(facets, fields, format, freetext, objtype, service, offset, limit)
+        if verbose:
+            print >>sys.stderr, 'Query: ', query
+        return query
+    limit = min(userLimit, chunksize)
+    first, numFound, numResults = parseResponse(readChunk(service, formulate(0, limit)), includeId)
+    total = min(numFound, userLimit)
+    pending = [first]
+    def chunks():
+        yield pending.pop()
+        if numResults==0:
+            return
+        queries = (formulate(offset, min(total-offset, chunksize))\
+                   for offset in xrange(limit, total, chunksize))
+        for tree in prefetchChunks(service, queries, ahead):
+            results, found, numDocs = parseResponse(tree, includeId)
+            del tree
+            if numDocs==0:
+                break
+            yield results
+    return numFound, chunks()
+
 # Parse the response header for available facet values
 # Returns (([valueList],), header), numFound as for parseTrailer
 def parseHeader(tree):
@@ -417,6 +490,72 @@ def outputResults(results, format, header=None, prettyPrint=False, printHeaders=
         print 'Format not yet implemented:', format
         sys.exit(1)
 
+# Writes results chunk by chunk, as outputResults would write them all at once; see --stream.
+# Only the current chunk is held in memory.
+class ResultWriter(object):
+    def __init__(self, format, prettyPrint=False, delimiter=None, out=sys.stdout):
+        if format not in ['narrow', 'wide']:
+            print 'Format not yet implemented:', format
+            sys.exit(1)
+        self.format = format
+        self.prettyPrint = prettyPrint
+        self.delimiter = delimiter
+        self.out = out
+        self.fieldlist = None           # wide format fields, from the first chunk
+        self.breakline = None           # set once the header has been printed
+        self.count = 0
+
+    def header(self):
+        if self.format=='narrow':
+            return ['id', 'field', 'value']
+        return ['id']+(self.fieldlist or [])
+
+    # results = [(id,field,value), (id,field,value), ...]
+    def write(self, results):
+        if self.format=='narrow':
+            rows = results
+        else:
+            valueDict = {}
+            for objid,field,value in results:
+                valueDict[(objid, field)] = value
+            if self.fieldlist is None:
+                fieldset = set([field for objid,field,value in results])
+                fieldset.discard('id')
+                self.fieldlist = sorted(fieldset)
+            objlist = sorted(set([objid for objid,field,value in results]))
+            rows = [tuple([obj]+[valueDict.get((obj,field), '') for field in self.fieldlist])\
+                    for obj in objlist]
+        if self.prettyPrint:
+            self.printRows(rows)
+        elif self.delimiter is not None:
+            for item in rows:
+                print >>self.out, self.delimiter.join(item)
+        else:
+            for item in rows:
+                print >>self.out, item
+        self.count += len(rows)
+
+    # Pretty-print rows as printQueryResult does, but with the columns aligned for this chunk only.
+    def printRows(self, rows):
+        header = self.header()
+        itemCount = getItemCount(header, rows)
+        format = '| '+' | '.join(["%%-%ds"%item for item in itemCount])+' |'
+        if self.breakline is None:
+            width = sum(itemCount)+3*len(itemCount)-1
+            self.breakline = '+'+width*'-'+'+'
+            print >>self.out, self.breakline
+            print >>self.out, format%tuple(header)
+            print >>self.out, self.breakline
+        for item in rows:
+            print >>self.out, format%item
+
+    def close(self):
+        if self.prettyPrint:
+            if self.breakline is None:
+                self.printRows([])
+            print >>self.out, self.breakline
+            print >>self.out, '%d results found'%self.count
+
 # Print facet results.
 # results = [(v1, ..., vn), (v1, ..., vn), ...]
 # header = [f1, f2, ..., fn]
@@ -436,7 +575,7 @@ def preoutput(argv):
     global DEFAULT_QUERY_SERVICE
 
     try:
-        args, lastargs = getopt.getopt(argv, "d:ho:pq:t:v", ['count', 'delimiter=', 'facet-query=', 'facets=', 'fields=', 'format=', 'free-text=', 'help', 'limit=', 'pretty-print', 'service-url=', 'type=', 'verbose'])
+        args, lastargs = getopt.getopt(argv, "d:ho:pq:t:v", ['count', 'delimiter=', 'facet-query=', 'facets=', 'fields=', 'format=', 'free-text=', 'help', 'limit=', 'pretty-print', 'service-url=', 'stream', 'type=', 'verbose'])
     except getopt.error:
         print sys.exc_value
         print usage
@@ -461,11 +600,11 @@ def preoutput(argv):
     freetext = None
     includeId = False
     objtype = DATASET
-    offset = 0
     outpath = sys.stdout
     outpathIsStdout = True
     prettyPrint = False
     service = DEFAULT_QUERY_SERVICE
+    stream = False
     userLimit = MAX_RECORDS
     verbose = False
     for flag, arg in args:
@@ -505,6 +644,8 @@ def preoutput(argv):
                 facets.append((f.strip(), v.strip()))
         elif flag=='--service-url':
             service = arg
+        elif flag=='--stream':
+            stream = True
         elif flag in ['-t', '--free-text']:
 	    freetext = arg
 	elif flag=='--type':
@@ -524,44 +665,31 @@ def preoutput(argv):
     if facetValues is not None:
         format = 'wide'
 
-    # While remaining data:
-    fullResults = []
-    numFound = 0
-    moredata = True
-    nread = 0
-    nleft = userLimit
-    offset = 0
-    chunksize = DEFAULT_CHUNKSIZE
-    while moredata:
-
-        # Formulate a query
-        if not (countOnly or facetValues is not None):
-            limit = min(nleft, chunksize)
+    if not (countOnly or facetValues is not None):
+        # Read the records chunk by chunk.  With --stream, they are left for main() to write as
+        # they come: fullResults is then an iterator over the chunks' results.
+        numFound, chunks = readResults(facets, fields, format, freetext, objtype, service, userLimit,\
+                                       includeId, verbose=verbose)
+        if stream:
+            fullResults = chunks
         else:
-            limit = 0
-        query = formulateQuery(facets, fields, format, freetext, objtype, service, offset, limit, facetValues=facetValues)
+            fullResults = []
+            for results in chunks:
+                fullResults.extend(results)
+    else:
+        # Only the count or the facet values are wanted, a single query does it.
+        query = formulateQuery(facets, fields, format, freetext, objtype, service, 0, 0, facetValues=facetValues)
         if verbose:
             print >>sys.stderr, 'Query: ', query
-
-        # Read a chunk
         chunk = readChunk(service, query)
 
-        # Parse the response. For facet value searches, parse the response trailer
+        # For facet value searches, parse the response trailer
         if facetValues is None:
-            results, numFound, numResults = parseResponse(chunk, includeId)
-            fullResults.extend(results)
+            fullResults, numFound, numResults = parseResponse(chunk, includeId)
+        elif allFacets:
+            fullResults, numFound = parseHeader(chunk)
         else:
-            numResults = 0
-            if allFacets:
-                fullResults, numFound = parseHeader(chunk)
-            else:
-                fullResults, numFound = parseTrailer(chunk, facetValues, includeId)
-
-        # More data if some results were found and the number of records read < total
-        nread += numResults
-        nleft -= limit
-        moredata = (numResults>0) and (nread<min(numFound, userLimit))
-        offset += limit
+            fullResults, numFound = parseTrailer(chunk, facetValues, includeId)
 
 ##    print "jfp fullResults as list of (id,field,value) ="
 ##    pprint.pprint(fullResults)
@@ -578,7 +706,13 @@ def main(argv):
      outpathIsStdout,format) = preoutput(argv)
 
     # Output the results
-    if not (countOnly or facetValues is not None):
+    if not (countOnly or facetValues is not None) and not isinstance(fullResults, list):
+        # --stream: fullResults is an iterator over chunks of results
+        writer = ResultWriter(format, prettyPrint=prettyPrint, delimiter=delim, out=outpath)
+        for results in fullResults:
+            writer.write(results)
+        writer.close()
+    elif not (countOnly or facetValues is not None):
         outputResults(fullResults, format, prettyPrint=prettyPrint, printHeaders=True,\
                       delimiter=delim, out=outpath)
     elif facetValues is not None:
@@ -10,86 +10,211 @@ The metadata of the files stored are:
 - checksum
 """
 
-from sqlalchemy import Column, Integer, String, Float, Boolean, or_
+from sqlalchemy import Column, Integer, String, Float, Boolean, or_, and_
 import logging 
 log = logging.getLogger('file_db')
 from utils_db import DAO, DB, Base
-import os, hashlib
+import os, stat, hashlib
 
 _ALG_BLOCK_SIZE=2**14
 
-import threading, Queue, subprocess
-class Checksum(threading.Thread):
-    """Python Thread for managing Checksum process"""
-    _in = Queue.Queue()
-    _out = Queue.Queue()
-    _threads = []
-
-    _kill_token = object()
-
-    running = True
-    _check_kwargs = {}
-
-    def __init__(self):
-        threading.Thread.__init__(self)
-        self.daemon = False
-       
-    def run(self):
-        while Checksum.running:
-            file = self._in.get()
-            if file is self._kill_token:
-                self._in.task_done() 
-                break
-
-
+import threading, Queue
+
+def _checksum(file, algorithm):
+    """Checksum of file computed in-process with hashlib, or taken from FileDAO.checksum_cache."""
+    if FileDAO.checksum_cache: return FileDAO.checksum_cache.checksum(file, algorithm)
+    alg = hashlib.new(algorithm)
+    f = open(file, 'rb')
+    block_size=_ALG_BLOCK_SIZE
+    data = f.read(block_size)
+    while data:
+        alg.update(data)
+        data = f.read(block_size)
+    f.close()
+
+    return alg.hexdigest()
+
+class CancelledError(Exception):
+    """Raised when asking for the result of a cancelled checksum."""
+    pass
+
+class ChecksumFuture(object):
+    """Checksum of a file which is (or will be) computed by a ChecksumExecutor."""
+    _PENDING, _RUNNING, _FINISHED, _CANCELLED = range(4)
+
+    def __init__(self, path, tag=None, algorithm='md5'):
+        self.path = path
+        self.tag = tag
+        self.algorithm = algorithm
+        self._state = self._PENDING
+        self._value = self._error = None
+        self._cond = threading.Condition()
+
+    def cancel(self):
+        """Cancel it if it hasn't started yet. Returns True if it is cancelled."""
+        self._cond.acquire()
+        try:
+            if self._state == self._PENDING:
+                self._state = self._CANCELLED
+                self._cond.notify_all()
+            return self._state == self._CANCELLED
+        finally:
+            self._cond.release()
+
+    def cancelled(self):
+        return self._state == self._CANCELLED
+
+    def done(self):
+        return self._state in (self._FINISHED, self._CANCELLED)
+
+    def exception(self):
+        """Waits for it to finish and returns the exception raised while computing it (or None)."""
+        self._cond.acquire()
+        try:
+            while not self.done(): self._cond.wait()
+        finally:
+            self._cond.release()
+        if self._state == self._CANCELLED: raise CancelledError(self.path)
+        return self._error
+
+    def result(self):
+        """Waits for it to finish and returns the checksum. Raises whatever computing it raised."""
+        error = self.exception()
+        if error is not None: raise error
+        return self._value
+
+    def _start(self):
+        self._cond.acquire()
+        try:
+            if self._state != self._PENDING: return False
+            self._state = self._RUNNING
+            return True
+        finally:
+            self._cond.release()
+
+    def _finish(self, value, error):
+        self._cond.acquire()
+        try:
+            self._value, self._error = value, error
+            self._state = self._FINISHED
+            self._cond.notify_all()
+        finally:
+            self._cond.release()
+
+class ChecksumExecutor(object):
+    """Bounded pool of threads computing checksums in-process (hashlib releases the GIL while
+    hashing, so threads do run in parallel).  submit() blocks while max_pending jobs are waiting,
+    so whoever is feeding it can't run ahead of the disks.  Errors are reported per file through
+    the returned futures.
+    Usage:
+        executor = ChecksumExecutor(workers=10)
+        future = executor.submit('/some/file')
+        ...
+        print future.result()
+        executor.shutdown()"""
+    _stop = object()
+
+    def __init__(self, workers=10, max_pending=None, algorithm='md5'):
+        """workers := number of threads
+        max_pending := number of jobs which may wait for a thread (default: 2*workers)
+        algorithm := any algorithm known to hashlib"""
+        self.algorithm = algorithm
+        self._jobs = Queue.Queue(max_pending or 2*workers)
+        self._threads = []
+        for i in range(workers):
+            t = threading.Thread(target=self._work)
+            t.daemon = True
+            t.start()
+            self._threads.append(t)
+        log.debug('started %s checksum threads', workers)
+
+    def submit(self, path, tag=None, algorithm=None):
+        """Queue the checksum of path and return its ChecksumFuture. tag is stored in it as is."""
+        future = ChecksumFuture(path, tag, algorithm or self.algorithm)
+        self._jobs.put(future)
+        return future
+
+    def _work(self):
+        while True:
+            future = self._jobs.get()
+            if future is self._stop: break
+            if not future._start(): continue    #cancelled
             try:
-                result = self.process(file)
-                
-                self._out.put((file, result))
+                value = _checksum(future.path, future.algorithm)
             except Exception as e:
-                log.error('Error: %s', e)
-            finally:
-                self._in.task_done()
-
-    def process(self, file):
-        p = subprocess.Popen(['md5sum', file.getLocalFile()], stdout=subprocess.PIPE)
-        retcode = p.wait()
-        stdout, stderr = p.communicate()
-        checksum = stdout.split(' ')[0]
-        
-        return file.check(checksum_value=checksum, **self._check_kwargs)
-
-    @staticmethod
-    def add(file):
-        Checksum._in.put(file)
-
-    @staticmethod
-    def setCheckArgs(**kwargs):
-        Checksum._check_kwargs = kwargs
-
-    @staticmethod
-    def addThread(amount=1):
-        while amount > 0:
-            log.debug('added new thread')
-            t = Checksum()
-            Checksum._threads.append(t)
-            t.start()
-            amount -= 1
-
-    @staticmethod
-    def waitUntilFinished():
-        #wait for queue
-        Checksum._in.join()
-
-    @staticmethod
-    def stop():
-        #nobody else should continue
-        Checksum.running = False
-
-        #waiting threads should wake up
-        for i in range(len(Checksum._threads)):
-            Checksum.add(Checksum._kill_token)
-            
+                log.error('Checksum of %s failed: %s', future.path, e)
+                future._finish(None, e)
+            else:
+                future._finish(value, None)
+
+    def shutdown(self, wait=True, cancel_pending=False):
+        """Stop all threads once the queued jobs are done (or cancelled, if cancel_pending)."""
+        if cancel_pending:
+            while True:
+                try:
+                    future = self._jobs.get_nowait()
+                except Queue.Empty:
+                    break
+                future.cancel()
+        for t in self._threads: self._jobs.put(self._stop)
+        if wait:
+            for t in self._threads: t.join()
+        self._threads = []
+
+try:
+    from os import scandir
+except ImportError:
+    try:
+        from scandir import scandir
+    except ImportError:
+        scandir = None
+
+class _DirEntry(object):
+    """Stand-in for the entries returned by scandir where it isn't available (listdir + stat)."""
+    def __init__(self, dir, name):
+        self.name = name
+        self.path = os.path.join(dir, name)
+        self._stat = None
+    def stat(self):
+        if self._stat is None: self._stat = os.stat(self.path)
+        return self._stat
+    def is_dir(self):
+        return stat.S_ISDIR(self.stat().st_mode)
+    def is_file(self):
+        return stat.S_ISREG(self.stat().st_mode)
+
+def _scandir(dir):
+    if scandir: return scandir(dir)
+    return [ _DirEntry(dir, name) for name in os.listdir(dir) ]
+
+_DIR_NEW, _DIR_CHANGED, _DIR_UNCHANGED = range(3)
+
+def _scanDir(dir, mtime, in_new_tree, known, offset, dryrun):
+    """Scan a single directory for FileDB.updateFromDir.
+        dir: absolute path, mtime its mtime (if known)
+        in_new_tree: True if the parent directory is new, so this one must be too
+        known: path -> mtime of the directories in the DB
+    Returns (path, mtime, state, subdirs, files), where subdirs are the tasks for the directories
+    to be scanned next and files the (name, size, mtime) of the files which should be added."""
+    if mtime is None: mtime = os.path.getmtime(dir)
+    path = dir[offset:]
+    if in_new_tree or path not in known: state = _DIR_NEW
+    elif mtime != known[path]: state = _DIR_CHANGED
+    else: state = _DIR_UNCHANGED
+
+    subdirs = []
+    files = []
+    if state == _DIR_NEW and dryrun:
+        #just report it, there's no need to look further
+        return path, mtime, state, subdirs, files
+    for entry in _scandir(dir):
+        #d_type spares us a stat for most entries, files in unchanged directories aren't stat'ed
+        if entry.is_dir():
+            subdirs.append((entry.path, entry.stat().st_mtime, state == _DIR_NEW))
+        elif state != _DIR_UNCHANGED and not dryrun:
+            st = entry.stat()
+            files.append((entry.name, st.st_size, st.st_mtime))
+    return path, mtime, state, subdirs, files
 
 class DirectoryDAO(Base, DAO):
     __tablename__ = 'dir_cache'
@@ -127,6 +252,9 @@ class FileDAO(Base, DAO):
     #access FileDAO.root for rooting all files
     root = ''
 
+    #checksum_cache.ChecksumCache consulted before reading any file (if set)
+    checksum_cache = None
+
     def __init__(self, **kwargs):
         if 'root' in kwargs: self.root = kwargs['root']
         if 'file' in kwargs:
@@ -220,39 +348,24 @@ class FileDAO(Base, DAO):
 
     @staticmethod
     def __getChecksum(file, algorithm):
-        alg = hashlib.__dict__[algorithm]()
-        f = open(file, 'r')
-        block_size=_ALG_BLOCK_SIZE
-        data = f.read(block_size)
-        while data:
-            alg.update(data)
-            data = f.read(block_size)
-        f.close()
-
-        return alg.hexdigest()
+        return _checksum(file, algorithm)
 
 class FileDB(DB):
     """Representsthe local files DB"""
 
-    def __init__(self, db_url, root):
+    def __init__(self, db_url, root, checksum_cache=None):
+        """checksum_cache: checksum_cache.ChecksumCache to consult before computing checksums."""
         DB.__init__(self, db_url)
         #trim last slash if present
         if root[-1:] == '/': root = root[:-1]
 
         self.root = root
         FileDAO.root = root
+        FileDAO.checksum_cache = checksum_cache
 
     def addAll(self, files):
-
-        self.open()
-
-        results = self._session.query(FileDAO).filter(FileDAO.name.in_([ f.name for f in files])).all()
-
-        new = []
-        existing = []
-
-        in_session = self._add_all(files, db_objects=results, new=new, existing=existing )
-        return new + existing
+        """Add files which aren't already in the DB (those which are are left untouched)."""
+        return self._upsert_all(files, update=False)
 
     def get(self, **filter):
         self.open()
@@ -264,109 +377,110 @@ class FileDB(DB):
 
 
 
-    def compareWithLocal(self, batch_size=100, only_new=False, **kwargs):
+    def compareWithLocal(self, batch_size=100, only_new=False, workers=10, **kwargs):
         """Compared DB with the current directory and report differences.
             only_new: compare only files which weren't checked before (flag in DB mark this)
             batch_size: number of files to be compared before updating DB.
+            workers: number of threads computing checksums.
             update: Only checked, result will not be stored in the DB.
-            **kwargs: passed to the Checksum Thread manager for configuration."""
+            **kwargs: passed to FileDAO.check()."""
         self.open()
 
-            
-
         ok_num = 0
         failed_num = 0
-    
-        Checksum.setCheckArgs(**kwargs)
-        Checksum.addThread(amount=10)    
 
-        workToDo = True
-
-        while workToDo:
-            ok = []
-            failed = []
-                
-            if only_new: query = self._session.query(FileDAO).filter(FileDAO.checked==None)
-            else: query = self._session.query(FileDAO).filter(or_(FileDAO.checked==False, FileDAO.checked==None))
-            files = query[:batch_size]
-
-            if not files and ok_num + failed_num == 0:
-                #first time run and nothing to be done
-                log.info("Nothing to do. Exiting")
-                break #return True
-
-            #parse this lasst batch
-            if len(files) < batch_size: workToDo = False
+        if only_new: query = self._session.query(FileDAO).filter(FileDAO.checked==None)
+        else: query = self._session.query(FileDAO).filter(or_(FileDAO.checked==False, FileDAO.checked==None))
+        query = query.order_by(FileDAO.path, FileDAO.name)
         
-            for file in files:
-                Checksum.add(file)
-
-            q = Checksum._out
-            while not Checksum._in.empty():
-                file, result = Checksum._out.get()
-                if result: ok.append(file)
-                else: failed.append(file)
-
-            log.debug('Batch almost done...')
-            
-            Checksum.waitUntilFinished()
-
-            log.debug('Batch Finished, getting the last results.')
-            
-            while not Checksum._out.empty():
-                file, result = Checksum._out.get()
-                if result: ok.append(file)
-                else: failed.append(file)
-            
-            
-            log.debug('done ok:%s, failed:%s',len(ok), len(failed))
-
-            
-            for f in ok: f.checked = True
-            for f in failed:
-                if only_new: f.checked = True   #if these are new, we could have compared it to anything, so it's asumed to be ok
-                else: f.checked = False
-
-            #update session
-            self._session.commit()
-
-
-            ok_num += len(ok)
-            failed_num += len(failed)
-
-        Checksum.waitUntilFinished()
-
-        log.debug('Finished, getting the last ones')
+        #The next batch is hashed while the previous one is checked and committed. Batches are
+        #read after the last (path, name) seen, as checking them changes what the query returns.
+        executor = ChecksumExecutor(workers=workers, max_pending=batch_size)
+        skip_checksum = kwargs.get('skip_checksum', False)
+        last = None
+        previous = []
+        try:
+            while True:
+                if last:
+                    files = query.filter(or_(FileDAO.path > last[0], \
+                            and_(FileDAO.path == last[0], FileDAO.name > last[1])))[:batch_size]
+                else:
+                    files = query[:batch_size]
+                    if not files:
+                        #first time run and nothing to be done
+                        log.info("Nothing to do. Exiting")
+                        break
+                if files: last = (files[-1].path, files[-1].name)
+
+                batch = []
+                for file in files:
+                    if skip_checksum or not self.__sizeMatches(file): batch.append((file, None))
+                    else: batch.append((file, executor.submit(file.getLocalFile(), \
+                                                 algorithm=file.checksum_type or 'md5')))
+
+                ok, failed = self.__checkBatch(previous, only_new, **kwargs)
+                ok_num += ok
+                failed_num += failed
+                previous = batch
+                if not files: break
+        finally:
+            executor.shutdown(cancel_pending=True)
         
-        while not Checksum._out.empty():
-            file, result = Checksum._out.get()
-            if result: ok.append(file)
-            else: failed.append(file)
+        log.debug('TOTAL ok:%s, failed:%s',ok_num, failed_num)
+        if FileDAO.checksum_cache:
+            FileDAO.checksum_cache.commit()
+            FileDAO.checksum_cache.report(log)
         
-        for f in ok: f.checked = True
-        for f in failed: f.checked = False
+        return failed_num == 0
 
+    def __sizeMatches(self, file):
+        """True if the local file exists and has the size stored in the DB. Otherwise check()
+        rejects it without a checksum, so there's no point in hashing it."""
+        path = file.getLocalFile()
+        try:
+            return os.path.isfile(path) and os.path.getsize(path) == file.size
+        except OSError:
+            return False
+
+    def __checkBatch(self, batch, only_new, **kwargs):
+        """Check the files of batch, a list of (file, future with its checksum or None), and
+        commit the results. Returns the number of files ok and failed."""
+        ok = failed = 0
+        for file, future in batch:
+            if future is None:
+                result = file.check(**kwargs)
+            else:
+                try:
+                    result = file.check(checksum_value=future.result(), **kwargs)
+                except CancelledError:
+                    continue
+                except Exception as e:
+                    log.error('Could not check %s: %s', file.getLocalFile(), e)
+                    result = False
+            if result:
+                file.checked = True
+                ok += 1
+            else:
+                #if these are new, we could have compared it to anything, so it's asumed to be ok
+                file.checked = only_new
+                failed += 1
+        
         #update session
         self._session.commit()
+        if batch: log.debug('done ok:%s, failed:%s', ok, failed)
+        return ok, failed
 
-        ok_num += len(ok)
-        failed_num += len(failed)
-        
-        log.debug('TOTAL ok:%s, failed:%s',ok_num, failed_num)
-        Checksum.stop()
-        
-        return failed_num == 0
-
-    def updateFromDir(self, start_from=None, dryrun=False, cache=False):
+    def updateFromDir(self, start_from=None, dryrun=False, cache=False, workers=16, flush_size=5000):
         """Update DB with current files in a given directory structure. No md5 will be performed.
             start_from: start comparison from this subdir (might be absolute or relative to self.root)
                 if not given, starts from self.root
-            dryrun: just report differences, don't update DB."""
+            dryrun: just report differences, don't update DB.
+            workers: number of threads scanning directories.
+            flush_size: number of new files stored in the DB in a single transaction."""
         ## TODO: handle removing for directories
         ## this caching procedure works only with new files, if they are modifed it does not.
 
         self.open()
-        query = self._session.query(FileDAO)
 
         #define where to start looking for files (might differ from root!)
         if start_from:
@@ -377,77 +491,75 @@ class FileDB(DB):
         else: start_from = self.root
            
         results = DirectoryDAO._load(self) 
-
-
-        
+        #the scanning threads only see this, never the DAOs
+        known = dict([ (path, dir.mtime) for path, dir in results.items() ])
 
         missing = []
         partially_missing = []
-        unchanged = []
+        new_dirs = []
+        new_files = []
         offset = len(self.root) + 1
-        
-        dirs = [start_from]
-        while dirs:
-            dir = dirs.pop()
-            path = dir[offset:]
-            if path not in results:
-                #new
-                missing.append(DirectoryDAO(path=path, mtime=os.path.getmtime(dir)))
-                continue    #nothing more to be done
-            elif os.path.getmtime(dir) != results[path].mtime:
-                #something changed
-                results[path].mtime = os.path.getmtime(dir)
-                partially_missing.append(results[path])
-            else:
-                #nothing changed since last call
-                unchanged = results[path]
-
-            #get subdirs
-            for entry in os.listdir(dir):
-                abs = os.path.join(dir, entry)
-                if os.path.isdir(abs): dirs.append(abs)
 
+        #Directories are scanned concurrently (metadata operations on GPFS are latency bound);
+        #the DB is only touched from this thread.
+        tasks = Queue.Queue()
+        done = Queue.Queue()
+        def work():
+            while True:
+                task = tasks.get()
+                if task is None: break
+                try:
+                    done.put((task, _scanDir(task[0], task[1], task[2], known, offset, dryrun), None))
+                except Exception as e:
+                    done.put((task, None, e))
+        threads = []
+        for i in range(workers):
+            t = threading.Thread(target=work)
+            t.daemon = True
+            t.start()
+            threads.append(t)
 
-        log.info('Found %s new directories for. A total of %s may have changed.', len(missing), len(partially_missing))
-
-                    
-        if not dryrun:
-            new_files = []
+        try:
+            tasks.put((start_from, None, False))
+            outstanding = 1
             counter = 0
-            #theses are plain files missing
-            for dir in partially_missing:
-                for file in os.listdir(os.path.join(self.root, dir.path)):
-                    f = FileDAO(file=os.path.join(dir.path,file))
-                    f.updateFromLocalFile()
-                    new_files.append(f)
-
+            while outstanding:
+                task, result, error = done.get()
+                outstanding -= 1
+                if error:
+                    log.error('Could not scan %s: %s', task[0], error)
+                    continue
+                path, mtime, state, subdirs, files = result
+                for subdir in subdirs:
+                    tasks.put(subdir)
+                    outstanding += 1
+
+                if state == _DIR_NEW:
+                    if task[2]: new_dirs.append(DirectoryDAO(path=path, mtime=mtime))
+                    else: missing.append(DirectoryDAO(path=path, mtime=mtime))
+                elif state == _DIR_CHANGED:
+                    #something changed
+                    results[path].mtime = mtime
+                    partially_missing.append(results[path])
+
+                for name, size, file_mtime in files:
+                    new_files.append(FileDAO(path=path, name=name, size=size, mtime=file_mtime))
                     counter += 1
                     if counter > 100: 
                         print '.',
                         counter = 0
+                if not dryrun and len(new_files) >= flush_size:
+                    self.__flush(new_dirs, new_files)
+                    new_dirs, new_files = [], []
+        finally:
+            for t in threads: tasks.put(None)
+
+        log.info('Found %s new directories for. A total of %s may have changed.', len(missing), len(partially_missing))
 
-            #these are whole directory trees
-            for dir in missing:
-                for base, dirs, files in os.walk(os.path.join(self.root, dir.path)):
-                    for dir in dirs:
-                        #add all dirs to the cache
-                        self._session.add(DirectoryDAO(path=os.path.join(base[offset:],dir), mtime=os.path.getmtime(os.path.join(base, dir))))
-
-                    for file in files:
-                        #files might be empty
-                        f = FileDAO(file=os.path.join(base,file))
-                        f.updateFromLocalFile()
-                        log.debug('Updating: %s', f)
-                        new_files.append(f)
-
-                        counter += 1
-                        if counter > 100: 
-                            print ',',
-                            counter = 0
+        if not dryrun:
             #update cache
             self._session.add_all(missing)
-            self.addAll(new_files)
-
+            self.__flush(new_dirs, new_files)
         else:
             #produce a report
             print "New Directories: %s\nModified Directories: %s" % (len(missing), len(partially_missing))
@@ -457,7 +569,12 @@ class FileDB(DB):
             
         return partially_missing + missing 
 
-        
+    def __flush(self, dirs, files):
+        """Store new directories and files in a single transaction."""
+        if dirs: self._session.add_all(dirs)
+        if files: self.addAll(files)
+        else: self._session.commit()
+
     def getFromCMIP3Dataset(self, drs):
         self.open()
         return self._session.query(FileDAO).filter(FileDAO.path.like(drs.replace('.','/') + '%')).all()
@@ -580,6 +697,9 @@ Opt:
                       (can be relative to root or absolute)
     --report        : Report differences between DB and file system
                       (no checksumiming)
+    --checksum-cache <file>
+                    : Keep checksums of unchanged files in this sqlite file
+                      (default: ~/.esgcet/checksum_cache.db)
 
     -q          : quiet mode
     -v          : verbose mode
@@ -592,7 +712,7 @@ def main(argv=None):
  
     import getopt
     try:
-        args, lastargs = getopt.getopt(argv, "D:ucdvqh", ['help', 'source=', 'report', 'all'])
+        args, lastargs = getopt.getopt(argv, "D:ucdvqh", ['help', 'source=', 'report', 'all', 'checksum-cache='])
     except getopt.error:
         print sys.exc_info()[:3]
         return 1
@@ -601,12 +721,15 @@ def main(argv=None):
     db_name = 'files.db'
     root = '.'
     source = None
+    import checksum_cache
+    cache_file = checksum_cache.DEFAULT_DB_FILE
     update = check = all = report = False
     #parse arguments
     for flag, arg in args:
         if flag=='-D':              db_name = arg
         elif flag=='--source':      source = arg
         elif flag=='--report':      report = True
+        elif flag=='--checksum-cache':  cache_file = arg
         elif flag=='-u':            update = True
         elif flag=='-c':            check = True
 
@@ -627,7 +750,7 @@ def main(argv=None):
     if ( update or check ) and  not root:
         raise Excpetion('You have to define a root (-r)')
 
-    db = FileDB('sqlite:///%s' % db_name, root)    
+    db = FileDB('sqlite:///%s' % db_name, root, checksum_cache=checksum_cache.getCache(cache_file))
 
     if update:
         db.updateFromDir(start_from=source)
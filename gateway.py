@@ -5,11 +5,11 @@ import xml.dom.minidom
 import logging 
 glog = logging.getLogger('gateway')
 import re
-import urllib2
+import urllib2, httplib, urlparse
 import sys, getopt, drs, os.path
 from pyesgf.search.connection import SearchConnection
-from timeout import *  # usage: decorate a function with "@timed_out(4)" for a 4-second timeout
-import socket
+from timeout import TimedOutExc
+import socket, threading, Queue, errno
 
 glog.addHandler( logging.FileHandler('gateway.log') )
 
@@ -24,6 +24,7 @@ version_name_pat = re.compile("^.*version=v?([0-9]+)")
 # adapted from
 # http://skyl.org/log/post/skyl/2010/04/remove-insignificant-whitespace-from-xml-string-with-python/
 from StringIO import StringIO
+from io import BytesIO
 from lxml import etree
 def fix_readable_xml(dirty_xml):
     # Recently (as of Sept 2012) NCAR changed its xml files to be human-readable.
@@ -80,6 +81,66 @@ def listCollections_P2P(index_node_url):
    collections = [collection_of_all]
    return collections
 
+def _callWithTimeout(timeout, f, *args):
+    """Calls f(*args) in a separate thread, waiting at most timeout seconds for it to return.
+    Unlike the timed_out decorator (SIGALRM) this works in any thread and doesn't change any
+    process-wide state. A call which times out is abandoned, its thread finishes on its own."""
+    result = []
+    def run():
+        try:
+            result.append((True, f(*args)))
+        except Exception as e:
+            result.append((False, e))
+    t = threading.Thread(target=run)
+    t.daemon = True
+    t.start()
+    t.join(timeout)
+    if not result: raise TimedOutExc()
+    ok, value = result[0]
+    if not ok: raise value
+    return value
+
+_esg = '{http://www.earthsystemgrid.org/}'
+_dataset_tag = _esg + 'dataset'
+_file_tag = _esg + 'file'
+_capability_tag = _esg + 'data_access_capability'
+_access_tag = _esg + 'file_access_point'
+_checksum_tag = _esg + 'checksum'
+
+def _iterparse(xml_ans, tags, attributes_only=False):
+    """Parses a gateway answer in a single pass with lxml, instead of building a DOM.  Yields
+    (element, depth, branch) for each element with one of the given (namespaced) tags as soon as
+    it's complete; depth is 1 for the root and branch tells which child of the root the element
+    is in (1 for the first).  With attributes_only, elements are yielded as soon as their
+    attributes are known, i.e. in document order as a DOM would list them.  An element (and
+    whatever came before it) is freed once it's complete, so the caller must be done with it
+    by then."""
+    if isinstance(xml_ans, unicode): xml_ans = xml_ans.encode('utf-8')
+    depth = branch = 0
+    for event, elem in etree.iterparse(BytesIO(xml_ans), events=('start', 'end')):
+        if event == 'start':
+            depth += 1
+            if depth == 2: branch += 1
+            if attributes_only and elem.tag in tags: yield elem, depth, branch
+            continue
+        if elem.tag in tags:
+            if not attributes_only: yield elem, depth, branch
+            elem.clear()
+            while elem.getprevious() is not None:
+                del elem.getparent()[0]
+        depth -= 1
+
+def _datasetDict(ds):
+    """dict describing a dataset element of a gateway answer"""
+    #DRS conform:
+    mo = version_uri_pat.match(ds.get('source_catalog_uri', ''))
+    #ESG publication name conform
+    if not mo: version_name_pat.match(ds.get('name', ''))
+    if mo: version = mo.group(1)
+    else: version = None
+    return { 'name' : ds.get('name', ''), 'id' : ds.get('id', ''), 'state' : ds.get('state', ''),
+             'catalog' : ds.get('source_catalog_uri', ''), 'version' : version }
+
 class Gateway(object):
     """Encapsulates Gateway access, and Peer-to-Peer server access"""
     
@@ -90,33 +151,65 @@ class Gateway(object):
     _att = lambda node, att: node.getAttribute(att)
 
     def __attToDict(self, node):
+        """attributes of a minidom node or an lxml element"""
         res = {}
-        for i in range(node.attributes.length):
-            att = node.attributes.item(i)
+        if hasattr(node, 'attrib'): atts = node.attrib.items()
+        else: atts = [ (node.attributes.item(i).name, node.attributes.item(i).value) \
+                       for i in range(node.attributes.length) ]
+        for name, value in atts:
             #workaround
-            if att.name == "MD5":
+            if name == "MD5":
                 res['checksum_type'] = 'md5'
-                res['checksum_value'] = att.value
+                res['checksum_value'] = value
             else:
-                res[att.name] = att.value
+                res[name] = value
         return res
         
 
-    def __init__(self, url, hessian_service='remote/hessian/guest/remoteMetadataService'):
+    def __init__(self, url, hessian_service='remote/hessian/guest/remoteMetadataService', timeout=480):
+        """timeout: seconds to wait for the answer to a single call (8 minutes by default)"""
+        self._timeout = timeout
+        self._http = None   #kept-alive connection for the REST calls
         if url==None:
             self._url = url
         else:
             self._url = url.rstrip('/')
-            self._service = Hessian('/'.join([self._url, hessian_service]))
+            self._hessian_url = '/'.join([self._url, hessian_service])
+            self._service = Hessian(self._hessian_url)
+
+    def __restGet(self, method, headers=None):
+        """GET <url>/method over a persistent connection to the gateway."""
+        surl = '/'.join([self._url, method])
+        parsed = urlparse.urlparse(surl)
+        for attempt in range(2):
+            if self._http is None:
+                if parsed.scheme == 'https': self._http = httplib.HTTPSConnection(parsed.netloc, timeout=self._timeout)
+                else: self._http = httplib.HTTPConnection(parsed.netloc, timeout=self._timeout)
+            try:
+                self._http.request('GET', parsed.path, headers=headers or {})
+                response = self._http.getresponse()
+                data = response.read()
+            except (httplib.HTTPException, socket.error) as e:
+                self._http.close()
+                self._http = None
+                #the server might have closed the connection we kept; try once more with a new one.
+                #Timeouts are not retried, a hung gateway would just hang again.
+                stale = isinstance(e, httplib.BadStatusLine) or \
+                        (not isinstance(e, socket.timeout) and \
+                         getattr(e, 'errno', None) in (errno.ECONNRESET, errno.EPIPE))
+                if attempt or not stale: raise
+                continue
+            if response.status >= 400:
+                raise urllib2.HTTPError(surl, response.status, response.reason, response.msg, None)
+            return data
 
-    @timed_out(480)    # 8-minute timeout
     def __contactGateway(self, method, *args, **kwargs):
         """Encapsulate the Gateway call, so we can change it more easily"""
         #default is hessian
         if 'restFull' in kwargs:
             surl = '/'.join([self._url, method])
             try:
-                url = urllib2.urlopen(surl,None,60)
+                return self.__restGet(method, kwargs.get('restHeaders'))
             except urllib2.HTTPError as e:
                 # not helpful with NCI problem: print e.read()
                 print "In __contactGateway opening",surl,", exception",e
@@ -124,14 +217,12 @@ class Gateway(object):
             except Exception as e:
                 print "In __contactGateway opening",surl,", exception",e
                 raise e
-            if 'restHeaders' in kwargs: url.headers.dict.update(kwargs['restHeaders'])
-            return url.read()
         else:
             try:
                 if method=="getDatasetFiles":
                     glog.debug( "in contactGateway %s %s" % ( self._url, args ) )
                     glog.debug( "about to call getattr(%s,%s)(%s)",self._service,method,*args )
-                result = getattr(self._service, method)(*args)
+                result = _callWithTimeout(self._timeout, getattr(self._service, method), *args)
                 # glog.debug( "from contactGateway, returning %s", result )
                 # normally: return getattr(self._service, method)(*args)
                 return result
@@ -145,36 +236,32 @@ class Gateway(object):
             except TimedOutExc as e:
                 print "__contactGateway timed out contacting", self._url
                 glog.error("timed out contacting %s", self._url)
+                #the abandoned call may still be using the old proxy
+                self._service = Hessian(self._hessian_url)
                 return None
 
     def __getRest(self, service, headers=None):
-        url = urllib2.urlopen('/'.join([self._url, service]))
-        if headers is not None: url.headers.dict.update(headers)
-        return url.read()
+        return self.__restGet(service, headers)
+
+    def __isReadableXml(self):
+        """True for the gateways serving human-readable xml, see fix_readable_xml()"""
+        return self._url.find('earthsystemgrid.org')>-1 or self._url.find('ncar.gov')>=1 or\
+               self._url.find('ucar.edu')>-1
 
     def getMetadata(self, parent, xml_only=False):
         """List dataset metadata from gateway."""
         xml_ans = self.__contactGateway('getDatasetMetadata', parent)
-        if self._url.find('earthsystemgrid.org')>-1 or self._url.find('ncar.gov')>=1 or\
-           self._url.find('ucar.edu')>-1 :
-            xml_ans = fix_readable_xml( xml_ans )
-        if xml_only: return xml_ans
+        if xml_only:
+            if xml_ans is not None and self.__isReadableXml(): xml_ans = fix_readable_xml( xml_ans )
+            return xml_ans
         if xml_ans is None: return None
 
         result = None
 
-        # parse answer into dom object
-        dom = xml.dom.minidom.parseString(xml_ans)
         #The requested dataset is also returned, go to it before looking into its children.
-        for ds in dom.firstChild.getElementsByTagNameNS(Gateway.esg_ns, 'dataset'):
-            #DRS conform:
-            mo = version_uri_pat.match(ds.getAttribute('source_catalog_uri'))
-            #ESG publication name conform
-            if not mo: version_name_pat.match(ds.getAttribute('name'))
-            if mo: version = mo.group(1)
-            else: version = None
-            result = { 'name' : ds.getAttribute('name'), 'id' : ds.getAttribute('id'), 'state' : ds.getAttribute('state')
-            ,'catalog' : ds.getAttribute('source_catalog_uri'), 'version' : version}
+        for ds, depth, branch in _iterparse(xml_ans, [_dataset_tag], attributes_only=True):
+            if depth < 2: continue
+            result = _datasetDict(ds)
 
         return result
 
@@ -201,41 +288,21 @@ class Gateway(object):
         """List all Datasets depending on the given parent."""
         if self._url==None: return []
         xml_ans = self.__contactGateway('getDatasetHierarchy', parent)
-        if self._url.find('earthsystemgrid.org')>-1 or self._url.find('ncar.gov')>=1 or\
-           self._url.find('ucar.edu')>-1 :
-            xml_ans = fix_readable_xml( xml_ans )
-        if xml_only: return xml_ans
+        if xml_only:
+            if xml_ans is not None and self.__isReadableXml(): xml_ans = fix_readable_xml( xml_ans )
+            return xml_ans
         if xml_ans is None: return None
 
         result = []
 
-        # parse answer into dom object
-        dom = xml.dom.minidom.parseString(xml_ans)
-        #The requested dataset is also returned, go to it before looking into its children.
-        domcc = dom.firstChild.firstChild
-        # jfp Sept 2012: ...This domcc works for normal gateways.  But NCAR's XML files now
-        # have extra whitespace, which adds readability and also adds superfluous elements
-        # once parsed:  The whitespace is parsed as text nodes each of whose data contents
-        #is a string of whitespace.  The attribute isWhitespaceInElementContent cannot be
-        # relied on (in tests, it's false even when it should be true).
-        # So, here's a quick-and-dirty workaround:
-        # probably this section is no longer needed,now that fix_readable_xml is called
-        #if self._url.find('earthsystemgrid.org')>-1 or self._url.find('ncar.gov')>=1 or\
-        #   self._url.find('ucar.edu')>-1 :
-        #    domc = dom.firstChild
-        #    if hasattr( domc.childNodes[0],'getElementsByTagNameNS'):
-        #        domcc = domc.firstChild
-        #    else:
-        #        domcc = domc.childNodes[1]
-        for ds in domcc.getElementsByTagNameNS(Gateway.esg_ns, 'dataset'):
-            #DRS conform:
-            mo = version_uri_pat.match(ds.getAttribute('source_catalog_uri'))
-            #ESG publication name conform
-            if not mo: version_name_pat.match(ds.getAttribute('name'))
-            if mo: version = mo.group(1)
-            else: version = None
-            result.append({ 'name' : ds.getAttribute('name'), 'id' : ds.getAttribute('id'), 'state' : ds.getAttribute('state'), 'version' : version,
-                        'catalog':ds.getAttribute('source_catalog_uri'), 'parent': parent})
+        #The requested dataset is also returned (as the first child of the root), only its
+        #children are wanted.  Whitespace added for readability (see fix_readable_xml) doesn't
+        #matter here, we only look at elements.
+        for ds, depth, branch in _iterparse(xml_ans, [_dataset_tag], attributes_only=True):
+            if depth < 3 or branch != 1: continue
+            ds = _datasetDict(ds)
+            ds['parent'] = parent
+            result.append(ds)
 
         return result
         
@@ -244,42 +311,36 @@ class Gateway(object):
         
         if self._url==None: return []
         xml_ans = self.__contactGateway('getDatasetFiles', dataset)
-        if self._url.find('earthsystemgrid.org')>-1 or self._url.find('ncar.gov')>=1 or\
-           self._url.find('ucar.edu')>-1 :
-            xml_ans = fix_readable_xml( xml_ans )
-        if xml_only: return xml_ans
+        if xml_only:
+            if xml_ans is not None and self.__isReadableXml(): xml_ans = fix_readable_xml( xml_ans )
+            return xml_ans
         if xml_ans is None: return None
 
-
-        # parse answer into dom object
-        dom = xml.dom.minidom.parseString(xml_ans)
+        # single pass over the answer; the endpoints are resolved at the end, as their description
+        # might come after the files.
         endpoints_desc = {}
-        for endpoints in dom.getElementsByTagNameNS(Gateway.esg_ns, 'data_access_capability'):
-            endpoints_desc[endpoints.getAttribute('name')] = { 'type' : endpoints.getAttribute('type'), 'base_uri' : endpoints.getAttribute('base_uri')}
+        raw_files = []
+        for elem, depth, branch in _iterparse(xml_ans, [_capability_tag, _file_tag]):
+            if elem.tag == _capability_tag:
+                endpoints_desc[elem.get('name')] = { 'type' : elem.get('type', ''), 'base_uri' : elem.get('base_uri', '')}
+                continue
+            #get file metadata
+            atts = self.__attToDict(elem)
+            access = [ (ep.get('data_access_capability', ''), ep.get('uri', '')) \
+                       for ep in elem.iter(_access_tag) ]
+            checksums = [ (ck.get('algorithm', '').lower(), ck.get('value', '')) \
+                          for ck in elem.iter(_checksum_tag) ]
+            raw_files.append((atts, access, checksums))
             
         print "jfp ",self._url," no. endpoints=",len(endpoints_desc)
-        #if len(endpoints_desc)<=0:
-            # dom.firstChild.removeChild(dom.firstChild.firstChild)
-            # for endpoints in dom.getElementsByTagNameNS(Gateway.esg_ns, 'data_access_capability'):
-            #     endpoints_desc[endpoints.getAttribute('name')] = { 'type' : endpoints.getAttribute('type'), 'base_uri' : endpoints.getAttribute('base_uri')}
-            # print "jfp elements with tag data_access_capability:",\
-            #      dom.getElementsByTagNameNS(Gateway.esg_ns, 'data_access_capability')
-            # print "jfp xml_ans=",xml_ans
-            # print "jfp dom=",dom.toprettyxml()
-            # for node in dom.firstChild.childNodes:
-            #   print "jfp dom node=",node.toprettyxml()
         files = []
-        for file in dom.getElementsByTagNameNS(Gateway.esg_ns, 'file'):
-            #get file metadata
-            atts = self.__attToDict(file)
+        for atts, access, checksums in raw_files:
             atts['endpoints'] = []
-            
 
             #get endpoint metadata (complete url with base name)
             path = None
-            for ep in file.getElementsByTagNameNS(Gateway.esg_ns, 'file_access_point'):
-                name = ep.getAttribute('data_access_capability')  #e.g. "HTTPServer"
-                url = endpoints_desc[name]['base_uri'] + ep.getAttribute('uri')
+            for name, uri in access:     #name e.g. "HTTPServer"
+                url = endpoints_desc[name]['base_uri'] + uri
 
                 #we expect to get a cmip5 DRS conform structure
                 mo = url_pat.match(url)
@@ -301,8 +362,7 @@ class Gateway(object):
             atts['path'] = path
             #get the checksum info if present
             tmp_chksum = None
-            for ep in file.getElementsByTagNameNS(Gateway.esg_ns, 'checksum'):
-                tmp_chksum = (ep.getAttribute('algorithm').lower(), ep.getAttribute('value')) 
+            for tmp_chksum in checksums:
                 #if possible get the md5
                 if tmp_chksum[0] == 'md5': break
             if tmp_chksum:
@@ -516,6 +576,152 @@ for g in P2PS:
     P2PS[g]['name'] = g
     P2PS[g]['server'] = name.match(P2PS[g]['url']).group(1)
 
+def resolveGateway(gateway):
+    """Url of a gateway given by name (see GW) or server name, None if it's not known."""
+    if gateway.find('.') != -1:
+        #probably a server name, see if we know it
+        for g in GW:
+            if GW[g]['server'] == gateway:
+                gateway = g
+                break
+    if gateway in GW: return GW[gateway]['url']
+    return None
+
+class GatewayRequest(object):
+    """A call to a gateway submitted to a GatewayClient."""
+    def __init__(self, gateway, method, *args):
+        self.gateway = gateway
+        self.method = method
+        self.args = args
+        self._done = threading.Event()
+        self._result = self._error = None
+
+    def _finish(self, result, error):
+        self._result, self._error = result, error
+        self._done.set()
+
+    def done(self):
+        return self._done.isSet()
+
+    def result(self, timeout=None):
+        """Waits (at most timeout seconds) for the call to complete and returns its result.
+        Raises whatever the call raised, or TimedOutExc."""
+        self._done.wait(timeout)
+        if not self._done.isSet(): raise TimedOutExc()
+        if self._error is not None: raise self._error
+        return self._result
+
+class GatewayClient(object):
+    """Programmatic access to gateways, e.g. to get the files of many datasets, without going
+    through main() with a command line per call.  Calls are run by a bounded pool of threads;
+    each thread has its own Gateway per server, so connections are reused for all its calls.
+    Calls time out after timeout seconds, without signals (see Gateway).
+    Usage:
+        client = GatewayClient(workers=4)
+        files = client.listFiles('PCMDI', dataset_name)
+        request = client.submit('PCMDI', 'getMetadata', dataset_name)
+        ...
+        metadata = request.result()
+        #or, for a list of calls known in advance:
+        remote = client.prefetch([('PCMDI', 'listFiles', name) for name in names], ahead=8)
+        for name in names: files = remote.get('PCMDI', 'listFiles', name)
+        client.close()"""
+
+    def __init__(self, workers=4, timeout=480, max_pending=None):
+        self.timeout = timeout
+        self._requests = Queue.Queue(max_pending or 4*workers)
+        self._threads = []
+        for i in range(workers):
+            t = threading.Thread(target=self._work)
+            t.daemon = True
+            t.start()
+            self._threads.append(t)
+
+    def _work(self):
+        gateways = {}   #url -> Gateway of this thread
+        while True:
+            request = self._requests.get()
+            if request is None: break
+            try:
+                url = resolveGateway(request.gateway)
+                if url is None: raise Exception("Unknown Gateway {0}".format(request.gateway))
+                if url not in gateways: gateways[url] = Gateway(url, timeout=self.timeout)
+                result = getattr(gateways[url], request.method)(*request.args)
+            except Exception as e:
+                glog.error("%s%s at %s failed: %s", request.method, request.args, request.gateway, e)
+                request._finish(None, e)
+            else:
+                request._finish(result, None)
+
+    def submit(self, gateway, method, *args):
+        """Queue a call of a Gateway method (e.g. 'listFiles', 'getMetadata', 'listDatasets') and
+        return its GatewayRequest. Blocks while too many requests are waiting."""
+        request = GatewayRequest(gateway, method, *args)
+        self._requests.put(request)
+        return request
+
+    def call(self, gateway, method, *args):
+        """The result of the call, or None if it failed (as the Gateway methods do)."""
+        try:
+            return self.submit(gateway, method, *args).result()
+        except Exception:
+            return None
+
+    def getMetadata(self, gateway, parent):
+        return self.call(gateway, 'getMetadata', parent)
+
+    def listFiles(self, gateway, dataset):
+        return self.call(gateway, 'listFiles', dataset)
+
+    def listDatasets(self, gateway, parent):
+        return self.call(gateway, 'listDatasets', parent)
+
+    def prefetch(self, calls, ahead=8):
+        """Returns a Prefetcher for calls, a list of (gateway, method, arg)."""
+        return Prefetcher(self, calls, ahead)
+
+    def close(self):
+        for t in self._threads: self._requests.put(None)
+        self._threads = []
+
+class Prefetcher(object):
+    """Results of a list of calls expected to be needed in that order. Up to ahead of them are
+    running (or done) before they are asked for, so the caller doesn't wait for the network
+    while it works on the previous results."""
+
+    def __init__(self, client, calls, ahead=8):
+        self._client = client
+        self._calls = list(calls)
+        self._ahead = ahead
+        self._position = dict([ (c, i) for i, c in enumerate(self._calls) ])
+        self._next = 0       #next call to be submitted
+        self._pending = {}   #call -> GatewayRequest
+        self._fill()
+
+    def _fill(self):
+        while len(self._pending) < self._ahead and self._next < len(self._calls):
+            call = self._calls[self._next]
+            self._next += 1
+            if call not in self._pending: self._pending[call] = self._client.submit(*call)
+
+    def get(self, gateway, method, arg):
+        """The result of the call (None if it failed). Calls listed before this one which were
+        never asked for are dropped; calls which weren't listed are made right away."""
+        call = (gateway, method, arg)
+        position = self._position.get(call)
+        if position is not None:
+            for c in self._pending.keys():
+                if self._position[c] < position: del self._pending[c]
+            self._next = max(self._next, position)
+            self._fill()
+        request = self._pending.pop(call, None)
+        if request is None: request = self._client.submit(*call)
+        self._fill()
+        try:
+            return request.result()
+        except Exception:
+            return None
+
 usage="""gateway.py [opt]
 Opt:
     -h, --help  : show this help
@@ -1,7 +1,7 @@
 #!/usr/apps/esg/cdat6.0a/bin/python
 #jfp was #!/usr/local/cdat/bin/python
 
-import subprocess, pprint
+import subprocess, pprint, sys, os, time, shlex, sqlite3, threading, Queue, urlparse
 
 # logging setup added by jfp
 import logging
@@ -10,6 +10,10 @@ log.addHandler( logging.FileHandler('globus.log') )
 
 pp = pprint.PrettyPrinter()
 
+DEFAULT_CACHE_FILE = os.path.expanduser('~/.esgcet/globus_listings.db')
+DEFAULT_MAX_AGE = 24 * 3600     #seconds a cached listing is used before listing the directory again
+LIST_CMD = ['globus-url-copy', '-list']
+
 usage="""globus.py [opt] 
 
     --list          : list datasets (default action)
@@ -20,10 +24,17 @@ opt:
     --max-procs <nr>: Nr. of max parallel processes to use (default = 10)
     --components <nr> : Nr. of components to retrieve (starting from --dataset, default: 9 or 8 if --no-version)
     --no-version  : skip version and list just datasets
+    --cache <file>  : listing cache to use (default: %s)
+    --no-cache      : neither use nor update the listing cache
+    --max-age <hrs> : list again directories whose cached listing is older than this (default: %d)
+    --refresh       : drop the cached listings below the starting directory before listing
+    --list-cmd <cmd>: command listing a url as globus-url-copy -list does (default: %s)
+                      e.g. "globus.py --local-list" to crawl a file:// repo offline
+    --local-list <url>: list the local directory of a file:// url as globus-url-copy -list does
     -q          : quiet mode
     -v          : verbose mode
     -d          : debug mode
-"""
+""" % (DEFAULT_CACHE_FILE, DEFAULT_MAX_AGE/3600, ' '.join(LIST_CMD))
 def main(argv=None):
     import getopt
 
@@ -31,7 +42,7 @@ def main(argv=None):
 
     try:
         args, lastargs = getopt.getopt(argv, "hdvq", ['help', 'dataset=', 'repo=', 'list', 'max-procs=', 'no-version',
-            'components=', 'list-raw'])
+            'components=', 'list-raw', 'cache=', 'no-cache', 'max-age=', 'refresh', 'list-cmd=', 'local-list='])
     except getopt.error:
         print sys.exc_info()[:3]
         return 1
@@ -44,6 +55,10 @@ def main(argv=None):
     dataset = None
     max_procs = 10
     components = None
+    cache_file = DEFAULT_CACHE_FILE
+    max_age = DEFAULT_MAX_AGE
+    refresh = False
+    list_cmd = LIST_CMD
 
     #parse arguments
     for flag, arg in args:
@@ -65,10 +80,23 @@ def main(argv=None):
         elif flag=='--max-procs':       max_procs = int(arg)
         elif flag=='--no-version':      version = False
         elif flag=='--components':      components = int(arg)
+        elif flag=='--cache':           cache_file = arg
+        elif flag=='--no-cache':        cache_file = None
+        elif flag=='--max-age':         max_age = float(arg) * 3600
+        elif flag=='--refresh':         refresh = True
+        elif flag=='--list-cmd':        list_cmd = shlex.split(arg)
+        elif flag=='--local-list':
+            sys.stdout.write(local_listing(arg))
+            return 0
     
 
-
-    g = globus(max_procs=max_procs)
+    cache = None
+    if cache_file: cache = ListingCache(cache_file, max_age=max_age)
+    g = globus(max_procs=max_procs, list_cmd=list_cmd, cache=cache)
+    if refresh and cache:
+        start = g.get_repo_url(repo)
+        if start and dataset: start += dataset.replace('.', '/') + '/'
+        if start: cache.invalidate(start)
 
     if show_list:
         if dataset:
@@ -90,8 +118,80 @@ def main(argv=None):
         for dir in dirs:
             print dir
 
+    if cache: cache.close()
     return 0
 
+def local_listing(url):
+    """Lists the local directory of a file:// url as globus-url-copy -list would: the url, then an
+    indented line per entry (directories with a trailing slash), then an empty line.
+    This is a stand-in for globus-url-copy, to try the crawler offline (see --list-cmd)."""
+    path = urlparse.urlparse(url).path
+    if url[-1] != '/': url += '/'
+    lines = [url]
+    for entry in sorted(os.listdir(path)):
+        if os.path.isdir(os.path.join(path, entry)): entry += '/'
+        lines.append('    ' + entry)
+    return '\n'.join(lines) + '\n\n'
+
+class ListingCache(object):
+    """Persistent (sqlite) cache of the directory listings made by globus.find, so that repeated
+    crawls of a repo only list what they haven't listed recently.  Listings are kept per directory
+    url, along with the repo (scheme://host:port/) for clear().  A listing older than max_age
+    seconds is listed again; if a subdirectory is gone from the new listing, everything cached
+    below it is dropped too.  invalidate() does the same for a given directory."""
+
+    def __init__(self, db_file=DEFAULT_CACHE_FILE, max_age=DEFAULT_MAX_AGE):
+        dir = os.path.dirname(db_file)
+        if dir and not os.path.isdir(dir): os.makedirs(dir)
+        self.db_file = db_file
+        self.max_age = max_age
+        self._conn = sqlite3.connect(db_file)
+        self._conn.text_factory = str
+        self._conn.execute('CREATE TABLE IF NOT EXISTS listings (url TEXT PRIMARY KEY, repo TEXT, '
+                           'listed_at REAL, entries TEXT)')
+        self._conn.execute('CREATE INDEX IF NOT EXISTS listings_repo ON listings (repo)')
+        self.hits = self.misses = 0
+
+    @staticmethod
+    def repo_of(url):
+        parts = urlparse.urlparse(url)
+        return '%s://%s/' % (parts.scheme, parts.netloc)
+
+    def get(self, url):
+        """Returns the cached listing (list of urls) of the directory url, or None if there is none
+        recent enough."""
+        row = self._conn.execute('SELECT listed_at, entries FROM listings WHERE url=?', (url,)).fetchone()
+        if row is None or (self.max_age is not None and time.time() - row[0] > self.max_age):
+            self.misses += 1
+            return None
+        self.hits += 1
+        return row[1].split('\n')
+
+    def put(self, url, entries):
+        """Stores the listing of url; cached subtrees of subdirectories no longer listed are dropped."""
+        old = self._conn.execute('SELECT entries FROM listings WHERE url=?', (url,)).fetchone()
+        if old is not None:
+            for gone in set(old[0].split('\n')) - set(entries):
+                if gone != url: self.invalidate(gone, commit=False)
+        self._conn.execute('INSERT OR REPLACE INTO listings VALUES (?,?,?,?)',
+                           (url, self.repo_of(url), time.time(), '\n'.join(entries)))
+        self._conn.commit()
+
+    def invalidate(self, url, commit=True):
+        """Drops the cached listing of the directory url and everything below it."""
+        if url[-1] != '/': url += '/'
+        self._conn.execute('DELETE FROM listings WHERE substr(url, 1, ?)=?', (len(url), url))
+        if commit: self._conn.commit()
+
+    def clear(self, repo):
+        """Drops all cached listings of a repo (any url in it will do)."""
+        self._conn.execute('DELETE FROM listings WHERE repo=?', (self.repo_of(repo),))
+        self._conn.commit()
+
+    def close(self):
+        log.info('listing cache: %d hits, %d misses', self.hits, self.misses)
+        self._conn.close()
+
 class globus(object):
     _err = None
     repos = { 
@@ -102,8 +202,12 @@ class globus(object):
         'nci'   : 'gsiftp://esgnode1.nci.org.au:2812//',
         'ncar'  : 'gsiftp://vetsman.ucar.edu:2811//datazone/' }
     
-    def __init__(self, max_procs=10):
+    def __init__(self, max_procs=10, list_cmd=LIST_CMD, cache=None):
+        """max_procs listings run at once; list_cmd is the listing command, to which a url is
+        appended; cache is a ListingCache, or None to always list."""
         self.max_procs = max_procs
+        self.list_cmd = list_cmd
+        self.cache = cache
         self._err = []
     
     def __parse_globus_listing(self, answer):
@@ -115,8 +219,24 @@ class globus(object):
         else: #jfp
             return [base]
         
+    def __lister(self, tasks, results):
+        """Worker thread: runs the listing command for each url taken from tasks, and puts
+        (url, depth, returncode, stdout, stderr) on results."""
+        while True:
+            task = tasks.get()
+            if task is None: return
+            url, depth = task
+            try:
+                proc = subprocess.Popen(self.list_cmd + [url], stdout=subprocess.PIPE, stderr=subprocess.PIPE)
+                out, err = proc.communicate()
+                results.put((url, depth, proc.returncode, out, err))
+            except Exception, e:
+                results.put((url, depth, -1, '', str(e)))
+
     def find(self, start, max_depth):
-        """Grabs the subdirectories of a gridFTP server by listing its contents in parallel."""
+        """Grabs the subdirectories of a gridFTP server by listing its contents in parallel.
+        Up to max_procs listings run at once, and each one is handled as soon as it finishes.
+        Directories with a recent enough listing in the cache aren't listed again."""
         if max_depth <= 0:
             return [start]
         #globus requires an ending slash
@@ -124,53 +244,60 @@ class globus(object):
         
         to_scan = [(start, max_depth - 1)]
         done = []
-        procs = []
-        
-        while to_scan or procs:
-            if to_scan:
-                start, depth = to_scan.pop()
-                procs.append((subprocess.Popen(['globus-url-copy', '-list', start], stdout=subprocess.PIPE, stderr=subprocess.PIPE), start, depth))
-            
-            #should we wait for a free slot?
-            if len(procs) >= self.max_procs:
-                #take the first out and process
-                proc, loc, proc_depth = procs[0]
-                procs = procs[1:]
-                
-                #if it's not ready wait for it
-                if proc.wait() != 0:
-                    self._err.append((loc, proc.communicate()[1]))
-                else:
-                    list = self.__parse_globus_listing(proc.communicate()[0])
-                    #check if we are done
-                    if proc_depth <= 0:
-                        #done! Prepare list for retrieval
-                        done.extend(list)
-                    else:
-                        #go one level deeper
-                        to_scan.extend([(l, proc_depth - 1) for l in list])
-            elif not to_scan:
-                #nothing to do, so wait for one to be ready
-                proc, loc, proc_depth = procs[0]
-                procs = procs[1:]
-                
-                if proc.wait() != 0:
-                    self._err.append((loc, proc.communicate()[1]))
-                else:
-                    list = self.__parse_globus_listing(proc.communicate()[0])
-                    #check if we are done
-                    if proc_depth <= 0:
-                        #done! Prepare list for retrieval
-                        done.extend(list)
-                    else:
-                        #go one level deeper
-                        to_scan.extend([(l, proc_depth - 1) for l in list])
+        listed = {}     #listings made or read during this call
+        tasks = Queue.Queue()
+        results = Queue.Queue()
+        workers = []
+        running = 0
+
+        def handle(list, depth):
+            #check if we are done
+            if depth <= 0:
+                #done! Prepare list for retrieval
+                done.extend(list)
+            else:
+                #go one level deeper
+                to_scan.extend([(l, depth - 1) for l in list])
+
+        try:
+            while to_scan or running:
+                while to_scan:
+                    loc, depth = to_scan.pop()
+                    list = listed.get(loc)
+                    if list is None and self.cache: list = self.cache.get(loc)
+                    if list is not None:
+                        listed[loc] = list
+                        handle(list, depth)
+                        continue
+                    if len(workers) < self.max_procs:
+                        worker = threading.Thread(target=self.__lister, args=(tasks, results))
+                        worker.daemon = True
+                        worker.start()
+                        workers.append(worker)
+                    tasks.put((loc, depth))
+                    running += 1
+                if not running: break
+
+                #take whichever listing finishes first
+                loc, depth, returncode, out, err = results.get()
+                running -= 1
+                if returncode != 0:
+                    self._err.append((loc, err))
+                    log.debug('listing %s failed: %s', loc, err)
+                    continue
+                list = self.__parse_globus_listing(out)
+                listed[loc] = list
+                if self.cache: self.cache.put(loc, list)
+                handle(list, depth)
+        finally:
+            for worker in workers: tasks.put(None)
+            for worker in workers: worker.join()
         return done
 
     def get_repo_url(self, repo):
         """Return the url of the repo, None if unknown or the repo string
             itself if it's already an url"""
-        if repo.startswith('gsiftp://'):
+        if repo.startswith('gsiftp://') or repo.startswith('file://'):
             #globus requires this and we need to count it to be consistent
             if repo[-1] != '/': repo += '/'
             return repo
@@ -203,7 +330,6 @@ or define it using gsiftp://...)" % (repo, self.repos.keys())
 if __name__ == '__main__':
     #configure logging
 
-    import sys
     result=main(None)
     if result != 0: print usage
     sys.exit(result)
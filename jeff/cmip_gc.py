@@ -32,14 +32,15 @@
 # should be deleted.
 # Note that any file in an unexpected location will be "possibly bad".
 
-import os, shutil, glob, sys, re
+import os, shutil, glob, sys, re, errno
+from multiprocessing.pool import ThreadPool
 import sqlalchemy
 from esgcet.config import loadConfig
 from sqlalchemy import sql
 from pprint import pprint
 
-goodfiles = []
-badfiles = []
+goodfiles = set()
+badfiles = set()
 whys = { 'good':0,
          'not in database, but there is no known later version':0,
          'not in database, obsolete, have latest version':0,
@@ -50,39 +51,76 @@ whys = { 'good':0,
          }
 
 def listgood( filename ):
-    global badfiles
-    goodfiles.append(filename)
-    if filename in badfiles: badfiles.remove(filename)
+    goodfiles.add(filename)
+    badfiles.discard(filename)
     whys['good'] += 1
 
 def listbad( filename, why ):
-    global badfiles
-    if filename not in badfiles: badfiles.append(filename)
-    if filename in goodfiles: goodfiles.remove(filename)
+    badfiles.add(filename)
+    goodfiles.discard(filename)
     whys[why] += 1
 
-def mv2scratch( filename, dirpath ):
-    """Moves a file in a dirpath under scratch/_gc/ to the corresponding location under scratch/"""
+def move_file( oldpath, newdir ):
+    """Moves the file oldpath into the directory newdir, making it if necessary.  Like shutil.move
+    but scratch/ and scratch/_gc/ are normally on the same file system, so this is just an
+    os.rename; only across file systems is the file copied.  An existing file is never overwritten."""
+    newpath = os.path.join( newdir, os.path.basename(oldpath) )
+    if os.path.exists(newpath):
+        raise shutil.Error("Destination path '%s' already exists"%newpath)
+    try:
+        os.makedirs(newdir)
+    except OSError as e:
+        if e.errno!=errno.EEXIST: raise   # another thread may have just made it
+    try:
+        os.rename( oldpath, newpath )
+    except OSError as e:
+        if e.errno!=errno.EXDEV: raise
+        shutil.move( oldpath, newpath )
+
+class Mover(object):
+    """Does move_file in a pool of threads, so that many renames are in flight at once; on a
+    network file system each one costs a round trip.  Call wait() to be sure that all moves
+    submitted so far are done; it raises the first exception from one of them."""
+    def __init__( self, workers=8 ):
+        self.pool = ThreadPool(workers)
+        self.pending = []
+    def move( self, oldpath, newdir ):
+        self.pending.append( self.pool.apply_async( move_file, (oldpath, newdir) ) )
+    def wait( self ):
+        pending, self.pending = self.pending, []
+        for result in pending:
+            result.get()
+    def close( self ):
+        try:
+            self.wait()
+        finally:
+            self.pool.close()
+            self.pool.join()
+
+def mv2scratch( filename, dirpath, mover=None ):
+    """Moves a file in a dirpath under scratch/_gc/ to the corresponding location under scratch/
+    If a Mover is supplied, the move is left to it."""
     scpath = dirpath.replace('/scratch/_gc/','/scratch/',1)
     oldpath = os.path.join(dirpath,filename)
-    #newpath = os.path.join(scpath,filename)
     print "moving from",oldpath,"\nto",scpath
-    if not os.path.isdir(scpath):
-        os.makedirs(scpath)
-    shutil.move( oldpath, scpath )
+    if mover is None:
+        move_file( oldpath, scpath )
+    else:
+        mover.move( oldpath, scpath )
     listgood( filename )
 
-def mv2trash( filename, dirpath, trashdir, why ):
+def mv2trash( filename, dirpath, trashdir, why, mover=None ):
     """Moves a file in dirpath under scratch/_gc/ to a corresponding location under
     scratch/_gc/trashdir.
-    This lets you collect files of the same type of badness in the same place."""
+    This lets you collect files of the same type of badness in the same place.
+    If a Mover is supplied, the move is left to it."""
     nwpath = os.path.normpath( dirpath.replace('/scratch/_gc/', '/scratch/_gc/'+trashdir+'/') )
     oldpath = os.path.join(dirpath,filename)
-    #newpath = os.path.join(scpath,filename)
     print "moving from",oldpath,"\nto",nwpath
-    if not os.path.isdir(nwpath):
-        os.makedirs(nwpath)
-    shutil.move( oldpath, nwpath )
+    if mover is None:
+        move_file( oldpath, nwpath )
+    else:
+        mover.move( oldpath, nwpath )
     listbad( filename, why )
 
 def abspath2vers( abspath ):
@@ -107,6 +145,12 @@ def verskey( verstr ):
         vstr = verstr
     return int(vstr)    
 
+def abspath2nvpath( abspath ):
+    """abspath without the version directory, i.e. the nv_path column of replica.files.
+    All versions of a file have the same nv_path."""
+    fdirs = abspath.split('/')
+    return '/'.join(fdirs[:9]+fdirs[10:])
+
 def existing_versions( filename, abspath, dirpath, engine ):
     """Identifies existing versions of a file for which the file has been verified.
     This file's version and all the versions are returned; the list of all versions is
@@ -117,11 +161,11 @@ def existing_versions( filename, abspath, dirpath, engine ):
         print "WARNING: cannot find the version from abspath.  vers=",vers,"fdirs=",fdirs
         return None,[]
 
-    ap_templ = abspath.replace(vers,'%')
-    # Do the Python equivalent of
-    # SELECT abs_path FROM replica.files WHERE status>=100 AND abs_path LIKE ap_templ;
-    sqlst = "SELECT abs_path FROM replica.files WHERE status>=100 AND abs_path LIKE '%s';"%ap_templ
-    report = engine.execute(sql.text(sqlst)).fetchall()
+    # All versions of the file have the same abs_path but for the version, i.e. the same nv_path
+    # (an indexed column; this used to be a LIKE with the version replaced by '%', a full scan).
+    nv_path = abspath2nvpath(abspath)
+    sqlst = "SELECT abs_path FROM replica.files WHERE status>=100 AND nv_path=:nv_path;"
+    report = engine.execute(sql.text(sqlst), nv_path=nv_path).fetchall()
     
     verss = [ abspath2vers(ap[0]) for ap in report ]
     verss.sort(reverse=True,key=verskey)
@@ -131,80 +175,97 @@ def existing_versions( filename, abspath, dirpath, engine ):
         print "WARNING, something didn't look like a version in", verss
         return None,[]
 
-def mvgood2scratch( filename, abspath, dirpath, engine ):
+class DBStatus(object):
+    """The replica.files status of every file under one facet directory, in all versions, read
+    with one query.  Files are then classified from memory; formerly each file took one or two queries."""
+    def __init__( self, engine, fac1dir ):
+        """fac1dir is the dataset's facet directory, e.g.
+        cmip5/output1/LASG-CESS/FGOALS-g2/amip/mon/atmos/Amon/r1i1p1"""
+        # Select by path, not by dataset_name: the files of a superseded version have been renamed
+        # to dataset_name='old_<version>_<name>' (push_dataset_aside), but keep their abs_path.
+        prefix = fac1dir.rstrip('/') + '/%'
+        sqlst = "SELECT abs_path,status FROM replica.files WHERE abs_path LIKE :prefix;"
+        report = engine.execute(sql.text(sqlst), prefix=prefix).fetchall()
+        self.status = {}     # abs_path -> status
+        self.versions = {}   # nv_path -> [(version, status), ...]
+        for abs_path, status in report:
+            self.status[abs_path] = status
+            self.versions.setdefault( abspath2nvpath(abs_path), [] ).append(
+                (abspath2vers(abs_path), status) )
+
+    def classify( self, abspath, filepath ):
+        """Decides what to do with the file at filepath, whose abs_path is abspath.  The file is good
+        if it's in the database, listed as present (status>=20 or <0), and we don't have a later
+        version of it.  Returns (good, trashdir, why); trashdir is None for a good file and for a
+        zero-length one, which is to be deleted."""
+        size = os.path.getsize(filepath)
+        if size==0:
+            return False, None, "zero length"
+        vers = abspath2vers(abspath)
+        others = self.versions.get( abspath2nvpath(abspath), [] )
+        if abspath not in self.status:
+            why = "not in database, "
+            print abspath,"not found in database, size=",size,"version=",vers
+
+            # Is another version in the database?
+            vershvs = [ v for v,st in others if st>=100 or st==30 ]
+            versnhvs = [ v for v,st in others if st<30 ]
+            vershvs = list(set([v[1:] if v[0]=='v' else v for v in vershvs]))
+            versnhvs = list(set([v[1:] if v[0]=='v' else v for v in versnhvs]))
+            vershvs.sort(key=verskey)
+            versnhvs.sort(key=verskey)
+            if len(vershvs)>0 and verskey(vershvs[-1])>verskey(vers):
+                print "  Not in database; but we have a later version."
+                why += "obsolete, have latest version"
+                trashdir = "notdb_hv_latest"
+            elif len(versnhvs)>0 and verskey(versnhvs[-1])>verskey(vers):
+                print "  Obsolete; we don't have the latest version."
+                why += "obsolete, do not have the latest version"
+                trashdir = "notdb_donthv_latest"
+            else:
+                why += "but there is no known later version"
+                trashdir = "notdb_no_later"
+            print "  versions in database which we have:", vershvs
+            print "  versions in database, we do not have:", versnhvs
+            return False, trashdir, why
+        status = self.status[abspath]
+        if status>=20 or status<0:
+            # It looks like we should keep this, unless we have a later version (as in existing_versions).
+            verss = [ v for v,st in others if st>=100 ]
+            if check_versiondir(vers) and len(verss)>0 and all(map(check_versiondir, verss)):
+                verss.sort(reverse=True,key=verskey)
+                if verskey(vers)!=verskey(verss[0]):
+                    print "abspath version",vers,"is older than",verss[0],"which we also have"
+                    return False, "old_hv_latest", "we have a later version"
+            return True, None, "good"
+        else:
+            print abspath,"status=",status,"\n  size=",size
+            return False, "status10", "db status says we do not have it"
+
+def mvgood2scratch( filename, abspath, dirpath, engine, dbstatus=None, mover=None ):
     """Checks whether file identified by abspath is in the database, listed as present
     (status>=20 or <0).
     If so, moves it from a path dirpath containing .../scratch/_gc/... to the corresponding path
     containing .../scratch/...
     Regardless of the database status, any zero-length file will be deleted.
     Returns True if the file was moved, False if it wasn't.
-    engine is an SQLAlchemy engine.
+    engine is an SQLAlchemy engine.  dbstatus is the DBStatus of the file's dataset; if not
+    supplied it will be read.  If a Mover is supplied, moves are left to it.
     The filename will be put in one of the lists goodfiles or badfiles."""
-    filepath = os.path.join(dirpath,filename)
-    if os.path.getsize(filepath)==0:
-        os.remove(filepath)
+    if dbstatus is None:
+        dbstatus = DBStatus( engine, '/'.join(abspath.split('/')[:9]) )
+    good, trashdir, why = dbstatus.classify( abspath, os.path.join(dirpath,filename) )
+    if good:
+        mv2scratch( filename, dirpath, mover )
+        return True
+    if trashdir is None:
+        os.remove( os.path.join(dirpath,filename) )
         # ...Cleaning nonexistent files out of the database will have to be done anyway.
         # That will be a separate job.
-        listbad(filename,"zero length")
-        return False
-
-    # Do the Python equivalent of SELECT status FROM replica.files WHERE abs_path=abspath
-    sqlst = "SELECT status FROM replica.files WHERE abs_path='%s';"%abspath
-    report = engine.execute(sql.text(sqlst)).fetchall()   # should be [(100,)] if status=100 e.g.
-    print "abspath=",abspath,"report=",report
-    if report==[]:
-        why = "not in database, "
-        vers = abspath2vers(abspath)
-        print abspath,"not found in database, size=",os.path.getsize(filepath),"version=",vers
-
-        # Is another version in the database?
-        abspath_anyvers = abspath.replace('/'+vers+'/', '/%/')
-        sqlst = "SELECT abs_path,status FROM replica.files WHERE abs_path LIKE '%s';"\
-                % abspath_anyvers
-        report = engine.execute(sql.text(sqlst)).fetchall()   # e.g. [(path1,status1),...]
-        vershvs = [ abspath2vers(r[0]) for r in report if r[1]>=100 or r[1]==30 ]
-        versnhvs = [ abspath2vers(r[0]) for r in report if r[1]<30 ]
-        vershvs = list(set([v[1:] if v[0]=='v' else v for v in vershvs]))
-        versnhvs = list(set([v[1:] if v[0]=='v' else v for v in versnhvs]))
-        vershvs.sort(key=verskey)
-        versnhvs.sort(key=verskey)
-        if len(vershvs)>0 and verskey(vershvs[-1])>verskey(vers):
-            print "  Not in database; but we have a later version."
-            why += "obsolete, have latest version"
-            trashdir = "notdb_hv_latest"
-        elif len(versnhvs)>0 and verskey(versnhvs[-1])>verskey(vers):
-            print "  Obsolete; we don't have the latest version."
-            why += "obsolete, do not have the latest version"
-            trashdir = "notdb_donthv_latest"
-        else:
-            why += "but there is no known later version"
-            trashdir = "notdb_no_later"
-        print "  versions in database which we have:", vershvs
-        print "  versions in database, we do not have:", versnhvs
-        mv2trash( filename, dirpath, trashdir, why )
-        #listbad(filename, why)
-
-        return False
-    status = report[0][0]
-    if status>=20 or status<0:
-        # It looks like we should keep this.
-        vers,verss = existing_versions(filename, abspath, dirpath, engine )
-        # Note that existing versions returns verss sorted so the latest is first.
-        if vers is not None and len(verss)>0 and verskey(vers)!=verskey(verss[0]):
-            print "abspath version",vers,"is older than",verss[0],"which we also have"
-            trashdir = "old_hv_latest"
-            mv2trash( filename, dirpath, trashdir, "we have a later version" )
-            #listbad(filename, "we have a later version")
-            return False
-        else:
-            mv2scratch( filename, dirpath )
-            return True
+        listbad( filename, why )
     else:
-        print abspath,"status=",status,"\n  size=",os.path.getsize(filepath)
-        trashdir = "status10"
-        mv2trash( filename, dirpath, trashdir, "db status says we do not have it" )
-        #listbad(filename,"db status says we do not have it")
-        return False
+        mv2trash( filename, dirpath, trashdir, why, mover )
+    return False
 
 def gc_mvall( scratchdir ):
     """first step of gc, move all files from /scratch/ to /scratch/_gc/."""
@@ -226,8 +287,10 @@ def gc_mvall( scratchdir ):
         if not os.path.isdir(glob.glob(gcdir)[0]):
             raise Exception("gcdir %s doesn't exist"%gcdir)
 
-def gc_mvgood( topdir, gcdir ):
-    """second step of gc, move good files from /scratch/_gc/ to /scratch/."""
+def gc_mvgood( topdir, gcdir, workers=8 ):
+    """second step of gc, move good files from /scratch/_gc/ to /scratch/.
+    Each dataset's database status is read once (DBStatus), every file of a dataset+version is
+    classified from it, and then the moves are done by workers threads (Mover)."""
     config = loadConfig(None)
     engine = sqlalchemy.create_engine(config.get('replication', 'esgcet_db'), echo=False,
                                       pool_recycle=3600)
@@ -236,49 +299,49 @@ def gc_mvgood( topdir, gcdir ):
     # the abs_path, which encodes the facets and version of the dataset, etc.
     # It's easier to start with those pieces of the path, and stick them together...
 
-    for gcdsdir in glob.glob( gcdir ):
-        fac1dir = gcdsdir[ len(os.path.join(topdir,'scratch/_gc/')): ]  # one choice of facets
-        # ...gcdsdir is the root directories for the dataset now in .../scratch/_gc/...
-        # Below this directory are ones for versions and variables, and possibly bad? directories
-        # for files which failed a checksum.
-        if fac1dir.endswith("withdrawn"):   # leave this facet directory in _gc, all versions
-            # rare, seen for LASG probably it's a name change done by hand
-            continue
-        versiondirs = os.listdir( gcdsdir )  # should be version directories e.g. v20120913/
-        for versd in versiondirs:
-            verspath = os.path.join(gcdsdir,versd)
-            if not os.path.isdir(verspath): continue
-            if not check_versiondir( versd ):
-                raise Exception("%s does not look like a version directory"%versd)
-            vardirs = os.listdir(verspath)
-            mvstatus = False  # True if any file in this dataset+version should be moved
-                              # back to scratch/.
-            for vard in vardirs:
-                varpath = os.path.join(verspath,vard)
-                dirpath = varpath
-                if not os.path.isdir(varpath): continue
-                filenames = os.listdir(varpath) # mostly files, may also have bad? directories
-                for filename in filenames:
-                    filep = os.path.join(varpath,filename)
-                    if os.path.isfile(filep):
-                        abspath = os.path.join( fac1dir, versd, vard, filename )
-                        mvstatus = mvstatus or mvgood2scratch( filename, abspath, dirpath, engine )
-            if mvstatus is True:
-                # A file was moved back to scratch, others in the same dataset+version should be
-                # moved.
-                for vard in vardirs:
+    mover = Mover(workers)
+    try:
+        for gcdsdir in glob.glob( gcdir ):
+            fac1dir = gcdsdir[ len(os.path.join(topdir,'scratch/_gc/')): ]  # one choice of facets
+            # ...gcdsdir is the root directories for the dataset now in .../scratch/_gc/...
+            # Below this directory are ones for versions and variables, and possibly bad? directories
+            # for files which failed a checksum.  Those are left in _gc/ for someone to look at.
+            if fac1dir.endswith("withdrawn"):   # leave this facet directory in _gc, all versions
+                # rare, seen for LASG probably it's a name change done by hand
+                continue
+            dbstatus = DBStatus( engine, fac1dir )
+            versiondirs = os.listdir( gcdsdir )  # should be version directories e.g. v20120913/
+            for versd in versiondirs:
+                verspath = os.path.join(gcdsdir,versd)
+                if not os.path.isdir(verspath): continue
+                if not check_versiondir( versd ):
+                    raise Exception("%s does not look like a version directory"%versd)
+                verdicts = []   # [(filename, dirpath, (good, trashdir, why)), ...]
+                for vard in os.listdir(verspath):
                     varpath = os.path.join(verspath,vard)
-                    dirpath = varpath
                     if not os.path.isdir(varpath): continue
-                    filenames = os.listdir(varpath) # mostly files, may also have bad? directories
-                    for filename in filenames:
+                    for filename in os.listdir(varpath): # mostly files, may also have bad? directories
                         filep = os.path.join(varpath,filename)
                         if os.path.isfile(filep):
-                            mv2scratch( filename, dirpath )
-                        if os.path.isdir(filep) and filep.find('bad')==0:
-                            for filen in os.listdir(filep):
-                                if os.path.isfile(filen):
-                                    mv2scratch( filename, dirpath )
+                            abspath = os.path.join( fac1dir, versd, vard, filename )
+                            verdicts.append( (filename, varpath, dbstatus.classify(abspath, filep)) )
+                # If any file in this dataset+version is good, the others in it go back to
+                # scratch/ with it.
+                mvstatus = True in [ verdict[0] for filename,dirpath,verdict in verdicts ]
+                for filename, dirpath, (good, trashdir, why) in verdicts:
+                    if good:
+                        mv2scratch( filename, dirpath, mover )
+                    elif trashdir is None:
+                        os.remove( os.path.join(dirpath,filename) )
+                        listbad( filename, why )
+                    elif mvstatus:
+                        print "  ...but it is in the same dataset+version as a good file:",why
+                        mv2scratch( filename, dirpath, mover )
+                    else:
+                        mv2trash( filename, dirpath, trashdir, why, mover )
+            mover.wait()
+    finally:
+        mover.close()
 
 def delete_empty_dirs( dirwc ):
     """Clean-up: delete empty directories in dirwc, which may be wildcarded."""
@@ -375,7 +438,6 @@ def check_facetsdir( topdir, facetsdir ):
     return sdirs
 
 def gc( topdir, facetsdir ):
-    global badfiles
     print "Entering CMIP gc with topdir=",topdir,"and"
     print "  facetsdir=",facetsdir
     sdirs = check_facetsdir(topdir,facetsdir)
@@ -386,18 +448,18 @@ def gc( topdir, facetsdir ):
     # It's also not necessary except for files which aren't in the expected places.
     for sdir in sdirs:
         for root, directories, filenames in os.walk(sdir):
-            badfiles += filenames
+            badfiles.update(filenames)
     print "jfp initially, badfiles=",
-    pprint(badfiles)
+    pprint(sorted(badfiles))
     print "jfp number of badfiles=",len(badfiles),"\n"
 
     gc_mvall( scratchdir )
     gc_mvgood( topdir, gcdir )
     delete_empty_dirs( os.path.join(topdir,'scratch/_gc/') )
     print len(goodfiles), "good files, in /scratch/:"
-    pprint( goodfiles )
+    pprint( sorted(goodfiles) )
     print len(badfiles), "bad files, in /scratch/_gc/:"
-    pprint( badfiles )
+    pprint( sorted(badfiles) )
     print len(goodfiles),"good files; ",len(badfiles),"bad files."
     print "reasons for files being good or bad:"
     pprint( whys )
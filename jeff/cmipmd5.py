@@ -2,6 +2,10 @@
 
 import sys, os, os.path, time
 import hashlib, subprocess
+try:
+    import checksum_cache
+except ImportError:
+    checksum_cache = None
 
 def md5( filename ):
     # returns the file's md5 checksum in hex format.
@@ -16,6 +20,16 @@ def md5( filename ):
             md5.update(chunk)
     return md5.hexdigest()
 
+def cached_md5( filename, cache ):
+    # md5 of the file, from the checksum cache if the file didn't change since it was last read
+    if cache is None: return md5(filename)
+    st = os.stat(filename)
+    ckactual = cache.get( filename, 'md5', st )
+    if ckactual is None:
+        ckactual = md5(filename)
+        cache.put( filename, ckactual, 'md5', st )
+    return ckactual
+
 def md5_all_of_it( filename ):
     # reads in the whole file to compute its md5 checksum; slightly slower
     # than reading it in chunks
@@ -46,6 +60,10 @@ def check_md5s( filename ):
     # Finally, files will be printed containing (1) the checksums of all files which have
     # been verified to be good, (2) the checksums of all files for which no checksums are
     # available, but at least the length is known to be good.
+    # md5 checksums of files which didn't change since they were last checked are taken from
+    # the shared checksum cache (checksum_cache.py), if available.
+    if checksum_cache: cache = checksum_cache.getCache()
+    else: cache = None
     nfiles = 0
     ngood = 0
     nbad = 0
@@ -84,7 +102,7 @@ def check_md5s( filename ):
             elif len(linelist)<=3:
                 nnock +=1
                 g.write( "no checksum available for "+fnc+"\n" )
-                ckactual = md5(fnc)
+                ckactual = cached_md5(fnc,cache)
                 i.write( fnc+" | "+ckactual+"\n" )
             else:                    # checksum is available
                 cksum = linelist[3]  # e.g. dfa5c368a6b76c80bf879ea178edcf5f
@@ -93,7 +111,7 @@ def check_md5s( filename ):
                 else:
                     csumalg = 'md5'
                 if csumalg=='md5':
-                    ckactual = md5(fnc)
+                    ckactual = cached_md5(fnc,cache)
                 elif csumalg=='cksum':
                     proc = subprocess.Popen(['cksum',fnc],stdout=subprocess.PIPE)
                     ckout = proc.stdout.readlines()
@@ -110,7 +128,7 @@ def check_md5s( filename ):
                         ngood += 1
                         h.write( fnc+" | "+cksum+"\n" )
                         if csumalg!='md5':
-                            ckactual = md5(fnc)
+                            ckactual = cached_md5(fnc,cache)
                             i.write( fnc+" | "+ckactual+"\n" )
                     else:
                         nbad += 1
@@ -120,6 +138,10 @@ def check_md5s( filename ):
 
     print "\nsummary: %d good, %d bad, %d no checksums available, %d missing files"\
           % (ngood, nbad, nnock, nnofl )
+    if cache:
+        print "checksum cache: %d hits, %d misses (%.1f%% hit rate)"\
+              % (cache.hits, cache.misses, 100*cache.getHitRate())
+        cache.close()
     g.write ( "\nsummary: %d good, %d bad, %d no checksums available, %d missing files\n"\
               % (ngood, nbad, nnock, nnofl))
     f.close()
@@ -67,6 +67,23 @@ def facets2dataset( facets ):
     
 
 
+def pathkey( abs_path ):
+    """the form of an abs_path used to compare paths from the database with paths from the P2P
+    system: the database and esgquery_index have different naming conventions, e.g. institute
+    CCCma/CCCMA, so the comparison has to be case-insensitive."""
+    return abs_path.lower().replace('inm-cm4','inmcm4')
+    #...if there are any more mismatch cases not handled by lower(), then I'll have to do
+    # a more complicated fix - break up into facets, subsitute with tables, then recombine.
+
+def unversioned( abs_path ):
+    """pathkey of abs_path without the version, so that all versions of a file have the same key.  E.g.
+    cmip5/output1/CCCma/CanCM4/decadal2008/mon/atmos/Amon/r1i1p1/v20111027/cl/cl_etc.nc becomes
+    cmip5/output1/cccma/cancm4/decadal2008/mon/atmos/amon/r1i1p1/cl/cl_etc.nc"""
+    fs = pathkey(abs_path).split('/')
+    if len(fs)>10:
+        del fs[9]
+    return '/'.join(fs)
+
 # The facets to which we shall restrict searches; for SQL compatibility use '%' for 'not specified':
 facets_default = { 'project':'CMIP5', 'product':'output1', 'institute':'NOAA GFDL', 'model':'GFDL-ESM2M',\
            'experiment':'historical', 'time_frequency':'3hr', 'realm':'atmos', 'cmor_table':'3hr',\
@@ -117,7 +134,7 @@ def download_list( facets=facets_default, downloadlist="download-mon", tempfile=
         ffiles = open(tempfile,'w')
 
         arg1= "-q "+ ','.join([ i+"='"+facets[i]+"'" for i in facets.keys() if facets[i] is not '%' ])
-        arg2="--fields "+','.join(fields)+" --type f -p"
+        arg2="--fields "+','.join(fields)+" --type f -p --stream"
         arg3 = "" # various options
         if len(serviceurl)>0:
             arg3 = arg3 + " --serviceurl "+serviceurl
@@ -189,62 +206,53 @@ def download_list( facets=facets_default, downloadlist="download-mon", tempfile=
     config = loadConfig(None)
     engine = sqlalchemy.create_engine(config.get('replication', 'esgcet_db'), echo=False, pool_recycle=3600)
 
-    # files0 is the files we want but already have, expresses as an abs_path; from the replication database.
-    # Note:  this could be merged with the check for older files - would save a database access
-    # but increase code complexity a little.
+    # All the database's files for the facet selection, in every version, are read in one query.
+    # Everything below is done with sets and dicts keyed by pathkey or unversioned, rather than
+    # with a query per file and list searches, which took hours for 100k-file selections.
     # Note: unfortunately, esgquery_index and postgres seem to do output sorting and hence limits
     # a little differently.
     dstr = facets2dataset(facets)
+    sqlall = "SELECT abs_path,checksum,checksum_type,status FROM replica.files WHERE dataset_name LIKE '"+\
+             dstr+"';"
+    dbfiles = engine.execute( sql.text( sqlall ) ).fetchall()
+    # files0 is the files we want but already have, expressed as an abs_path.
+    # files1 is the files we want and don't have (all of them with forcedl).
+    # It should correspond to the download list, but probably doesn't because they're based on different
+    # harvests.
+    # older maps the unversioned path of each file we have to [(abs_path,checksum,checksum_type),...]
+    # for all the versions of it we have; that's where local copies can come from.
+    files0 = []
+    files1 = []
+    older = {}
+    for abs_path, checksum, checksum_type, status in dbfiles:
+        if status is not None and status>=30:
+            files0.append(abs_path)
+            older.setdefault( unversioned(abs_path), [] ).append( (abs_path, checksum, checksum_type) )
+            if forcedl: files1.append(abs_path)
+        elif status is not None or forcedl:
+            files1.append(abs_path)
+    del dbfiles
+
     if not forcedl:
-        sql0 = "SELECT abs_path FROM replica.files WHERE dataset_name LIKE '"+dstr+"' AND status>=30;"
-        files0 = engine.execute( sql.text( sql0 ) ).fetchall()
-        files0 = [ f[0] for f in files0 ]
-        # pp.pprint "From %s files0=\n"%(sql0)
-        # pp.pprint(files0)
         # Of couse, we don't want files we already have, so take them out of the download list:
-        # Making a set out of files0 should convert the deletion process from O(n^2) to O(n), with
-        # bigger constants; I'm not sure whether it's worth it.  Usually 1,000<n<100,000.
-        # Also, the database and esgquery_index have different naming conventions, e.g. institute
-        # CCCma/CCCMA so the comparison has to be made case-insensitive (at least; but I believe that
-        # urls and file paths derived from the P2P system will hyphenate the same way).
-        sfiles0 = set([f.lower() for f in files0])
+        sfiles0 = set([pathkey(f) for f in files0])
         ldllist0 = len(dllist)
-        dllist = [ row for row in dllist if row[1].lower().replace('inm-cm4','inmcm4') not in sfiles0 ]
-        #...if there are any more mismatch cases not handled by lower(), then I'll have to do
-        # a more complicated fix - break up into facets, subsitute with tables, then recombine.
+        dllist = [ row for row in dllist if pathkey(row[1]) not in sfiles0 ]
         statusfile.write("dllist reduced from %d to %d lines by removing files we already have\n"%\
                          (ldllist0, len(dllist)) )
 
-    # files1 is the files we want and don't have; from the replication database.
-    # It should correspond to the download list, but probably doesn't because they're based on different
-    # harvests.
     # I don't want to deal with files which are missing from the database.  Rather than try
     # to fix the database, we'll take them out of the download list too.
-    if forcedl:
-        sql1 = "SELECT abs_path FROM replica.files WHERE dataset_name LIKE '"+dstr+"';"
-    else:
-        sql1 = "SELECT abs_path FROM replica.files WHERE dataset_name LIKE '"+dstr+"' AND status<30;"
-    print sql1
-    files1 = engine.execute( sql.text( sql1 ) ).fetchall()
-    files1 = [ f[0] for f in files1 ]
-    # pp.pprint "From %s files1=\n"%(sql0)
-    # pp.pprint(files1)
-    sfiles1 = set([f.lower() for f in files1])
+    sfiles1 = set([pathkey(f) for f in files1])
     ldllist0 = len(dllist)
-    # pp.pprint(dllist)
-    print [ row[1].lower().replace('inm-cm4','inmcm4') for row in dllist ][0]
-    dllist2 = [ row for row in dllist if row[1].lower().replace('inm-cm4','inmcm4') in sfiles1 ]
-    #...if there are any more mismatch cases not handled by lower(), then I'll have to do
-    # a more complicated fix - break up into facets, subsitute with tables, then recombine.
+    dllist2 = [ row for row in dllist if pathkey(row[1]) in sfiles1 ]
     statusfile.write(("dllist reduced from %d to %d lines by removing files not known to the replication"+\
                      " database.\n")%(ldllist0, len(dllist2)) )
     if len(dllist2)<ldllist0:
         statusfile.write( "WARNING: This change discards the following download list files.\n" )
         statusfile.write( "Maybe it's time for another harvest!\n" )
         if statusfile!=sys.stdout:  # don't write too much to the screen
-            pp.pprint( [ row[1] for row in dllist if row[1].lower().replace('inm-cm4','inmcm4') not in sfiles1 ] )
-            #...if there are any more mismatch cases not handled by lower(), then I'll have to do
-    # a more complicated fix - break up into facets, subsitute with tables, then recombine.
+            pp.pprint( [ row[1] for row in dllist if pathkey(row[1]) not in sfiles1 ] )
         else:
             statusfile.write("(filenames not printed)\n")
     dllist = dllist2
@@ -259,56 +267,35 @@ def download_list( facets=facets_default, downloadlist="download-mon", tempfile=
             if statusfile!=sys.stdout:
                 print "WARNING: esgquery and database produced different numbers of files to download!",\
                       len(dllist), len(files1)
-    # _Maybe_ these sorts will help in finding the row efficiently in the older-version search below;
-    # this needs investigation if it matters.
-    files1.sort( key=( lambda i: i.lower() ) )
-    dllist.sort( key=( lambda i: i[1].lower() ) )
+    files1.sort( key=pathkey )
+    dllist.sort( key=( lambda i: pathkey(i[1]) ) )
 
-    # files2 is the same as files1 but with the SQL wildcard % in place of the version
-    # example of the following:
-    # f = cmip5/output1/CCCma/CanCM4/decadal2008/mon/atmos/Amon/r1i1p1/v20111027/cl/cl_etc.nc
-    # fs=[cmip5,output1,CCCma,CanCM4,decadal2008,mon,atmos,Amon,r1i1p1,v20111027,cl,cl_etc.nc]
-    # fs=[cmip5,output1,CCCma,CanCM4,decadal2008,mon,atmos,Amon,r1i1p1,%,cl,cl_etc.nc]
-    # g = cmip5/output1/CCCma/CanCM4/decadal2008/mon/atmos/Amon/r1i1p1/%/cl/cl_etc.nc
-    files2=files1[:]
-    for i in range(len(files2)):
-        fs = files1[i].split('/')
-        fs[9] = '%'
-        files2[i] = '/'.join(fs)
-    # pp.pprint "From %s files2=\n"%(sql0)
-    # pp.pprint(files2)
-
-    # Now look for older versions of each file in dllist/files1/files2:
+    # Now look for older versions of each file in files1, and its row in dllist:
+    rows = dict( [ (pathkey(row[1]), row) for row in dllist ] )
     nnomatch = 0
-    for i in range(len(files2)):
-        fil2 = files2[i]
-        fil1 = files1[i]
-        sql2 = "SELECT abs_path,checksum,checksum_type FROM replica.files WHERE abs_path LIKE '"+fil2+\
-               "' AND status>=30;"
-        hvf = engine.execute( sql.text( sql2 ) ).fetchall()   # list of (abs_path,checksum,checksum_type)
+    for fil1 in files1:
+        hvf = [ fi for fi in older.get( unversioned(fil1), [] ) if fi[0]!=fil1 ]
+        if len(hvf)==0:
+            continue
+        row = rows.get( pathkey(fil1) )  # the row which matches fil1; None if no match
+        if row==None:
+            # The database has a file, abs_path==fil1, which the P2P system (i.e. dllist) doesn't
+            # know about.  That is, the P2P and gateway systems are inconsistent with one another.
+            # This shouldn't happen, but often does...
+            nnomatch = nnomatch+1
+            if statusfile!=sys.stdout:  # don't write too much to the screen!
+                statusfile.write( "WARNING, can't find match for database file %s\n"%(fil1) )
+            continue
         for fi in hvf:
-            # If abs_path is in the download list, this is a file we have which is the same as a file we
-            # want, other than version number.  If the checksum matches, we don't have to download -
-            # just copy from one version's directory to the new version's directory.
+            # fi is a file we have which is the same as a file we want, other than version number.
+            # If the checksum matches, we don't have to download - just copy from one version's
+            # directory to the new version's directory.
             # Of course, don't bother to do anything if the dllist already refers to another local copy.
-
-            row = next((r for r in dllist if r[1]==fil1),None)  # the row which matches fil1; None if no match
-            # ...the above use of a generator expression will only search until the row is found.
-            # Thanks to ionous blog: http://dev.ionous.net/2009/01/python-find-item-in-list.html
-            # >>> I would like it to start at the previous match; that will usually get the next
-            # >>> match in just one try if the lists are sorted first; look into this later.
-            if row==None:
-                # The database has a file, abs_path==fil1, which the P2P system (i.e. dllist) doesn't
-                # know about.  That is, the P2P and gateway systems are inconsistent with one another.
-                # This shouldn't happen, but often does...
-                if statusfile!=sys.stdout:  # don't write too much to the screen!
-                    statusfile.write( "WARNING, can't find match for database file %s\n"%(fil1) )
-                    nnomatch = nnomatch+1
-                continue
             statusfile.write( fil1+'\n' )
             pp.pprint( row )
             statusfile.write( fi[0]+'\n' )
-            if fi[1].upper()==row[3].upper() and fi[1].upper()!='DUMMY' and\
+            if fi[1] is not None and fi[2] is not None and\
+                   fi[1].upper()==row[3].upper() and fi[1].upper()!='DUMMY' and\
                    fi[2].lower()==row[4].lower() and row[0].find("file")!=0:
                 # checksums match, aren't "DUMMY", so change the download url to do a local copy
                 # >>>> for the moment, assume that we know where the file is.<<<<
@@ -0,0 +1,108 @@
+#!/usr/local/cdat/bin/python
+"""Persistent index of where files were last found on disk.
+Finding a file means probing many candidate roots (archive and scratch areas); on GPFS/NFS
+every probe is a metadata round trip. This index remembers, per DRS abs_path, the location
+where the file was found (and its size and mtime), so the next search can probe that
+location first.
+It also caches directory listings keyed by the directory mtime: as long as a directory's
+mtime doesn't change its stored listing is reused, so probing candidates which aren't there
+costs one stat per directory instead of one per file."""
+
+import os, sqlite3, time
+import logging
+log = logging.getLogger('location_index')
+
+#a listing made less than this many seconds after the directory's mtime isn't stored: with coarse
+#mtimes (1s on NFS/ext3), a file created later in the same second wouldn't change the mtime
+#(as with git's "racily clean" index entries)
+RACY_SECONDS = 2
+
+class LocationIndex(object):
+    """sqlite backed index of file locations and directory listings."""
+
+    def __init__(self, db_file):
+        self.db_file = db_file
+        self._conn = sqlite3.connect(db_file)
+        self._conn.text_factory = str
+        self._conn.execute('CREATE TABLE IF NOT EXISTS locations (abs_path TEXT PRIMARY KEY, '
+                           'location TEXT NOT NULL, published INTEGER, size INTEGER, mtime REAL)')
+        self._conn.execute('CREATE TABLE IF NOT EXISTS dirs (path TEXT PRIMARY KEY, '
+                           'mtime REAL, names TEXT)')
+        #directory listings already checked during this run: path -> set of names (None if missing)
+        self._listings = {}
+        self.hits = self.misses = 0
+
+    def lookup(self, abs_path):
+        """Returns (location, published) where abs_path was last found if it's still there
+        (a non empty file), or None."""
+        row = self._conn.execute('SELECT location, published, size, mtime FROM locations '
+                                 'WHERE abs_path=?', (abs_path,)).fetchone()
+        if row:
+            location, published, size, mtime = row
+            try:
+                st = os.stat(location)
+            except OSError:
+                st = None
+            if st and st.st_size > 0:
+                if st.st_size != size or st.st_mtime != mtime:
+                    self.record(abs_path, location, published, st)
+                self.hits += 1
+                return (location, bool(published))
+            #it's gone
+            self.forget(abs_path)
+        self.misses += 1
+        return None
+
+    def record(self, abs_path, location, published, st=None):
+        """Remember that abs_path was found at location. st is the os.stat of location (if known)."""
+        if st is None: st = os.stat(location)
+        self._conn.execute('INSERT OR REPLACE INTO locations VALUES (?,?,?,?,?)',\
+                           (abs_path, location, int(bool(published)), st.st_size, st.st_mtime))
+
+    def forget(self, abs_path):
+        self._conn.execute('DELETE FROM locations WHERE abs_path=?', (abs_path,))
+
+    def listdir(self, path):
+        """Returns the set of names in the given directory or None if it's not a directory.
+        The stored listing is reused as long as the directory mtime didn't change; a listing of a
+        directory modified within RACY_SECONDS isn't stored. Each directory is checked only once
+        per LocationIndex instance (i.e. once per run)."""
+        if path in self._listings: return self._listings[path]
+        try:
+            mtime = os.stat(path).st_mtime
+        except OSError:
+            self._listings[path] = None
+            return None
+
+        row = self._conn.execute('SELECT mtime, names FROM dirs WHERE path=?', (path,)).fetchone()
+        if row and row[0] == mtime:
+            names = set(row[1].split('\n')) if row[1] else set()
+        else:
+            listed_at = time.time()
+            try:
+                names = set(os.listdir(path))
+            except OSError:
+                #not a directory, or not readable
+                self._listings[path] = None
+                return None
+            if listed_at - mtime >= RACY_SECONDS:
+                self._conn.execute('INSERT OR REPLACE INTO dirs VALUES (?,?,?)',\
+                                   (path, mtime, '\n'.join(names)))
+            elif row:
+                self._conn.execute('DELETE FROM dirs WHERE path=?', (path,))
+        self._listings[path] = names
+        return names
+
+    def isfile(self, path):
+        """Same as os.path.isfile(path) and os.path.getsize(path)>0 but answers negatively
+        from the cached directory listing without touching the file."""
+        names = self.listdir(os.path.dirname(path))
+        if not names or os.path.basename(path) not in names: return False
+        return os.path.isfile(path) and os.path.getsize(path) > 0
+
+    def commit(self):
+        self._conn.commit()
+
+    def close(self):
+        self._conn.commit()
+        self._conn.close()
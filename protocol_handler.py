@@ -2,6 +2,7 @@
 """Handle download of files in a subprocess according to the given
 protocol."""
 import subprocess, re, time, os
+import threading, Queue, httplib, urlparse, socket, ssl
 import logging
 log = logging.getLogger('download')
 
@@ -20,6 +21,11 @@ class BaseProtocol(object):
     def getProc(self, *args, **kwargs):
         return self._proc
 
+    def getProgress(self):
+        """Bytes of the target file already in place, if the handler knows it. None means
+        the caller should look at the file size instead."""
+        return None
+
     def killProcess(self):
         p = self._proc
         if p:
@@ -295,6 +301,305 @@ class __HTTPProtocol_wget(BaseProtocol):
 class __HTTPSProtocol(__HTTPProtocol_wget):
     """handle https via wget, the same as with http."""
 
+## persistent (keep-alive) connections, shared by all http handlers
+_max_idle_connections = 8  #per host
+_connections = {}
+_connections_lock = threading.Lock()
+
+def _getConnection(scheme, netloc, timeout, context=None, cert=None):
+    """Return an idle connection to the given host or a new one"""
+    conn = None
+    _connections_lock.acquire()
+    try:
+        idle = _connections.get((scheme, netloc))
+        if idle: conn = idle.pop()
+    finally:
+        _connections_lock.release()
+
+    if conn:
+        conn.timeout = timeout
+        if conn.sock: conn.sock.settimeout(timeout)
+    elif scheme == 'https':
+        if context: conn = httplib.HTTPSConnection(netloc, timeout=timeout, context=context)
+        else: conn = httplib.HTTPSConnection(netloc, timeout=timeout, key_file=cert, cert_file=cert)
+    else:
+        conn = httplib.HTTPConnection(netloc, timeout=timeout)
+    return conn
+
+def _releaseConnection(scheme, netloc, conn):
+    """Give a connection whose last response was completely read back for reuse."""
+    _connections_lock.acquire()
+    try:
+        idle = _connections.setdefault((scheme, netloc), [])
+        if len(idle) < _max_idle_connections:
+            idle.append(conn)
+            conn = None
+    finally:
+        _connections_lock.release()
+    if conn: conn.close()
+
+class __HTTPProtocol_native(BaseProtocol):
+    """handle http(s) in this process. Connections are kept alive and reused, and large files are
+    retrieved as several byte-range segments in parallel.
+    The file is written to <target>.part (with the finished ranges in <target>.part.segments, so
+    an interrupted download can be resumed) and renamed to the target when complete."""
+
+    #minimal size of a segment, smaller files are retrieved in one go
+    MIN_SEGMENT = 64*1024*1024
+    BUFFER = 1024*1024
+    MAX_REDIRECTS = 10
+
+    def __init__(self, url, **init_args):
+        BaseProtocol.__init__(self, url)
+        self.cert = None
+        self.cacert = None
+        self._context = None
+        self._cookies = {}
+        self._cancelled = False
+        self._done = 0          #bytes that were already there
+        self._progress = {}     #segment start -> bytes retrieved by it
+        self._lock = threading.Lock()
+
+    def getSecurity(self):
+        if not self.cert:
+            #plain http works without certificate, so don't fail here
+            self.cert = os.getenv('X509_USER_PROXY')
+            self.cacert = os.getenv('X509_CERT_DIR')
+        return (self.cert, self.cacert)
+
+    def getProgress(self):
+        return self._done + sum(self._progress.values())
+
+    def killProcess(self):
+        self._cancelled = True
+
+    def __connect(self, scheme, netloc, timeout):
+        cert, cacert = self.getSecurity()
+        if scheme == 'https' and self._context is None and hasattr(ssl, 'create_default_context'):
+            self._context = ssl.create_default_context(capath=cacert)
+            #same as wget --no-check-certificate
+            self._context.check_hostname = False
+            self._context.verify_mode = ssl.CERT_NONE
+            if cert: self._context.load_cert_chain(cert)
+        return _getConnection(scheme, netloc, timeout, context=self._context, cert=cert)
+
+    def __request(self, headers, timeout):
+        """GET self.url following redirects (and keeping cookies as curl --cookie does).
+        Returns (scheme, netloc, connection, response). self.url is set to the final url."""
+        for redirect in range(self.MAX_REDIRECTS):
+            url = urlparse.urlsplit(self.url)
+            path = url.path or '/'
+            if url.query: path += '?' + url.query
+            conn = self.__connect(url.scheme, url.netloc, timeout)
+            req_headers = dict(headers)
+            if self._cookies:
+                req_headers['Cookie'] = '; '.join(['%s=%s' % c for c in self._cookies.items()])
+            try:
+                conn.request('GET', path, headers=req_headers)
+                resp = conn.getresponse()
+            except (httplib.BadStatusLine, httplib.CannotSendRequest, socket.error):
+                #the server might have closed an idle connection, try once with a new one
+                conn.close()
+                conn = self.__connect(url.scheme, url.netloc, timeout)
+                conn.request('GET', path, headers=req_headers)
+                resp = conn.getresponse()
+
+            for cookie in (resp.getheader('set-cookie') or '').split(','):
+                cookie = cookie.split(';')[0].strip()
+                if '=' in cookie:
+                    name, value = cookie.split('=', 1)
+                    self._cookies[name] = value
+
+            if resp.status in (301, 302, 303, 307) and resp.getheader('location'):
+                resp.read()
+                _releaseConnection(url.scheme, url.netloc, conn)
+                self.url = urlparse.urljoin(self.url, resp.getheader('location'))
+                log.debug('redirected to %s', self.url)
+                continue
+            return (url.scheme, url.netloc, conn, resp)
+        raise Exception('Too many redirects for %s' % self.url)
+
+    def __probe(self, timeout):
+        """Find the size of the remote file and whether it supports byte ranges."""
+        scheme, netloc, conn, resp = self.__request({'Range': 'bytes=0-0'}, timeout)
+        if resp.status == 206 or resp.status == 416:
+            resp.read()
+            _releaseConnection(scheme, netloc, conn)
+            total = (resp.getheader('content-range') or '').split('/')[-1]
+            if total.isdigit(): return (int(total), True)
+            return (None, False)
+        #don't read the whole file just to know this
+        conn.close()
+        if resp.status == 200:
+            length = resp.getheader('content-length')
+            if length and length.isdigit(): return (int(length), False)
+            return (None, False)
+        raise Exception('HTTP error %s %s' % (resp.status, resp.reason))
+
+    def __getSegment(self, part, start, end, timeout, retries, use_range):
+        """Retrieve [start, end) into the part file. end might be None (unknown size).
+        Returns the position up to which the data was retrieved."""
+        pos = start
+        failures = 0
+        fd = os.open(part, os.O_WRONLY)
+        try:
+            while (end is None or pos < end) and not self._cancelled:
+                headers = {}
+                if use_range: headers['Range'] = 'bytes=%d-%s' % (pos, end is not None and end-1 or '')
+                elif pos > start:
+                    #no range support, start from scratch
+                    pos = start
+                    self._progress[start] = 0
+                conn = None
+                try:
+                    scheme, netloc, conn, resp = self.__request(headers, timeout)
+                    if resp.status != (use_range and 206 or 200):
+                        raise httplib.HTTPException('HTTP error %s %s' % (resp.status, resp.reason))
+                    os.lseek(fd, pos, os.SEEK_SET)
+                    while not self._cancelled:
+                        data = resp.read(self.BUFFER)
+                        if not data: break
+                        while data:
+                            written = os.write(fd, data)
+                            data = data[written:]
+                            pos += written
+                        self._progress[start] = pos - start
+                    if self._cancelled:
+                        conn.close()
+                        break
+                    _releaseConnection(scheme, netloc, conn)
+                    if end is None: break   #unknown size, we got everything there was
+                    if pos < end: raise httplib.HTTPException('connection closed at byte %s' % pos)
+                except (socket.error, httplib.HTTPException, IOError) as e:
+                    if conn: conn.close()
+                    failures += 1
+                    log.warn('Segment [%s-%s] of %s failed at %s (%s/%s): %s', start, end, self.url,\
+                             pos, failures, retries, e)
+                    if failures > retries: break
+        finally:
+            os.close(fd)
+        return pos
+
+    @staticmethod
+    def __readState(state_file):
+        finished = []
+        if os.path.isfile(state_file):
+            for line in open(state_file):
+                items = line.split()
+                if len(items) == 2: finished.append((int(items[0]), int(items[1])))
+        return finished
+
+    @staticmethod
+    def __missing(finished, total):
+        """Return the ranges of [0, total) not covered by the finished ones"""
+        missing = []
+        pos = 0
+        for start, end in sorted(finished):
+            if start > pos: missing.append((pos, start))
+            pos = max(pos, end)
+        if pos < total: missing.append((pos, total))
+        return missing
+
+    def getFile(self, target_file, block_check=True, start=0, end=None, segments=4, timeout=120,\
+                retries=3, **params):
+        """Retrieve the file, block_check is ignored (downloads never block forever, stalled
+        connections time out after timeout seconds). start > 0 means the first start bytes
+        of target_file are already there. Returns 0 if the file was completely retrieved."""
+        if target_file.startswith('file://'): target_file = target_file[7:]
+        part = target_file + '.part'
+        state_file = part + '.segments'
+        self._cancelled = False
+
+        if start > 0 and os.path.isfile(target_file):
+            #continue what some other handler began
+            for f in (part, state_file):
+                if os.path.isfile(f): os.remove(f)
+            os.rename(target_file, part)
+            finished = [(0, start)]
+        elif os.path.isfile(part):
+            finished = self.__readState(state_file)
+        else:
+            finished = []
+
+        try:
+            total, use_range = self.__probe(timeout)
+        except Exception as e:
+            log.error('Cannot access %s: %s', self.url, e)
+            return 1
+        if total is not None and end and total != end:
+            log.warn('%s has %s bytes, %s were expected', self.url, total, end)
+        if not use_range: finished = []
+
+        if total is None:
+            missing = [(0, None)]
+        else:
+            missing = self.__missing(finished, total)
+            #split what's missing in at most "segments" parallel requests
+            if use_range and segments > 1:
+                remaining = sum([e-s for s, e in missing])
+                size = max(self.MIN_SEGMENT, -(-remaining//segments))
+                split = []
+                for s, e in missing:
+                    while e - s > size:
+                        split.append((s, s+size))
+                        s += size
+                    split.append((s, e))
+                missing = split
+            self._done = total - sum([e-s for s, e in missing])
+
+        #preallocate the file (sparse)
+        fd = os.open(part, os.O_WRONLY | os.O_CREAT, 0644)
+        try:
+            if total is not None: os.ftruncate(fd, total)
+            else: os.ftruncate(fd, 0)
+        finally:
+            os.close(fd)
+
+        log.debug("Downloading %s (%s bytes) in %s segment(s)", self.url, total, len(missing))
+        if not use_range: state = None
+        elif finished: state = open(state_file, 'w')
+        else: state = open(state_file, 'a')
+        if state:
+            #rewrite what we know (compacted)
+            for s, e in finished: state.write('%s %s\n' % (s, e))
+            state.flush()
+        self._progress = {}
+        failed = []
+        todo = Queue.Queue()
+        for segment in missing: todo.put(segment)
+        def run():
+            while True:
+                try:
+                    s, e = todo.get_nowait()
+                except Queue.Empty:
+                    return
+                pos = self.__getSegment(part, s, e, timeout, retries, use_range)
+                self._lock.acquire()
+                try:
+                    if state and pos > s:
+                        state.write('%s %s\n' % (s, pos))
+                        state.flush()
+                    if e is not None and pos < e: failed.append((s, e))
+                finally:
+                    self._lock.release()
+
+        threads = []
+        for i in range(min(max(segments, 1), len(missing))):
+            t = threading.Thread(target=run)
+            t.daemon = True
+            t.start()
+            threads.append(t)
+        for t in threads:
+            t.join()
+        if state: state.close()
+
+        if failed or self._cancelled:
+            log.warn('Download of %s incomplete, %s segment(s) failed', self.url, len(failed))
+            return 1
+        os.rename(part, target_file)
+        if os.path.isfile(state_file): os.remove(state_file)
+        return 0
+
 class __FileProtocol(BaseProtocol):
     """Handle files available locally. This wil create hardlinks if possible"""
     def __init__(self, url, **init_args):
@@ -353,12 +658,12 @@ def getFile(url, file, **kwargs):
 ## init 
 
 
-addHandler('http', __HTTPProtocol_wget)
+addHandler('http', __HTTPProtocol_native)
 addHandler('gsiftp', __GsiftpProtocol)
 addHandler('ftp', __ftpProtocol)
 addHandler('sftp', __sftpProtocol)
 addHandler('file', __FileProtocol)
-addHandler('https', __HTTPSProtocol)
+addHandler('https', __HTTPProtocol_native)
 
 
 
@@ -4,11 +4,6 @@
 """This file is specially tailored for WDCC. Adapt and use at your own risk."""
 
 import sqlalchemy
-from esgcet.publish import parseDatasetVersionId
-from esgcet.config import loadConfig, initLogging
-from esgcet.model import Dataset, DatasetVersion
-from esgcet.query import printResult
-from esgcet.messaging import warning
 import os,sys,shutil, time
 from sqlalchemy.ext.declarative import declarative_base
 from sqlalchemy import Column, Integer, Float, String, sql, ForeignKey, orm
@@ -58,6 +53,11 @@ Actions:
     --report <type>:    provide some reports. Known types: """ + ','.join(report_types) + """
     --publish:          Not all users are allowed to do this!
     --archive:          store published replica and delete from DB
+    --mapfile:          write a mapfile of all datasets in their final directory (to --file)
+    --multi-mapfiles:   write a mapfile per dataset in its final directory (into the directory
+                        --file, default: the current one)
+    --index-files:      fill in the columns used for looking up files by name for the files
+                        which predate them (run once after upgrading, it's safe to run again)
 opt:
     --dataset   : SQL like similar clause for matching dataset names. Only these will be considered
                   for the action.
@@ -77,14 +77,14 @@ def main(argv=None):
         args, lastargs = getopt.getopt(argv, "hdvq", ['help', 'find-datasets', 'download-list=', 
             'verify', 'discover', 'report=', 'dataset=', 'datasetnot=', 'file=', 'no-checksums',
             'update', 'move', 'chown', 'mapfile', 'multi-mapfiles',
-            'publish', 'archive', 'clean', 'skip_hardlinks'])
+            'publish', 'archive', 'clean', 'skip_hardlinks', 'index-files'])
     except getopt.error:
         rmlog.error( sys.exc_info()[:3] )
         return 1
 
     #init values
     find_datasets =  verify = discover =  update = move = chown = mapfile = multi_mapfiles =\
-                    publish = archive = clean = False
+                    publish = archive = clean = index_files = False
     skip_hardlinks = False
     global dataset_match, dataset_matchnot
     file = download_type = report_type = None
@@ -107,6 +107,7 @@ def main(argv=None):
         elif flag=='--multi-mapfiles':         multi_mapfiles = True
         elif flag=='--publish':         publish = True
         elif flag=='--archive':         archive = True
+        elif flag=='--index-files':     index_files = True
 
         #options
         elif flag=='--dataset':         dataset_match = arg
@@ -124,7 +125,7 @@ def main(argv=None):
     if download_type=='T' or download_type=='t' or download_type=='HTTP' or download_type=='http':
         download_type='list_HTTPServer'
     if not (find_datasets or download_type or verify or discover or clean or report_type or
-            update or move or chown or mapfile or multi_mapfiles or publish or archive):
+            update or move or chown or mapfile or multi_mapfiles or publish or archive or index_files):
         rmlog.error( "You must select at least one action" )
         return 1
 
@@ -133,6 +134,7 @@ def main(argv=None):
     else: dataset_match = '%%'
     if dataset_matchnot: dataset_matchnot.replace('%','%%')
 
+    if index_files: index_file_paths()
     if find_datasets: fill_replica_db()
     if download_type: create_download_lists(file=file, type=download_type)
     if verify: verify_datasets(skip_hardlinks,do_checksums)
@@ -145,36 +147,53 @@ def main(argv=None):
     if move: move_to_final_dir()
     if chown: change_ownership()
     if mapfile: create_mapfile(file)
-    if multi_mapfiles: dumpMapfiles()
+    if multi_mapfiles: dumpMapfiles(file)
     if publish: publishReplica()
     if archive: archiveReplica()
 
     #if here everything ended ok
     return 0
 
-config = loadConfig(None)
+#The configuration (and the paths below) are loaded on first use, so actions which don't
+#need them (and --help) don't pay for it. Use getConfig() instead of accessing it directly.
+config = None
 
 ###########################################
 #### PATHS #################################
 #########################################
 
 #Final destination of files (the archive).  Typically this comes from ~/.esgcet/esg.ini
-archive_root0 = config.get('replication', 'archive_root0') # on gdo2: /cmip5/data
-archive_root1 = config.get('replication', 'archive_root1') # on gdo2: /css01-cmip5/data
-archive_root2 = config.get('replication', 'archive_root2') # on gdo2: /css02-cmip5/data
-archive_root3 = config.get('replication', 'archive_root3') # on gdo2: /css02-cmip5/cmip5/data
+archive_root0 = archive_root1 = archive_root2 = archive_root3 = None
 
 #temporal destinations of files and other data while completing the datasets
-replica_root0 = config.get('replication', 'replica_root0')   # on gdo2: /cmip5/scratch
-replica_root1 = config.get('replication', 'replica_root1')   # on gdo2: /css01-cmip5/scratch
-replica_root2 = config.get('replication', 'replica_root2')   # on gdo2: /css02-cmip5/scratch
+replica_root0 = replica_root1 = replica_root2 = None
 
 # no longer used: map_dir= os.path.join(replica_root2, 'map')
 
 #jfp was files_dir= os.path.join(replica_root2, 'files')
-files_dir0 = replica_root0                               # on gdo2: /cmip5/scratch
-files_dir1 = replica_root1                               # on gdo2: /css01-cmip5/scratch
-files_dir2 = replica_root2                               # on gdo2: /css02-cmip5/scratch
+files_dir0 = files_dir1 = files_dir2 = None
+
+def getConfig():
+    """Returns the esgcet configuration, loading it (and setting the paths) the first time."""
+    global config, archive_root0, archive_root1, archive_root2, archive_root3,\
+           replica_root0, replica_root1, replica_root2, files_dir0, files_dir1, files_dir2
+    if config is None:
+        from esgcet.config import loadConfig
+        config = loadConfig(None)
+
+        archive_root0 = config.get('replication', 'archive_root0') # on gdo2: /cmip5/data
+        archive_root1 = config.get('replication', 'archive_root1') # on gdo2: /css01-cmip5/data
+        archive_root2 = config.get('replication', 'archive_root2') # on gdo2: /css02-cmip5/data
+        archive_root3 = config.get('replication', 'archive_root3') # on gdo2: /css02-cmip5/cmip5/data
+
+        replica_root0 = config.get('replication', 'replica_root0')   # on gdo2: /cmip5/scratch
+        replica_root1 = config.get('replication', 'replica_root1')   # on gdo2: /css01-cmip5/scratch
+        replica_root2 = config.get('replication', 'replica_root2')   # on gdo2: /css02-cmip5/scratch
+
+        files_dir0 = replica_root0                               # on gdo2: /cmip5/scratch
+        files_dir1 = replica_root1                               # on gdo2: /css01-cmip5/scratch
+        files_dir2 = replica_root2                               # on gdo2: /css02-cmip5/scratch
+    return config
 
 #############################################
 
@@ -212,10 +231,21 @@ class ReplicaAccess(Base, DAO):
     abs_path = Column(String, ForeignKey('replica.files.abs_path'))
     type = Column(String, nullable=False)
 
+def strip_version(abs_path):
+    """Returns abs_path without its version directory (the 10th DRS component), so all versions
+    of a file map to the same value. Paths too short to hold a version are returned unchanged."""
+    parts = abs_path.split('/')
+    if len(parts) <= 9: return abs_path
+    return '/'.join(parts[:9] + parts[10:])
+
 class ReplicaFile(Base, DAO):
     __tablename__ = 'files'
     __table_args__ = {'schema':'replica'}
     abs_path = Column(String, primary_key=True)
+    #derived from abs_path, so we can look files up without LIKE scans. Set automatically when
+    #abs_path is set; rows created before these columns existed need: --index-files
+    basename = Column(String, index=True)
+    nv_path = Column(String, index=True)    #abs_path without version (see strip_version)
     dataset_name = Column(String,  ForeignKey('replica.datasets.name'))
     checksum = Column(String, nullable=False)   #nullable:=avoid replicating things we can't be sure of
     checksum_type =  Column(String, default='md5')
@@ -225,13 +255,23 @@ class ReplicaFile(Base, DAO):
     #jfp was access = orm.relation(ReplicaAccess, backref=orm.backref('file'), order_by = ReplicaAccess.url, cascade='all, delete')
     access = orm.relation(ReplicaAccess, backref=orm.backref('file'), order_by = ReplicaAccess.url )
     location = None # may get set during verification
+
+    @orm.validates('abs_path')
+    def _set_derived_paths(self, key, abs_path):
+        if abs_path:
+            self.basename = os.path.basename(abs_path)
+            self.nv_path = strip_version(abs_path)
+        return abs_path
+
     def getFinalLocations(self):
+        getConfig()
         return [ os.path.join(archive_root0, self.abs_path),
                  os.path.join(archive_root1, self.abs_path),
                  os.path.join(archive_root2, self.abs_path),
                  os.path.join(archive_root3, self.abs_path) ]
 
     def getDownloadLocation(self):
+        getConfig()
         if   self.abs_path.find("/BCC/")>0 or\
              self.abs_path.find("/CNRM-CERFACS/")>0 or\
              self.abs_path.find("/COLA-CFS/")>0 or\
@@ -275,11 +315,13 @@ class ReplicaDataset(Base, DAO):
         return self.path
 
     def getMapfile(self, root):
+        """The whole mapfile as a string. For many (or big) datasets use write_mapfiles()."""
         lines=[]
         for f in self.files:
             if not f.mtime:
                 f.mtime = os.path.getmtime(os.path.join(root,f.abs_path))
-            lines.append('|'.join([self.name, os.path.join(root,f.abs_path), str(f.size), 'mod_time=%f|checksum_type=%s|checksum=%s' % (f.mtime,f.checksum_type,f.checksum)]))
+            lines.append(mapfile_line(self.name, os.path.join(root,f.abs_path), f.size, f.mtime,\
+                                      f.checksum_type, f.checksum))
         return '\n'.join(lines) + '\n'
         
 
@@ -295,19 +337,55 @@ class ArchivedFile(Base,DAO):
     gateway = Column(String, nullable=False)
     catalog = Column(String, nullable=False)
 
+_engine = _Session = None
+def getEngine():
+    """Returns the engine of the replica DB (created on first use). Its connections are pooled."""
+    global _engine
+    if _engine is None:
+        db_url = getConfig().get('replication', 'replica_db')
+        args = {'pool_recycle':3600}
+        if not db_url.startswith('sqlite'):
+            args.update(pool_size=5, max_overflow=10)
+        _engine = sqlalchemy.create_engine(db_url, **args)
+        Base.metadata.create_all(_engine)
+        add_file_path_columns(_engine)
+    return _engine
+
+def newSession():
+    """Returns a new session to the replica DB. Sessions aren't thread safe, so anything running
+    concurrently needs its own; they all share the pool of connections of the engine."""
+    global _Session
+    if _Session is None:
+        #jfp was orm.sessionmaker(bind=e, autoflush=False, autocommit=False,expire_on_commit=False)
+        _Session = orm.sessionmaker(bind=getEngine(), autoflush=False, autocommit=False)
+    return _Session()
+
 def getReplicaDB():
+    """Returns the session shared by the whole module."""
     global rep_s
     if not rep_s:
         #prepare rplica_db
-        e = sqlalchemy.create_engine(config.get('replication', 'replica_db'))
-        Base.metadata.create_all(e)
-        #jfp was rep_s = orm.sessionmaker(bind=e, autoflush=False, autocommit=False,expire_on_commit=False)()
-        rep_s = orm.sessionmaker(bind=e, autoflush=False, autocommit=False)()
+        rep_s = newSession()
     return rep_s
 ###########################################################
 ####### --- Preparing datasets available for download --- ####
 ################################################################
 
+def existing_files(paths):
+    """Returns the set of the given paths which exist. Each directory is listed only once instead
+    of stat'ing every file (which is a round trip per file on GPFS/NFS)."""
+    listings = {}
+    found = set()
+    for path in paths:
+        dir, name = os.path.split(path)
+        if dir not in listings:
+            try:
+                listings[dir] = set(os.listdir(dir))
+            except OSError:
+                listings[dir] = set()
+        if name in listings[dir]: found.add(path)
+    return found
+
 def push_dataset_aside( rd, previous_files, engine, Session ):
     # rd is a ReplicaDataset found from database rep_s.
     # This function makes a re-named copy of it and associated files, and then deletes it
@@ -317,86 +395,126 @@ def push_dataset_aside( rd, previous_files, engine, Session ):
     t0=time.time()
     global rep_s
 
-    # rd is obsolete.  Make a copy with a different name and status...
-    mod_rd = ReplicaDataset( name="old_"+str(rd.version)+'_'+rd.name, version=rd.version,\
-                             status=STATUS.OBSOLETE, gateway=rd.gateway,\
-                             parent=rd.parent, size=rd.size, filecount=rd.filecount,catalog=rd.catalog )
-    rep_s.add(mod_rd)
-    # The new copy of the dataset still has those files...
-    # count = 0
-
-    # The files pointing to rd should instead point to the copy, mod_rd.
-    for file in rd.files:
-        if file.dataset_name==rd.name:
-#            mod_file = ReplicaFile( abs_path=file.abs_path, dataset_name=mod_rd.name,\
-#                                    checksum=file.checksum, checksum_type=file.checksum_type,\
-#                                    size=file.size, mtime=file.mtime, status=file.status )
-#            rep_s.add( mod_file )
-            # incredibly slow, do instead with engine.execute (below) ... rep_s.delete( file )
-            file.dataset_name = mod_rd.name
-            location = file.getDownloadLocation()
-            # This could miss the case where a copy of the file had previously been downloaded
-            # to a different directory (e.g. css01,css02,gdo2); but it's not essential to get
-            # every case for previous_files; a few extra downloads won't hurt...
-            if not os.path.exists(location):
-                location = None
-                for loc in file.getFinalLocation():
-                    if os.path.exists(loc):
-                        location = loc
-                        break
-            if location != None:
-                previous_files[file.checksum] = (location, file.checksum, file.checksum_type)
-
-        # if count<10: print mod_file.abs_path, mod_file.dataset_name, location
-        # count+=1
-
-    # Now that copies have been made of the existing (old) dataset and its files, we want
-    # to delete the originals to make room for the new versions; and also delete those files'
-    # file_access rows (there's no need for a copy of the file_access data - it's old, so if we
-    # don't have it, we don't want it).
-    # A cascading delete of the datase would do the job, and SQLAlchemy deletes are normally cascading.
-    # However, occasionally a spurious lock makes the cascading delete hang.  Maybe it has to do with
-    # the fact that Postgres is set up with non-cascading deletes.  The solution is to explicitly
-    # delete the file and file_access data.
-    # Here is straightfoward SQL to do that deletion.  It could be executed with
-    # "engine.execute(sqltext(sqlcommand)) but that affects only the database, not the orm
-    # representation which is generally how thses scripts work.  So we can't just run this SQL...
-    # sqlcommandfa= "DELETE FROM replica.file_access WHERE abs_path IN ( SELECT abs_path FROM replica.files"+
-    #           " WHERE dataset_name='"+rd.name+"');"
-    # sqlcommandf = "DELETE FROM replica.files WHERE dataset_name='"+rd.name+"';"
-    # Following are the SQLAlchemy query-delete calls which are equivalent to the above SQL, but
-    # very much slower.
-
-    # Delete the file_access referencing older version files: we don't want them.
-    rep_s.flush()  # makes the new file.dataset_name visible to file_access rows
-    # N.B. the with_labels() is probably unnecessary: it's a remnant of some messing around...
-#    fquery  = rep_s.query(ReplicaFile         ).filter(ReplicaFile.dataset_name.like(rd.name)).with_labels()
-#    fsquery = rep_s.query(ReplicaFile.abs_path).filter(ReplicaFile.dataset_name.like(rd.name)).with_labels()
-    fsquery = rep_s.query(ReplicaFile.abs_path).filter(ReplicaFile.dataset_name.like(mod_rd.name)).with_labels()
-    aquery = rep_s.query(ReplicaAccess).filter(ReplicaAccess.abs_path.in_(fsquery))
-    # an = aquery.delete(synchronize_session=False)
-    an = aquery.delete(synchronize_session='fetch')
-
-#    # When the older version files were copied, we would have deleted the originals here...
-    # fn = fquery.delete(synchronize_session=False)
-#    fn = fquery.delete(synchronize_session='fetch')
-#    rmlog.info("jfp %d files rows deleted; now about to delete older version dataset, time=%d"%(fn,td))
-    rmlog.info("jfp %d file_access rows deleted; about to commit"%(an))
-    # The commit is needed so that the dataset will know that there are no longer files pointing to it.
-    # Maybe just a flush() would be good enough.
-    rep_s.commit()
+    # Everything is done with a few set-based statements in a single transaction, instead of
+    # changing every file through the orm and deleting its file_access rows with
+    # synchronize_session='fetch' (which took minutes for large datasets).
+    files = ReplicaFile.__table__
+    access = ReplicaAccess.__table__
+    datasets = ReplicaDataset.__table__
+    old_name = "old_"+str(rd.version)+'_'+rd.name
+    rep_s.flush()   # whatever is pending must be in the DB before we work on it directly
 
-    # Finally, it's safe to delete the old dataset:
-    rep_s.delete(rd)
+    # rd is obsolete.  Make a copy with a different name and status...
+    rep_s.execute( datasets.insert(), dict( name=old_name, version=rd.version,\
+                   status=STATUS.OBSOLETE, gateway=rd.gateway, parent=rd.parent,\
+                   size=rd.size, filecount=rd.filecount, catalog=rd.catalog ) )
+
+    # Remember where the old files are, so they can be found later.
+    rows = rep_s.execute( sql.select([files.c.abs_path, files.c.checksum, files.c.checksum_type],\
+                                     files.c.dataset_name==rd.name) ).fetchall()
+    candidates = []
+    for abs_path, checksum, checksum_type in rows:
+        f = ReplicaFile(abs_path=abs_path)
+        # This could miss the case where a copy of the file had previously been downloaded
+        # to a different directory (e.g. css01,css02,gdo2); but it's not essential to get
+        # every case for previous_files; a few extra downloads won't hurt...
+        candidates.append( ([f.getDownloadLocation()]+f.getFinalLocations(), checksum, checksum_type) )
+    existing = existing_files([loc for locations, checksum, checksum_type in candidates\
+                               for loc in locations])
+    for locations, checksum, checksum_type in candidates:
+        for location in locations:
+            if location in existing:
+                previous_files[checksum] = (location, checksum, checksum_type)
+                break
+
+    # The files pointing to rd should instead point to the copy.  We don't want the file_access
+    # rows of the older version files (it's old, so if we don't have it, we don't want it),
+    # and finally the old dataset can go.
+    # A cascading delete of the dataset is avoided on purpose: occasionally a spurious lock makes
+    # it hang (Postgres is set up with non-cascading deletes).
+    fn = rep_s.execute( files.update().where(files.c.dataset_name==rd.name).\
+                        values(dataset_name=old_name) ).rowcount
+    an = rep_s.execute( access.delete().where(access.c.abs_path.in_(\
+                        sql.select([files.c.abs_path], files.c.dataset_name==old_name))) ).rowcount
+    rep_s.execute( datasets.delete().where(datasets.c.name==rd.name) )
+    rmlog.info("jfp %d files moved to %s, %d file_access rows deleted; about to commit"%(fn,old_name,an))
+
+    # The orm doesn't know about any of this, rd must go from the session.
+    if rd in rep_s: rep_s.expunge(rd)
     rep_s.commit()
-
-
-
-def fill_replica_db(allow_empty_md5=True):
-    """The replica DB will be initialized with data from files that need to be replicated"""
+    rmlog.debug("dataset %s pushed aside in %.1f seconds"%(rd.name,time.time()-t0))
+
+
+
+def bulk_insert_files(session, file_rows, access_rows, chunk_size=5000):
+    """Insert rows (dictionaries) into replica.files and replica.file_access with executemany.
+    This runs in the session's current transaction, so a rollback discards them as well.
+    All rows of a table must have the same keys."""
+    # the dataset the files point to must be in the DB first
+    session.flush()
+    for table, rows in ((ReplicaFile.__table__, file_rows), (ReplicaAccess.__table__, access_rows)):
+        for start in range(0, len(rows), chunk_size):
+            session.execute(table.insert(), rows[start:start+chunk_size])
+
+def add_file_path_columns(engine):
+    """Adds the derived columns of replica.files (basename, nv_path) and their indices if the
+    table predates them; the ORM can't query the table without them.  This is cheap when they
+    are there already, so it's done whenever the engine is created (see getEngine).  Existing rows
+    get their values from index_file_paths."""
+    files = ReplicaFile.__table__
+    try:
+        engine.execute(sql.select([files.c.basename, files.c.nv_path]).limit(1))
+        return
+    except exc.DBAPIError:
+        pass
+    rmlog.info("adding columns basename, nv_path to %s"%files.fullname)
+    for column in ('basename', 'nv_path'):
+        engine.execute("ALTER TABLE %s ADD COLUMN %s VARCHAR"%(files.fullname, column))
+    for index in files.indexes:
+        try:
+            index.create(engine)
+            rmlog.info("created index %s"%index.name)
+        except exc.DBAPIError:
+            pass    # it's already there
+
+def index_file_paths(batch_size=10000):
+    """Maintenance of the derived columns of replica.files (basename, nv_path): fills them in for
+    rows which don't have them (the columns themselves are added by getEngine)."""
+    engine = getEngine()
+    files = ReplicaFile.__table__
+
+    update = files.update().where(files.c.abs_path==sql.bindparam('old_abs_path')).\
+             values(basename=sql.bindparam('new_basename'), nv_path=sql.bindparam('new_nv_path'))
+    done = 0
+    while True:
+        conn = engine.connect()
+        trans = conn.begin()
+        try:
+            rows = conn.execute(sql.select([files.c.abs_path], files.c.basename==None).\
+                                limit(batch_size)).fetchall()
+            if rows:
+                conn.execute(update, [dict(old_abs_path=r[0], new_basename=os.path.basename(r[0]),\
+                                           new_nv_path=strip_version(r[0])) for r in rows])
+            trans.commit()
+        except:
+            trans.rollback()
+            raise
+        finally:
+            conn.close()
+        done += len(rows)
+        if len(rows) < batch_size: break
+        rmlog.info("%d files indexed so far"%done)
+    rmlog.info("%d files indexed"%done)
+
+def fill_replica_db(allow_empty_md5=True, prefetch=8):
+    """The replica DB will be initialized with data from files that need to be replicated.
+    The gateway metadata and file lists of the next prefetch datasets are requested while the
+    current one is processed."""
     import gateway
-    global config, archive_root0,rmlog
+    from esgcet.model import Dataset
+    global rmlog
     rep_s = getReplicaDB()
+    config = getConfig()
 
     known = set()
 
@@ -427,7 +545,20 @@ def fill_replica_db(allow_empty_md5=True):
       #jfp     rmlog.debug( "1 ", dataset[0] )
 
 #jfp: was    for dataset in view_e.execute(sql.text("SELECT d.id, d.version, parent_gateway, size, filecount, parent_id, catalog from (SELECT id, max(version) as version from global.datasets group by id) as uniq join global.datasets as d on (uniq.id=d.id and uniq.version=d.version) WHERE d.parent_gateway = d.master_gateway AND d.id like :dataset"), dataset=dataset_match).fetchall():
-    for dataset in view_e.execute(sql.text("SELECT d.id, d.version, parent_gateway, size, filecount, parent_id, catalog from (SELECT id, max(version) as version from global.datasets group by id) as uniq join global.datasets as d on (uniq.id=d.id and uniq.version=d.version) WHERE                                              d.id like :dataset"), dataset=dataset_match).fetchall():
+    all_datasets = view_e.execute(sql.text("SELECT d.id, d.version, parent_gateway, size, filecount, parent_id, catalog from (SELECT id, max(version) as version from global.datasets group by id) as uniq join global.datasets as d on (uniq.id=d.id and uniq.version=d.version) WHERE                                              d.id like :dataset"), dataset=dataset_match).fetchall()
+
+    #the gateway calls which will be needed: for datasets we don't have, or have an older version of
+    replica_versions = dict( rep_s.query(ReplicaDataset.name, ReplicaDataset.version).\
+                             filter(ReplicaDataset.name.like(dataset_match)).all() )
+    calls = []
+    for dataset in all_datasets:
+        if dataset['id'] not in replica_versions or replica_versions[dataset['id']]<dataset['version']:
+            calls.append( (dataset['parent_gateway'], 'getMetadata', dataset['id']) )
+            calls.append( (dataset['parent_gateway'], 'listFiles', dataset['id']) )
+    client = gateway.GatewayClient(workers=max(1,prefetch/2))
+    remote = client.prefetch(calls, ahead=2*prefetch)
+
+    for dataset in all_datasets:
         #fast skip datasets already ingested or in the proces
         if '%s#%s' % (dataset['id'],dataset['version']) in known:
             dataset_name = dataset['id']
@@ -475,7 +606,7 @@ def fill_replica_db(allow_empty_md5=True):
             #jfp ...former else: clause
                 
             #check this is what we expect (e.g. no new version in between)
-            dataset_remote = gateway.main(('-g %s --parent %s -mo' % (dataset_gateway, dataset_name)).split(' '))
+            dataset_remote = remote.get(dataset_gateway, 'getMetadata', dataset_name)
             if dataset_remote is None:
                 continue              
 
@@ -542,10 +673,13 @@ def fill_replica_db(allow_empty_md5=True):
             #there's nothing local
 
             #now get remote files
-            dataset_remote_files = gateway.main(('-g %s --parent %s -of' % (dataset_gateway, dataset_name)).split(' '))
+            dataset_remote_files = remote.get(dataset_gateway, 'listFiles', dataset_name)
             if dataset_remote_files is None:
                 continue
-            files_added=[]  # added by jfp for duplicate check
+            # Rows are collected here and written in bulk once the dataset is complete (the ORM
+            # unit of work is far too slow for large datasets).
+            file_rows = {}    # abs_path -> replica.files row; also used as duplicate check (jfp)
+            access_rows = []  # replica.file_access rows
             for file in dataset_remote_files:
                 if dataset.id.split('.')[1]=='output2':
                     # Not only is output2 data unimportant, but it is susceptible to drslib errors
@@ -595,14 +729,15 @@ def fill_replica_db(allow_empty_md5=True):
                         catalog_chksums = {}
                         #get it from the catalog
                         try:
-                            md_files = catalog.getDatasetMetadata(dataset_catalog)['files']
+                            #stream the catalog, we only need the file checksums
+                            for kind, md_file in catalog.iterDatasetMetadata(dataset_catalog):
+                                if kind == 'file' and 'checksum' in md_file:
+                                    catalog_chksums[md_file['file_id'].split('.')[9] + '.nc'] = (md_file['checksum'],
+                                        md_file['checksum_type'])
                         except:    # may fail because url doesn't work any more
                             rmlog.warn( "problem finding catalog checksums for "+file['name'] )
+                            catalog_chksums = {}
                             continue
-                        for md_file in md_files:
-                            if 'checksum' in md_file:
-                                catalog_chksums[md_file['file_id'].split('.')[9] + '.nc'] = (md_file['checksum'],
-                                    md_file['checksum_type'])
                     
                     if file['name'] in catalog_chksums:
                         file_checksum, file_checksum_type = catalog_chksums[file['name']]
@@ -623,21 +758,14 @@ def fill_replica_db(allow_empty_md5=True):
                     rmlog.warn( "Missing Checksum" )
                     commit_changes = False
                     break
-                try:
-                    if abs_path in files_added:  #jfp added duplicate check
-                        rmlog.warn( "skipping second instance of %s"%(abs_path) )
-                        continue
-                    else:
-                        files_added.append(abs_path)
-                        rep_s.add(ReplicaFile(\
-                            abs_path=abs_path, dataset_name=dataset_name, checksum=file_checksum,\
-                            checksum_type=file_checksum_type, size=file['size'] ))
-                except:
-                    rmlog.warn( "Could not add file to db. Skipping dataset %s" % dataset_name )
-                    
-                    rmlog.warn( sys.exc_info()[:3] )
-                    commit_changes = False
-                    break
+                if abs_path in file_rows:  #jfp added duplicate check
+                    rmlog.warn( "skipping second instance of %s"%(abs_path) )
+                    continue
+                file_rows[abs_path] = dict(\
+                    abs_path=abs_path, dataset_name=dataset_name, checksum=file_checksum,\
+                    checksum_type=file_checksum_type, size=file['size'], mtime=None,\
+                    status=STATUS.UNINIT, basename=os.path.basename(abs_path),\
+                    nv_path=strip_version(abs_path) )
                 
                 #compute file access
                 # jfp added check on DUMMY - it's not an error to be warned about, but the previous_files
@@ -657,7 +785,7 @@ def fill_replica_db(allow_empty_md5=True):
                     if os.path.getsize(location)==file['size']:
                         #this file is locally available, so we use the file: protocol to mark this
                         #no other check is required
-                        rep_s.add(ReplicaAccess(abs_path=abs_path,url='file://' + location,type='local'))
+                        access_rows.append(dict(abs_path=abs_path,url='file://' + location,type='local'))
 
                 #this file is new
                 #jfp: In rare occasions (e.g. ICHEC) endpoints can have two copies of the same endpoint!
@@ -675,16 +803,17 @@ def fill_replica_db(allow_empty_md5=True):
                         eps.append( file['endpoints'][i] )
                 #jfp was for ep in file['endpoints']:
                 for ep in eps:
-                    rep_s.add(ReplicaAccess(abs_path=abs_path,url=ep['url'],type=ep['type']))
+                    access_rows.append(dict(abs_path=abs_path,url=ep['url'],type=ep['type']))
 
             #we are done with this dataset!
             if commit_changes:
                 #should we update file count? (this happens if a new version was found)
                 if int(rep_ds.filecount) <= 0:
-                    rep_ds.filecount = len(rep_ds.files)
-                    rep_ds.size = sum([f.size for f in rep_ds.files])
+                    rep_ds.filecount = len(file_rows)
+                    rep_ds.size = sum([int(f['size']) for f in file_rows.values()])
                 rep_ds.status = STATUS.INIT
                 try:
+                    bulk_insert_files(rep_s, file_rows.values(), access_rows)
                     rep_s.commit()
                 except exc.IntegrityError as e:
                     rmlog.warn("Cannot process dataset %s due to IntegrityError %s" % (dataset,e) )
@@ -698,7 +827,9 @@ def fill_replica_db(allow_empty_md5=True):
             rmlog.warn( "Can't process dataset %s an exception was found." % dataset )
             rmlog.warn( sys.exc_info()[:3] )
             rep_s.rollback()
+            client.close()
             raise
+    client.close()
 
     #flush all pending operations (there are breaks in there, this is a MUST.
     #rep_s.commit()
@@ -708,18 +839,22 @@ def fill_replica_db(allow_empty_md5=True):
 
 
 
-def update_replica_db():
+def update_replica_db(prefetch=8):
     """Update the metadata we have with that from the catalog. This is mainly intended to 
     be used for those cases where the catalog changes without issuing a new version (e.g.
-    adding or correcting checksums)"""
+    adding or correcting checksums).  The file lists of the next prefetch datasets are requested
+    from the gateways while the current one is processed."""
     rep_s = getReplicaDB()
     import gateway
 
-    for dataset in rep_s.query(ReplicaDataset).filter(ReplicaDataset.name.like(dataset_match)):
+    datasets = rep_s.query(ReplicaDataset).filter(ReplicaDataset.name.like(dataset_match)).all()
+    client = gateway.GatewayClient(workers=prefetch)
+    remote = client.prefetch([ (d.gateway, 'listFiles', d.name) for d in datasets ], ahead=prefetch)
+    for dataset in datasets:
         rmlog.info( "checking %s (%s files)" % (dataset.name, len(dataset.files)) )
         #cache file results
         results = {}
-        allfiles = gateway.main(('-g %s --parent %s -fo' % (dataset.gateway, dataset.name)).split(' '))
+        allfiles = remote.get(dataset.gateway, 'listFiles', dataset.name)
         if allfiles is None: continue
         #...moving on in this case means we don't delete a dataset not found at the server - the right
         # thing to do if it's a temporary server problem, but wrong if the dataset really has been
@@ -822,6 +957,7 @@ def update_replica_db():
         if rep_s.dirty:
             rmlog.info( "Committing changes for %s  file(s)" % changed_files )
             rep_s.commit()
+    client.close()
         
 
 #################################################
@@ -1001,60 +1137,189 @@ def create_download_lists(file=None, type=None):
 
     
 
-def finish_first_checksum_process( procs, ds_incomplete, published=False, wherefrom=0 ):
-    """This is called from verify_datasets().  It will have set up several checksumming processes, each
-    of which can be identified by a [file,process] pair. where the process is a checksum computation on
-    the file.  The first argument of this function, procs, is a list of such pairs.
-    Here we wait for the first process of the list to complete; and then handle the results of the
-    process.  The other arguments are the ds_incomplete flag of verify_datasets() and an output marker
-    to identify where this function was called from. """
-
-    chk_file, proc = procs[0]
-    if proc.wait() != 0:    #wait until first is free:
-        #clean and finish dataset
-        rmlog.warn( "%s checksum reported an error: '%s'" %(chk_file.abs_path, proc.communicate()[1]) )
+#####################################################
+##### -- Mapfiles --- ##############################
+###################################################
+
+def mapfile_line(dataset_name, path, size, mtime, checksum_type, checksum):
+    """One line (without the newline) of a mapfile for esgpublish"""
+    return '|'.join([dataset_name, path, str(size), 'mod_time=%f|checksum_type=%s|checksum=%s' %\
+                     (mtime, checksum_type, checksum)])
+
+def _getmtime(path):
+    try:
+        return os.path.getmtime(path)
+    except OSError:
+        return None
+
+def _final_locations(abs_paths):
+    """For each abs_path, the first of its final locations (see ReplicaFile.getFinalLocations)
+    which exists, or None."""
+    getConfig()
+    roots = [ archive_root0, archive_root1, archive_root2, archive_root3 ]
+    existing = existing_files([ os.path.join(root, p) for p in abs_paths for root in roots ])
+    locations = []
+    for p in abs_paths:
+        found = [ os.path.join(root, p) for root in roots if os.path.join(root, p) in existing ]
+        locations.append( found and found[0] or None )
+    return locations
+
+def _close_mapfile(out, output_dir, dataset_name, failed):
+    """Close the mapfile of a dataset written to output_dir; an incomplete one is discarded."""
+    out.close()
+    path = os.path.join(output_dir, dataset_name + '.map')
+    if dataset_name in failed: os.remove(path + '.tmp')
+    else: os.rename(path + '.tmp', path)
+
+def write_mapfiles(dataset_names, output=None, output_dir=None, root=None, threads=16,\
+                   batch_size=1000):
+    """Writes the mapfiles of many datasets in one pass, without loading their files through the
+    orm or building the mapfiles in memory.  Either all go to output (a file name, default stdout),
+    or there is one <dataset>.map per dataset in output_dir.  Files are taken from root if given,
+    else from whichever of their final locations exists.
+    File rows are read batch_size at a time through a server-side cursor (where the driver has
+    one).  Stored mtimes are used as they are; missing ones are looked up by a pool of threads,
+    a batch at a time, and stored in the DB for the next time.
+    Returns the names of the datasets whose mapfile couldn't be written completely."""
+    from multiprocessing.pool import ThreadPool
+    files = ReplicaFile.__table__
+    engine = getEngine()
+    pool = ThreadPool(threads)
+    failed = set()
+    new_mtimes = []
+    out = current = None
+    if output_dir is None:
+        if output: out = open(output, 'w')
+        else: out = sys.stdout
+    conn = engine.connect()
+    try:
+        # a few hundred names at a time, IN clauses can't be arbitrarily long
+        for start in range(0, len(dataset_names), 500):
+            query = sql.select([files.c.dataset_name, files.c.abs_path, files.c.size, files.c.mtime,\
+                                files.c.checksum_type, files.c.checksum],\
+                               files.c.dataset_name.in_(dataset_names[start:start+500])).\
+                    order_by(files.c.dataset_name, files.c.abs_path)
+            result = conn.execution_options(stream_results=True).execute(query)
+            while True:
+                rows = result.fetchmany(batch_size)
+                if not rows: break
+                if root: paths = [ os.path.join(root, r.abs_path) for r in rows ]
+                else: paths = _final_locations([ r.abs_path for r in rows ])
+                todo = [ i for i in range(len(rows)) if not rows[i].mtime and paths[i] ]
+                mtimes = dict(zip(todo, pool.map(_getmtime, [ paths[i] for i in todo ])))
+                for i in range(len(rows)):
+                    r = rows[i]
+                    if output_dir is not None and r.dataset_name != current:
+                        if current: _close_mapfile(out, output_dir, current, failed)
+                        current = r.dataset_name
+                        out = open(os.path.join(output_dir, current + '.map.tmp'), 'w')
+                    if paths[i] is None:
+                        rmlog.error("%s isn't in any final location, mapfile of %s is incomplete"%\
+                                    (r.abs_path, r.dataset_name))
+                        failed.add(r.dataset_name)
+                        continue
+                    mtime = r.mtime or mtimes.get(i)
+                    if mtime is None:
+                        rmlog.error("%s not found, mapfile of %s is incomplete"%\
+                                    (r.abs_path, r.dataset_name))
+                        failed.add(r.dataset_name)
+                        continue
+                    if not r.mtime: new_mtimes.append(dict(old_abs_path=r.abs_path, new_mtime=mtime))
+                    out.write(mapfile_line(r.dataset_name, paths[i], r.size, mtime,\
+                                           r.checksum_type, r.checksum) + '\n')
+        if current: _close_mapfile(out, output_dir, current, failed)
+        current = None
+    finally:
+        conn.close()
+        pool.close()
+        if current:
+            # interrupted in the middle of a dataset, don't leave its partial mapfile behind
+            out.close()
+            tmp = os.path.join(output_dir, current + '.map.tmp')
+            if os.path.exists(tmp): os.remove(tmp)
+        if output_dir is None:
+            if output: out.close()
+            else: out.flush()
+
+    # only now, the DB may not allow writing while the cursor was open (sqlite)
+    if new_mtimes:
+        update = files.update().where(files.c.abs_path==sql.bindparam('old_abs_path')).\
+                 values(mtime=sql.bindparam('new_mtime'))
+        for start in range(0, len(new_mtimes), 5000):
+            engine.execute(update, new_mtimes[start:start+5000])
+    if failed: rmlog.warn("%d mapfiles are incomplete"%len(failed))
+    return sorted(failed)
+
+def _mapfile_datasets():
+    """Names of the datasets matching --dataset which are in their final directory (or beyond)."""
+    session = getReplicaDB()
+    query = session.query(ReplicaDataset.name).filter(ReplicaDataset.status>=STATUS.FINAL_DIR).\
+            filter(ReplicaDataset.name.like(dataset_match)).order_by(ReplicaDataset.name)
+    return [ r[0] for r in query ]
+
+def create_mapfile(file=None):
+    """A single mapfile for all datasets ready to be published, to file (default stdout)."""
+    return write_mapfiles(_mapfile_datasets(), output=file)
+
+def dumpMapfiles(output_dir=None):
+    """A mapfile per dataset ready to be published, in output_dir (default: the current one)."""
+    return write_mapfiles(_mapfile_datasets(), output_dir=output_dir or '.')
+
+def handle_checksum_result( chk_file, chksum, error, ds_incomplete, published=False, wherefrom=0,
+                            recheck=None ):
+    """This is called from verify_datasets().  It will have submitted checksum computations to a
+    checksum_pool.ChecksumPool; whenever one of them completes, this function handles its result.
+    chk_file is the file which was checksummed, chksum the computed checksum and error is None, or
+    a description of what went wrong.  The other arguments are the ds_incomplete flag of
+    verify_datasets(), whether the file was found in a published location and an output marker
+    to identify where this function was called from.  If recheck is a list, a file with a bad
+    checksum is appended to it instead of having its previous downloads verified right away, see
+    verify_previous_downloads_parallel().  Returns the updated ds_incomplete flag."""
+
+    if error is not None:
+        #clean and finish file
+        rmlog.warn( "%s checksum reported an error: '%s'" %(chk_file.abs_path, error) )
         if not published:
             chk_file.status = STATUS.ERROR
             chk_file.dataset.status = STATUS.ERROR
             ds_incomplete = True
-        return None,None,ds_incomplete   #something unexpected is wrong, we can't continue
-    else:
-        #md5 are always 32 char lang
-        chksum = proc.communicate()[0][:32]
-        if published:
-            if chksum == chk_file.checksum:
-                # Checksum is good; for a published file (or just in its final directory) we knew it
-                # was good; this just means we're looking at the same version of the file.
-                chk_file.status = max(chk_file.status,STATUS.FINAL_DIR)
-            else:
-                # We trust the published file, and we trust the catalog checksum.
-                # They don't agree!  But we don't (yet) know the published file's dataset version.
-                # It must be different, we shouldn't have checked this file in the first place;
-                # do nothing.
-                pass
-        else:   # unpublished data
-            if chksum != chk_file.checksum:
-                #checksum mismatch!
-                rmlog.warn( "%s checksum mismatch %s vs %s (%s)" % \
-                            (chk_file.abs_path, chksum, chk_file.checksum,wherefrom) )
-                chk_file.status = STATUS.ERROR
-                chk_file.dataset.status = STATUS.ERROR
+        return ds_incomplete
+    if published:
+        if chksum == chk_file.checksum:
+            # Checksum is good; for a published file (or just in its final directory) we knew it
+            # was good; this just means we're looking at the same version of the file.
+            chk_file.status = max(chk_file.status,STATUS.FINAL_DIR)
+        else:
+            # We trust the published file, and we trust the catalog checksum.
+            # They don't agree!  But we don't (yet) know the published file's dataset version.
+            # It must be different, we shouldn't have checked this file in the first place;
+            # do nothing.
+            pass
+    else:   # unpublished data
+        if chksum != chk_file.checksum:
+            #checksum mismatch!
+            rmlog.warn( "%s checksum mismatch %s vs %s (%s)" % \
+                        (chk_file.abs_path, chksum, chk_file.checksum,wherefrom) )
+            chk_file.status = STATUS.ERROR
+            chk_file.dataset.status = STATUS.ERROR
+            if recheck is None:
                 file = verify_previous_downloads(chk_file,do_checksums=True)
-                ds_incomplete = True
-                #there's no harm in continuing with the rest
             else:
-                #That file is ready!
-                chk_file.status = STATUS.RETRIEVED
+                recheck.append( (chk_file,True) )
+            ds_incomplete = True
+            #there's no harm in continuing with the rest
+        else:
+            #That file is ready!
+            chk_file.status = STATUS.RETRIEVED
 
-    #we now have 1 process slot free
-    procs = procs[1:]
-    return procs, chk_file, ds_incomplete
+    return ds_incomplete
 
 def swapfile( fullpath1, fullpath2 ):
     """swap files in two locations, known  not to have a subdirectory tmp4jfp"""
     (path1,file1) = os.path.split(fullpath1)
     (path2,file2) = os.path.split(fullpath2)
-    tmpdir = os.mkdir( os.path.join(path1,"tmp4jfp") )
+    tmpdir = os.path.join(path1,"tmp4jfp")
+    os.mkdir( tmpdir )
     shutil.move( fullpath1, tmpdir )
     shutil.move( fullpath2, path1 )
     shutil.move( os.path.join(tmpdir,file1), path2 )
@@ -1086,25 +1351,22 @@ def verify_previous_downloads( file, do_checksums=True ):
         badfile = os.path.join( baddir,filename )
         if not os.path.isfile(badfile):
             continue    # baddir doesn't have the file in question.
-        if os.path.getsize(badfile)<0:  # incomplete file in bad0 or bad1, get rid of it
-            os.remove(badfile)
-            continue
-        if os.path.getsize(badfile)>0:  # size is wrong, so file is bad
+        if os.path.getsize(badfile)!=file.size:  # size is wrong, so file is bad
             nbad = nbad + 1
             continue
         # At this point baddir has the file in question, of the right length.
         if do_checksums==False or file.checksum.upper()=='DUMMY':
-            swapfiles(badfile,fullpath)
+            swapfile(badfile,fullpath)
             havegood = True
             break
         if not( file.checksum_type == 'md5' or file.checksum_type=='MD5' ):
             continue  # shouldn't get here
         # Checksum for badfile.  This occurs rarely enough so we don't need the speedup of forking of
         # another process.
-        import pymd5
-        csum = pymd5.md5(badfile)
+        import checksum_cache
+        csum = checksum_cache.getCache().checksum(badfile)
         if csum == file.checksum:
-            swapfiles(badfile,fullpath)
+            swapfile(badfile,fullpath)
             havegood = True
             checksum_done = True
             break
@@ -1125,6 +1387,81 @@ def verify_previous_downloads( file, do_checksums=True ):
         pass
     return file
 
+def verify_previous_downloads_parallel( files, pool, cache=None ):
+    """Does what verify_previous_downloads() does, for many files at once.  files is a list of
+    (file,do_checksums) pairs.  First the sizes of all previous downloads are compared; only those
+    of the right size get checksummed, all concurrently in pool (a checksum_pool.ChecksumPool with
+    nothing else pending).  If cache (a checksum_cache.ChecksumCache) is provided, checksums found
+    there aren't computed again, and new ones are stored in it - thus when a download is bad again
+    and again, its older copies in bad0,bad1 are read only once."""
+    plans = []     # (file, fullpath, nbad, candidates), candidates = [(badfile,st or None)]
+    checksums = {} # badfile -> checksum
+    for file, do_checksums in files:
+        fullpath = file.location
+        if not os.path.isfile(fullpath):
+            rmlog.warn("verify_previous_downloads called incorrectly with %s",fullpath)
+            continue
+        if fullpath and fullpath.find('/data/')>0:
+            rmlog.error("verify_previous_downloads called on published file %s",fullpath)
+            continue
+        (path,filename) = os.path.split(fullpath)
+        if not os.path.isfile( os.path.join(path,'bad1',filename) ):
+            # same shortcut as in verify_previous_downloads()
+            continue
+        nbad = 1
+        candidates = []
+        for n in range(2):
+            badfile = os.path.join( path, 'bad'+str(n), filename )
+            try:
+                st = os.stat(badfile)
+            except OSError:
+                continue    # baddir doesn't have the file in question.
+            if st.st_size!=file.size:  # size is wrong, so file is bad
+                nbad = nbad + 1
+                continue
+            if do_checksums==False or file.checksum.upper()=='DUMMY':
+                candidates.append( (badfile,None) )   # good enough without a checksum
+                break
+            if not( file.checksum_type == 'md5' or file.checksum_type=='MD5' ):
+                continue  # shouldn't get here
+            candidates.append( (badfile,st) )
+            csum = cache.get(badfile,st=st) if cache else None
+            if csum is not None:
+                checksums[badfile] = csum
+            else:
+                pool.submit(badfile, tag=(badfile,st))
+        plans.append( (file, fullpath, nbad, candidates) )
+
+    for (badfile,st), path, chksum, error in pool.results():
+        if error is not None:
+            rmlog.warn( "%s checksum reported an error: '%s'" %(badfile, error) )
+            continue
+        checksums[badfile] = chksum
+        if cache: cache.put(badfile, chksum, st=st)
+
+    for file, fullpath, nbad, candidates in plans:
+        havegood = False
+        checksum_done = False
+        for badfile,st in candidates:
+            if st is None:
+                swapfile(badfile,fullpath)
+                havegood = True
+                break
+            if checksums.get(badfile) == file.checksum:
+                swapfile(badfile,fullpath)
+                havegood = True
+                checksum_done = True
+                break
+            nbad = nbad + 1
+        if havegood==True:
+            if checksum_done==True:
+                file.status = STATUS.RETRIEVED
+            else:
+                file.status = STATUS.VERIFYING
+        elif nbad>=3:
+            file.status = STATUS.MULTIPLE_ERRORS
+    if cache: cache.commit()
+
 def pcmdi_dbify( location ):
     """locaton is a full path to a file on gdo2.llnl.gov, beginning '/cmip5/data/cmip5/'.
     This function will return a corresponding (strictly-DRS) path from the database,
@@ -1132,7 +1469,7 @@ def pcmdi_dbify( location ):
     compare checksums)."""
     filename = os.path.basename(location)
     db = getReplicaDB()
-    dbq = db.query(ReplicaFile).filter(ReplicaFile.abs_path.like('%/'+filename))
+    dbq = db.query(ReplicaFile).filter(ReplicaFile.basename==filename)
     dbfiles = dbq.all()
     if len(dbfiles)==1:
         return (dbfiles[0]).abs_path
@@ -1149,16 +1486,17 @@ def pcmdi_dbify( location ):
             if v>vmax:
                 vmax = v
                 fmax = f
-        return f
+        return fmax.abs_path
 
-def pcmdi_ify( location ):
+def pcmdi_ify( location, index=None ):
     """location is a full path to a file on gdo2.llnl.gov, beginning, e.g.,'/cmip5/data/cmip5/'.
     The path will formed as a root plus a (strictly-DRS) path from the database.
     This function will return a similar path where the file may actually be found, or None
     if it cannot be found.
     If there are multiple versions, this function will return the most recent version (ideally we'd
     compare checksums).  Note that, in this process, the DRS date-based version number is dropped.
-    There is no guarantee that the returned path will correspond to this DRS version number."""
+    There is no guarantee that the returned path will correspond to this DRS version number.
+    If index (a location_index.LocationIndex) is given, directory listings are taken from it."""
     # example in comments: '/cmip5/data/cmip5/output1/IPSL/IPSL-CM5A-LR/historical/mon/atmos/Amon/
     # r1i1p1/v20110406/ts/ts_Amon_IPSL-CM5A-LR_historical_r1i1p1_185001-200512.nc'
     file = os.path.basename( location ) # e.g. ts_Amon_IPSL-CM5A-LR_historical_r1i1p1_185001-200512.nc
@@ -1170,7 +1508,11 @@ def pcmdi_ify( location ):
     drs_vers = os.path.basename( dir2 ) # e.g. v20110406
     dir3 = os.path.dirname( dir2 )      # e.g. .../r1i1p1/
     ndir2 = os.path.join( dir3, var )   # e.g. .../r1i1p1/ts/
-    if os.path.isdir(ndir2):
+    if index is not None:
+        ld2 = index.listdir( ndir2 )
+        if not ld2: return None
+        ld2 = list(ld2)
+    elif os.path.isdir(ndir2):
         ld2 = os.listdir( ndir2 )           # e.g. ['1','2']
     else:
         return None
@@ -1200,8 +1542,11 @@ def verify_datasets(skip_hardlinks=False,do_checksums=True,pcmdipub=False):
     If do_checksums==False, this function will just check whether the file exists and has
     the right length.  If do_checksums='Verified', any file which exists is guaranteed to
     have the right checksum as well, so the checksum will not be re-computed."""
-    import subprocess
+    import checksum_pool
+    import checksum_cache
+    import location_index
     import pubpath2version
+    config = getConfig()
 
     if not pcmdipub:
         dlroot0 = files_dir0     # on gdo2: /cmip5/scratch
@@ -1242,11 +1587,23 @@ def verify_datasets(skip_hardlinks=False,do_checksums=True,pcmdipub=False):
     else:
         matching_datasets = query1.all()
 
+    #checksums are computed by a pool of worker processes; results are handled as they complete.
+    max_proc = 16
+    pool = checksum_pool.ChecksumPool(processes=max_proc)
+    #where files were found last time, so we don't have to search all candidate roots again
+    index = location_index.LocationIndex(config.get('replication', 'location_index',\
+                                default=os.path.expanduser('~/.esgcet/location_index.db')))
+    #checksums of files which didn't change since they were last read, so re-runs don't read them again
+    chk_cache = checksum_cache.getCache(config.get('replication', 'checksum_cache',\
+                                default=checksum_cache.DEFAULT_DB_FILE))
+
     #jfp was for dataset in datasets.filter(ReplicaDataset.name.like(dataset_match)).all():
     for dataset in matching_datasets:
         # If checksums were requested but can't be done, checksums_done will be switched to False
         checksums_done = do_checksums
         idurls = None
+        #files whose previous downloads should be looked at, done together at the end
+        recheck = []
 
         #if dataset.name.find("cmip5.output2")>=0:
         #    # For now, we're not interested in output2 data
@@ -1257,8 +1614,6 @@ def verify_datasets(skip_hardlinks=False,do_checksums=True,pcmdipub=False):
         #    rmlog.info( "Not processing %s" % dataset.name )
         #    continue
         rmlog.info( "Processing %s" % dataset.name )
-        max_proc = 16
-        procs= []
         ds_incomplete = False
         if len(dataset.files)!=dataset.filecount:
             # The dataset's filecount differs from the number of known files in the dataset!
@@ -1281,7 +1636,12 @@ def verify_datasets(skip_hardlinks=False,do_checksums=True,pcmdipub=False):
 
             #jfp new code:
             location = None
+            location_published = False
             candidate_pcmdi_paths = []
+            # first look where we found it last time; but a download may have been linked into
+            # the published tree since, so an unpublished location is used only if it isn't there
+            indexed = index.lookup(abs_path)
+            if indexed and indexed[1]: location, location_published = indexed
             candidate_drs_paths = [ (os.path.join(pubroot0,abs_path),True),
                                     (os.path.join(pubroot1,abs_path),True),
                                     (os.path.join(pubroot2,abs_path),True),
@@ -1290,21 +1650,27 @@ def verify_datasets(skip_hardlinks=False,do_checksums=True,pcmdipub=False):
                                     (os.path.join(dlroot2,abs_path),False),
                                     (os.path.join(dlroot1,abs_path),False),
                                     (os.path.join(dlroot0,abs_path),False) ]
-            for path,pub in candidate_drs_paths:
-                #print "jfp trying path=",path,pub
-                if path and os.path.isfile(path) and os.path.getsize(path)>0:
-                    #print "jfp found path=",path,pub
-                    location = path
-                    location_published = pub
-                    break
             if location==None:
-                candidate_pcmdi_paths = [ (pcmdi_ify(path),pub) for (path,pub) in candidate_drs_paths ]
+                for path,pub in candidate_drs_paths:
+                    #print "jfp trying path=",path,pub
+                    if indexed and not pub:
+                        location, location_published = indexed
+                        break
+                    if path and index.isfile(path):
+                        #print "jfp found path=",path,pub
+                        location = path
+                        location_published = pub
+                        break
+            if location==None:
+                candidate_pcmdi_paths = [ (pcmdi_ify(path,index),pub) for (path,pub) in candidate_drs_paths ]
                 for path,pub in candidate_pcmdi_paths:
-                    if path and os.path.isfile(path) and os.path.getsize(path)>0:
+                    if path and index.isfile(path):
                         #print "jfp found path=",path,pub
                         location = path
                         location_published = pub
                         break
+            if location!=None and (not indexed or location!=indexed[0]):
+                index.record(abs_path, location, location_published)
             #jfp end of new code, but here's a bit for testing
 #            if location!=location0:
 #                if os.path.isfile(location0):
@@ -1349,7 +1715,7 @@ def verify_datasets(skip_hardlinks=False,do_checksums=True,pcmdipub=False):
                                 (location,os.path.getsize(location),file.size) )
                     file.status = STATUS.ERROR
                     file.dataset.status = STATUS.ERROR
-                    file = verify_previous_downloads(file,do_checksums)
+                    recheck.append( (file,do_checksums) )
                     ds_incomplete = True
                 else:  # 0-length file.
                     #Almost always that means a download attempt failed to start.
@@ -1365,7 +1731,7 @@ def verify_datasets(skip_hardlinks=False,do_checksums=True,pcmdipub=False):
                 file.status = STATUS.ERROR
                 file.dataset.status = STATUS.ERROR
                 rmlog.warn( "file %s exceeds the expected size" % location )
-                file = verify_previous_downloads(file,do_checksums)
+                recheck.append( (file,do_checksums) )
                 continue
 
             #update timestamp            
@@ -1426,13 +1792,21 @@ def verify_datasets(skip_hardlinks=False,do_checksums=True,pcmdipub=False):
 
             #check checksum
             if file.checksum_type == 'md5' or file.checksum_type=='MD5':
-                if len(procs) >= max_proc:
-                    #we are not refering to the current file, but some other
-                    procs, chk_file, ds_incomplete = finish_first_checksum_process(\
-                        procs, ds_incomplete, location_published, 1 )
-                    if procs==None: break
-                # if here we may start a new process
-                procs.append((file, subprocess.Popen(['pymd5',location],shell=False, stdout=subprocess.PIPE)))
+                while pool.pending() >= 4*max_proc:
+                    #we are not refering to the current file, but whichever finished first
+                    (chk_file, published, st), path, chksum, error = pool.next()
+                    if error is None: chk_cache.put(path, chksum, st=st)
+                    ds_incomplete = handle_checksum_result(\
+                        chk_file, chksum, error, ds_incomplete, published, 1, recheck )
+                st = os.stat(location)
+                chksum = chk_cache.get(location, st=st)
+                if chksum is not None:
+                    # unchanged since we last read it
+                    ds_incomplete = handle_checksum_result(\
+                        file, chksum, None, ds_incomplete, location_published, 3, recheck )
+                    continue
+                # if here we may queue a new checksum
+                pool.submit(location, tag=(file, location_published, st))
             elif file.checksum_type is not None:
                 rmlog.warn( "checksum of type %s not implemented yet!" % file.checksum_type )
             else: 
@@ -1440,11 +1814,12 @@ def verify_datasets(skip_hardlinks=False,do_checksums=True,pcmdipub=False):
                 rmlog.info( "No checksum infor for %s. Skipping" % location )
 
         #process last checksums!
-        while procs:
-            #we are not refering to the current file, but some other
-            procs, chk_file, ds_incomplete = finish_first_checksum_process(\
-                procs, ds_incomplete, location_published, 2 )
-            if procs==None: break
+        for (chk_file, published, st), path, chksum, error in pool.results():
+            if error is None: chk_cache.put(path, chksum, st=st)
+            ds_incomplete = handle_checksum_result(\
+                chk_file, chksum, error, ds_incomplete, published, 2, recheck )
+        if recheck:
+            verify_previous_downloads_parallel( recheck, pool, chk_cache )
 
         #All files processed check status and update if necesary.
         if ds_incomplete:
@@ -1482,6 +1857,14 @@ def verify_datasets(skip_hardlinks=False,do_checksums=True,pcmdipub=False):
 
         #update DB
         db.commit()
+        index.commit()
+
+    pool.report(rmlog)
+    pool.close()
+    rmlog.info( "location index: %d hits, %d misses" % (index.hits, index.misses) )
+    index.close()
+    chk_cache.report(rmlog)
+    chk_cache.close()
 
 
 #####################################################
@@ -101,7 +101,88 @@ class DAO(object):
         return self._hash
 
 
+def _rows(objects):
+    """Groups the column values of objects by the set of columns which were set on them.
+    Columns never set (or loaded) on an object are left out, as merge() would do, so
+    the DB keeps its value (or default) for them.
+    returns: {(table, column names): (rows, objects)}"""
+    groups = {}
+    for o in objects:
+        table = o.__table__
+        row = {}
+        for c in table.columns:
+            if c.key in o.__dict__: row[c.name] = o.__dict__[c.key]
+        rows, objs = groups.setdefault((table, tuple(sorted(row))), ([], []))
+        rows.append(row)
+        objs.append(o)
+    return groups
+
+def _merge(session, objects, update=True):
+    """The fallback of bulk_upsert: merge() objects one by one. If not update, only those whose
+    primary key isn't in the DB yet."""
+    for o in objects:
+        if not update:
+            mapper = orm.object_mapper(o)
+            if session.query(o.__class__).get(tuple(mapper.primary_key_from_instance(o))) is not None:
+                continue
+        session.merge(o)
+
+def bulk_upsert(session, objects, update=True, chunk_size=1000):
+    """Writes objects without going through the ORM, i.e. without a SELECT per object as merge()
+    does, in chunks of chunk_size rows.
+    update: if set, rows with the same primary key get the new values (upsert), else they are
+        left alone (insert new ones only).
+    The statement used depends on the dialect: ON CONFLICT for SQLite (>= 3.24) and PostgreSQL,
+    ON DUPLICATE KEY UPDATE for MySQL, and INSERT OR REPLACE/IGNORE for older SQLite (where
+    replacing loses the columns not set on the object).  Other dialects fall back to merge().
+    Nothing is committed."""
+    bind_dialect = session.get_bind().dialect
+    dialect = bind_dialect.name
+    #ON CONFLICT came with SQLite 3.24; older ones (e.g. RHEL 6/7's) reject it
+    on_conflict = dialect == 'postgresql' or (dialect == 'sqlite' and \
+                  getattr(bind_dialect.dbapi, 'sqlite_version_info', (0,)) >= (3, 24))
+    for (table, keys), (rows, objs) in _rows(objects).items():
+        pk = [ c.name for c in table.primary_key.columns ]
+        others = [ k for k in keys if k not in pk ]
+        stmt = None
+        if on_conflict:
+            try:
+                if dialect == 'sqlite': from sqlalchemy.dialects.sqlite import insert
+                else: from sqlalchemy.dialects.postgresql import insert
+                stmt = insert(table)
+                if update and others:
+                    stmt = stmt.on_conflict_do_update(index_elements=pk, \
+                                set_=dict([ (k, stmt.excluded[k]) for k in others ]))
+                else:
+                    stmt = stmt.on_conflict_do_nothing(index_elements=pk)
+            except (ImportError, AttributeError):
+                #older SQLAlchemy
+                stmt = None
+        if stmt is None and dialect == 'sqlite':
+            if update: stmt = table.insert().prefix_with('OR REPLACE')
+            else: stmt = table.insert().prefix_with('OR IGNORE')
+        elif dialect == 'mysql':
+            try:
+                from sqlalchemy.dialects.mysql import insert
+                stmt = insert(table)
+                if update and others:
+                    stmt = stmt.on_duplicate_key_update(**dict([ (k, stmt.inserted[k]) for k in others ]))
+                else:
+                    stmt = table.insert().prefix_with('IGNORE')
+            except (ImportError, AttributeError):
+                if update: stmt = None
+                else: stmt = table.insert().prefix_with('IGNORE')
+
+        if stmt is None:
+            log.debug('No bulk upsert for %s, merging one by one', dialect)
+            _merge(session, objs, update)
+            continue
+        for start in range(0, len(rows), chunk_size):
+            session.execute(stmt, rows[start:start+chunk_size])
+
 class DB(object):
+    #number of rows written per statement by _upsert_all
+    chunk_size = 1000
 
     def __init__(self, db_url):
         self._db_url = db_url
@@ -115,9 +196,16 @@ class DB(object):
             Base.metadata.create_all(self._engine)
             self._session = orm.scoped_session(orm.sessionmaker(self._engine, autoflush=False, autocommit=False, expire_on_commit=False))
     def _merge_all(self, objects):
+        """Insert or update objects. Same as merging them one by one, but in bulk."""
+        return self._upsert_all(objects)
+
+    def _upsert_all(self, objects, update=True, chunk_size=None):
+        """Writes all objects in a single transaction, see bulk_upsert().
+        The objects aren't added to the session. Returns them."""
         self.open()
-        map(self._session.merge, objects)
+        bulk_upsert(self._session, objects, update=update, chunk_size=chunk_size or self.chunk_size)
         self._session.commit()
+        return objects
 
     def _add_all(self, objects, db_objects=[], new=None, existing=None, alter_session=True, update_function=None):
         """Adds many objects at once. In case the objects are already present, an update callback function